@@ -0,0 +1,190 @@
+import json
+import os
+
+from music_manager import SAVE_DIR
+from typing_window import BASE_HIGH, BASE_MID
+
+# percentiles of the user's window counts above which typing is 'mid' and 'high'
+DEFAULT_MID_PERCENTILE = 0.6
+DEFAULT_HIGH_PERCENTILE = 0.85
+# windows observed before the percentiles are trusted over the defaults
+MIN_OBSERVATIONS = 30
+# windows with fewer keystrokes are idle, and say nothing about typing speed
+MIN_ACTIVE_COUNT = 2
+# observations between saves to disk
+SAVE_INTERVAL = 30
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a single quantile with the P-squared algorithm
+    (Jain and Chlamtac, 1985): five markers whose heights are adjusted with
+    piecewise-parabolic interpolation as observations arrive, so that the
+    estimate takes constant memory and O(1) time per observation.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        # the first five observations, until the markers are initialised
+        self.initial = []
+        # marker heights, actual positions and desired positions
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def __len__(self):
+        if self.positions is None:
+            return len(self.initial)
+        return int(self.positions[4]) + 1
+
+    def add(self, value):
+        if self.heights is None:
+            self.initial.append(float(value))
+            if len(self.initial) == 5:
+                self.heights = sorted(self.initial)
+                self.positions = [0.0, 1.0, 2.0, 3.0, 4.0]
+                self.desired = [0.0, 2 * self.p, 4 * self.p, 2 + 2 * self.p, 4.0]
+            return
+
+        heights, positions = self.heights, self.positions
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        heights, positions = self.heights, self.positions
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1])
+        )
+
+    def value(self):
+        if self.heights is None:
+            if not self.initial:
+                return None
+            ordered = sorted(self.initial)
+            return ordered[int(round(self.p * (len(ordered) - 1)))]
+        return self.heights[2]
+
+    def to_dict(self):
+        return {
+            'p': self.p,
+            'initial': self.initial,
+            'heights': self.heights,
+            'positions': self.positions,
+            'desired': self.desired,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        quantile = cls(data['p'])
+        quantile.initial = list(data['initial'])
+        quantile.heights = data['heights']
+        quantile.positions = data['positions']
+        quantile.desired = data['desired']
+        return quantile
+
+
+class AdaptiveThresholds:
+    """
+    Derives the mid and high typing thresholds from percentiles of the
+    user's own window counts, tracked with P2Quantile estimators and saved
+    across sessions.
+    """
+
+    def __init__(self, mid_percentile=DEFAULT_MID_PERCENTILE, high_percentile=DEFAULT_HIGH_PERCENTILE,
+                 default_mid=BASE_MID, default_high=BASE_HIGH, path=None, key='default'):
+        """
+        :param default_mid: mid threshold used until MIN_OBSERVATIONS windows have been seen
+        :param default_high: high threshold used until MIN_OBSERVATIONS windows have been seen
+        :param path: json file the estimators are saved to and restored from
+        :param key: entry of the file to use - counts are only comparable
+                    between sessions with the same window size
+        """
+        self.default_mid = default_mid
+        self.default_high = default_high
+        self.path = path
+        self.key = key
+        self.mid = P2Quantile(mid_percentile)
+        self.high = P2Quantile(high_percentile)
+        self.unsaved = 0
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def for_profile(cls, profile, beat_window_size, **kwargs):
+        path = str(SAVE_DIR / '{}.thresholds.json'.format(profile))
+        return cls(path=path, key='{:g}'.format(beat_window_size), **kwargs)
+
+    def observe(self, count):
+        """
+        Adds a window's keystroke count - O(1)
+
+        :return: whether the count was used
+        """
+        if count < MIN_ACTIVE_COUNT:
+            return False
+        self.mid.add(count)
+        self.high.add(count)
+
+        self.unsaved += 1
+        if self.path is not None and self.unsaved >= SAVE_INTERVAL:
+            self.save()
+        return True
+
+    def thresholds(self):
+        """
+        Returns the (mid, high) thresholds
+        """
+        if len(self.mid) < MIN_OBSERVATIONS:
+            return self.default_mid, self.default_high
+        mid = self.mid.value()
+        # the thresholds must stay apart for the three moods to exist
+        return mid, max(self.high.value(), mid + 1)
+
+    def load(self):
+        with open(self.path, 'r') as raw_data:
+            entry = json.load(raw_data).get(self.key)
+        if entry is not None:
+            self.mid = P2Quantile.from_dict(entry['mid'])
+            self.high = P2Quantile.from_dict(entry['high'])
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as raw_data:
+                data = json.load(raw_data)
+        data[self.key] = {'mid': self.mid.to_dict(), 'high': self.high.to_dict()}
+
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as raw_file:
+            json.dump(data, raw_file)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
@@ -0,0 +1,177 @@
+import json
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+import queue
+
+# what a full subscription does with a new item
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+
+class Subscription:
+    """
+    One subscriber's buffer of the items published on a BeatBus. Behaves
+    like a queue.Queue for the subscriber, but put never blocks - once
+    maxsize items are waiting, the overflow policy decides which is dropped.
+    """
+
+    def __init__(self, name, maxsize=0, overflow=DROP_OLDEST):
+        """
+        :param maxsize: maximum number of waiting items, 0 for no limit
+        :param overflow: DROP_OLDEST or DROP_NEWEST
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}, should be one of: {}'.format(
+                overflow, ', '.join(OVERFLOW_POLICIES)
+            ))
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.items = deque()
+        self.condition = Condition()
+        self.unfinished_tasks = 0
+
+        # counters, readable through stats()
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.condition:
+            if self.maxsize > 0 and len(self.items) >= self.maxsize:
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return
+                self.items.popleft()
+                self.unfinished_tasks -= 1
+            self.items.append(item)
+            self.unfinished_tasks += 1
+            self.delivered += 1
+            self.condition.notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if not block:
+                if not self.items:
+                    raise queue.Empty
+            elif not self.condition.wait_for(lambda: self.items, timeout):
+                raise queue.Empty
+            return self.items.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self.condition:
+            if self.unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks == 0:
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.unfinished_tasks == 0)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.items)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def stats(self):
+        with self.condition:
+            return {
+                'depth': len(self.items),
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+            }
+
+
+class BeatBus:
+    """
+    Broadcasts the (count, time) windows and events of a beat source to any
+    number of subscribers, each with its own buffer, so that a slow
+    subscriber (such as the visualizer) loses items instead of holding up
+    the others (such as the player).
+
+    The bus can be handed to a beat source in place of a queue, as put
+    publishes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # replaced rather than modified, so publishing never takes the lock
+        self.sinks = ()
+
+    def subscribe(self, name, maxsize=0, overflow=DROP_OLDEST):
+        """
+        :return: a Subscription receiving every item published from now on
+        """
+        subscription = Subscription(name, maxsize=maxsize, overflow=overflow)
+        self.attach(subscription)
+        return subscription
+
+    def attach(self, sink):
+        """
+        Delivers every item published from now on to sink.put - the sink must
+        never block (e.g. an unbounded queue, or the player's AsyncQueueBridge)
+        """
+        with self.lock:
+            self.sinks = self.sinks + (sink,)
+        return sink
+
+    def unsubscribe(self, sink):
+        with self.lock:
+            self.sinks = tuple(s for s in self.sinks if s is not sink)
+
+    def publish(self, item):
+        for sink in self.sinks:
+            sink.put(item)
+
+    def put(self, item, block=True, timeout=None):
+        self.publish(item)
+
+    def qsize(self):
+        """
+        Returns the depth of the most backed-up subscriber
+        """
+        return max((sink.qsize() for sink in self.sinks), default=0)
+
+
+class TraceRecorder:
+    """
+    Writes the items of a subscription to a trace file as they arrive, in
+    the JSON lines format read by simulator.load_trace.
+    """
+
+    def __init__(self, subscription, path):
+        self.subscription = subscription
+        self.path = path
+        self.closed = Event()
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _run(self):
+        with open(self.path, 'a') as raw_file:
+            while not self.closed.is_set():
+                try:
+                    item = self.subscription.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                raw_file.write(json.dumps(item))
+                raw_file.write('\n')
+                # only flush once caught up
+                if self.subscription.empty():
+                    raw_file.flush()
+                self.subscription.task_done()
+
+    def close(self):
+        self.closed.set()
+        self.runner.join()
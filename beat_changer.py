@@ -10,6 +10,54 @@ class BaseBeatChanger(ABC):
         """
         pass
 
+    def configure_window(self, window):
+        """
+        Gives the beat changer the typing_window.TypingWindow that the player
+        maintains, whose running statistics can be read instead of re-scanning
+        the times and counts passed to change_music.
+        """
+        self.window = window
+
+    def configure_feedback(self, feedback):
+        """
+        Gives the beat changer a feedback_store.FeedbackStore, which the
+        weights of the snippets are loaded from in configure_tracks, and
+        changes to them are recorded to.
+        """
+        self.feedback = feedback
+
+    def initial_weight(self, snippet):
+        """
+        Returns the weight a snippet starts with in configure_tracks - the
+        learnt one, if any
+        """
+        if self.feedback is None:
+            return 1.0
+        return self.feedback.weight(snippet)
+
+    def record_weight(self, snippet, weight):
+        if self.feedback is not None:
+            self.feedback.record(snippet, weight)
+
+    def change_interval(self, window_size):
+        """
+        Returns the number of windows the player waits after a change before
+        calling change_music again - by default, until the window has been
+        entirely replaced.
+        """
+        return window_size
+
+    def prepare_next(self, times, counts):
+        """
+        Called with the window after every new beat window, including those
+        for which change_music is not called.
+
+        Returns None, or the song filename and offset of the song the beat
+        changer expects to change to next, which the player asks the backend
+        to preload.
+        """
+        return None
+
     @abstractmethod
     def configure_tracks(self, music_manager):
         """
@@ -18,6 +66,21 @@ class BaseBeatChanger(ABC):
         """
         pass
 
+    def update_tracks(self, added, removed):
+        """
+        Adds snippets to and removes songs from the beat changer's song list
+        while it is playing, without rebuilding it from the whole library.
+        Snippets of a removed song which is being played may still be passed
+        to notify_event.
+
+        :param added: list of (mood, snippet) - mood is one of 'low', 'mid'
+                      or 'high'
+        :param removed: list of songs whose snippets should no longer be played
+        :raises NotImplementedError: if the beat changer can only be given its
+                                     songs by configure_tracks
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def change_music(self, times, counts, repeated=False):
         """
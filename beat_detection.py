@@ -2,7 +2,6 @@ from scipy.io import wavfile
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.fftpack
-import sounddevice as sd
 from collections import deque
 import math
 import time
@@ -11,7 +10,7 @@ PYFFT_ENABLED = True
 try:
     import pyfftw
 except ImportError:
-    PYFFT_ENABLED
+    PYFFT_ENABLED = False
     print("INFO: Could not load pyfftw, defaulting to scipy instead.")
 
 BEAT_LOW = 10
@@ -57,9 +56,19 @@ class FrequencySelectedEnergyDetector:
 
 
 
-    def transform(self, data):
-        if data.shape[1] == 2:
-            data = data[:,0] + 1j * data[:,1]
+    def transform(self, data, timings=None):
+        """
+        :param data: the samples of the audio, one column per channel
+        :param timings: if specified, a dict to which the seconds spent in the
+                        'fft' and 'band_reduction' stages are added
+        """
+        if data.ndim > 1:
+            if data.shape[1] == 2:
+                data = data[:,0] + 1j * data[:,1]
+            else:
+                data = data.mean(axis=1)
+
+        started = time.perf_counter()
 
         n_blocks = data.shape[0] // self.block_size
         band_energy_history = [deque() for i in range(self.frequency_bands)]
@@ -71,6 +80,7 @@ class FrequencySelectedEnergyDetector:
             fft_data = pyfftw.interfaces.scipy_fftpack.fft(data)
         else:
             fft_data = scipy.fftpack.fft(data)
+        fft_time = time.perf_counter() - started
 
         if self.verbose:
             print("INFO: Completed fft transform on data. Now beginning beat detection.")
@@ -82,9 +92,10 @@ class FrequencySelectedEnergyDetector:
 
             return data[lower_bound:upper_bound]
 
-        def calculate_block_energy(block):
-            energy_block = np.absolute(scipy.fftpack.fft(block))
+        def calculate_block_spectrum(block):
+            return np.absolute(scipy.fftpack.fft(block))
 
+        def calculate_band_energy(energy_block):
             band_energy = [
                 band.mean()
                 for band in
@@ -119,6 +130,8 @@ class FrequencySelectedEnergyDetector:
         energy_values = []
 
 
+        block_fft_time = 0.0
+        loop_started = time.perf_counter()
         for block_index in range(n_blocks):
 
             if self.threshold is None:
@@ -127,7 +140,13 @@ class FrequencySelectedEnergyDetector:
                 threshold = [self.threshold] * len(band_energy_history)
 
             block = get_block_at_index(block_index)
-            energy = calculate_block_energy(block)
+            if timings is not None:
+                started = time.perf_counter()
+                spectrum = calculate_block_spectrum(block)
+                block_fft_time += time.perf_counter() - started
+                energy = calculate_band_energy(spectrum)
+            else:
+                energy = calculate_band_energy(calculate_block_spectrum(block))
 
 
             if self.plot_waveform:
@@ -143,6 +162,13 @@ class FrequencySelectedEnergyDetector:
 
             record_block_energy(energy)
 
+        if timings is not None:
+            # everything in the loop but the block FFTs is band reduction
+            timings['fft'] = timings.get('fft', 0.0) + fft_time + block_fft_time
+            timings['band_reduction'] = timings.get('band_reduction', 0.0) + (
+                time.perf_counter() - loop_started - block_fft_time
+            )
+
         if self.verbose:
             print("INFO: Completed beat detection.")
 
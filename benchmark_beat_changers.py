@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from math import ceil
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from simulator import CHANGERS, load_trace, synthetic_music_manager, synthetic_trace
+from typing_window import TypingWindow
+
+# library sizes benchmarked by default, as (snippets, songs)
+DEFAULT_SIZES = '10:1,1000:100,100000:10000'
+
+
+def parse_sizes(value):
+    """
+    Parses a comma separated list of SNIPPETS:SONGS pairs
+    """
+    sizes = []
+    for pair in value.split(','):
+        snippets, songs = pair.split(':')
+        snippets, songs = int(snippets), int(songs)
+        if songs < 1 or snippets < songs:
+            raise ValueError('Every song needs at least one snippet: {}'.format(pair))
+        sizes.append((snippets, songs))
+    return sizes
+
+
+def summarise(values, scale=1.0):
+    values = np.array(values, dtype=float) * scale
+    if len(values) == 0:
+        return None
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def benchmark_changer(changer_class, music_manager, windows, beat_window_size=10.0, min_change_time=120,
+                      seed=0, trace_allocations=True):
+    """
+    Feeds the windows to a beat changer as the player would, timing every
+    change_music call, and a notify_event call after each of them.
+
+    :param windows: list of (count, time) tuples
+    :param trace_allocations: also run the windows through a second changer
+                              with tracemalloc on, recording the memory it
+                              holds and the bytes allocated by every call -
+                              tracemalloc slows the calls down, so they are
+                              not timed then
+    :return: a dict of the results
+    """
+    window_size = int(ceil(min_change_time / beat_window_size) + 1)
+
+    def configure():
+        random.seed(seed)
+        np.random.seed(seed)
+        changer = changer_class()
+        changer.configure_tracks(music_manager)
+        changer.configure_parameters(beat_window_size=beat_window_size, window_size=window_size)
+        window = TypingWindow(window_size)
+        changer.configure_window(window)
+        return changer, window
+
+    started = time.perf_counter()
+    changer, window = configure()
+    configure_seconds = time.perf_counter() - started
+
+    change_times, notify_times = [], []
+    changes = 0
+    for i, (count, start) in enumerate(windows):
+        window.push(count, start)
+        changer.prepare_next(window.times, window.counts)
+
+        started = time.perf_counter()
+        result = changer.change_music(window.times, window.counts)
+        change_times.append(time.perf_counter() - started)
+        if result is not None:
+            changes += 1
+
+        started = time.perf_counter()
+        changer.notify_event('good' if i % 2 == 0 else 'bad')
+        notify_times.append(time.perf_counter() - started)
+
+    results = {
+        'changer': changer_class.__name__,
+        'snippets': sum(len(snippets) for snippets in (
+            music_manager.slow_snippets, music_manager.base_snippets, music_manager.fast_snippets
+        )),
+        'songs': len(music_manager.songs),
+        'calls': len(windows),
+        'changes': changes,
+        'configure_seconds': configure_seconds,
+        'change_music_us': summarise(change_times, 1e6),
+        'notify_event_us': summarise(notify_times, 1e6),
+    }
+
+    if trace_allocations:
+        del changer, window
+        tracemalloc.start()
+        changer, window = configure()
+        # what the beat changer keeps of the library, and what building it took
+        results['retained_bytes'], results['configure_peak_bytes'] = tracemalloc.get_traced_memory()
+
+        change_bytes, notify_bytes = [], []
+        for i, (count, start) in enumerate(windows):
+            window.push(count, start)
+            changer.prepare_next(window.times, window.counts)
+
+            # clearing the traces resets the peak, so the peak after the call
+            # is what it allocated
+            tracemalloc.clear_traces()
+            changer.change_music(window.times, window.counts)
+            change_bytes.append(tracemalloc.get_traced_memory()[1])
+
+            tracemalloc.clear_traces()
+            changer.notify_event('good' if i % 2 == 0 else 'bad')
+            notify_bytes.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        results['change_music_allocated_bytes'] = summarise(change_bytes)
+        results['notify_event_allocated_bytes'] = summarise(notify_bytes)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measures the cost of the beat changers\' decisions on synthetic libraries')
+
+    parser.add_argument(
+        '--sizes', metavar='SNIPPETS:SONGS[,...]', default=DEFAULT_SIZES,
+        help='Library sizes to benchmark, as snippet:song counts. Defaults to {}'.format(DEFAULT_SIZES)
+    )
+
+    parser.add_argument(
+        '-c', '--changers', metavar='CHANGER', nargs='+', choices=sorted(CHANGERS), default=sorted(CHANGERS),
+        help='Beat changers to benchmark. Defaults to all of: {}'.format(', '.join(sorted(CHANGERS)))
+    )
+
+    parser.add_argument(
+        '-t', '--trace', metavar='TRACE', default=None,
+        help='Trace of windows to replay, as saved by simulator.py or --record-trace. Defaults to a synthetic trace.'
+    )
+
+    parser.add_argument(
+        '-n', '--calls', metavar='N', type=int, default=1000,
+        help='Number of windows to feed each beat changer'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='SEED', type=int, default=0,
+        help='Seed for the synthetic trace, libraries and beat changers'
+    )
+
+    parser.add_argument(
+        '--no-allocations', action='store_true',
+        help='Skip the second pass recording the memory held by each beat changer and allocated by each call'
+    )
+
+    parser.add_argument(
+        '-o', '--output', metavar='PATH', default=None,
+        help='Write the results to this file rather than printing them'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        sizes = parse_sizes(args.sizes)
+    except ValueError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        exit(-1)
+
+    if args.trace is not None:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(float('inf'), seed=args.seed)
+    # only the windows - the events are sent after every decision instead
+    windows = []
+    for item in trace:
+        if isinstance(item, tuple):
+            windows.append(item)
+            if len(windows) == args.calls:
+                break
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'trace': args.trace,
+        'results': [],
+    }
+
+    for snippets, songs in sizes:
+        music_manager = synthetic_music_manager(songs, snippets_per_song=snippets // songs, seed=args.seed)
+        for name in args.changers:
+            print('INFO: Benchmarking {} on {} snippets of {} songs'.format(name, snippets, songs), file=sys.stderr)
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                results = benchmark_changer(
+                    CHANGERS[name], music_manager, windows, seed=args.seed,
+                    trace_allocations=not args.no_allocations,
+                )
+            report['results'].append(results)
+        del music_manager
+
+    if args.output is not None:
+        with open(args.output, 'w') as raw_file:
+            json.dump(report, raw_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+from argparse import ArgumentParser
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile
+
+from music_manager import MusicManager
+
+# the corpus is spread over these, to cover the resampling-free and odd cases
+SAMPLE_RATES = [22050, 44100, 48000]
+CHANNELS = [1, 2]
+FORMATS = {'WAV': '.wav', 'FLAC': '.flac'}
+# tempo range of the synthetic music, in clicks per minute - the default
+# library thresholds fall at about 300 and 600, so sections of every mood
+# are generated
+MIN_TEMPO = 90
+MAX_TEMPO = 720
+# a regression is a drop in throughput or growth in peak RSS of more than this
+DEFAULT_TOLERANCE = 0.2
+# seconds between checks that the ingestion process is still running
+POLL_INTERVAL = 1.0
+# the stages of MusicManager.add_song reported, and save_to_disk
+STAGES = ['read', 'fft', 'band_reduction', 'beats_per_interval', 'features', 'segmentation', 'save_to_disk']
+
+
+def synthetic_song(length, rate, channels, rng):
+    """
+    Generates a song of clicks over a tone and noise, whose tempo changes
+    every 10 to 60 seconds, so that it splits into snippets of several moods.
+    """
+    samples = int(length * rate)
+    song = 0.05 * rng.standard_normal(samples).astype(np.float32)
+    song += 0.1 * np.sin(2 * np.pi * rng.uniform(110, 440) * np.arange(samples) / rate).astype(np.float32)
+
+    click = np.exp(-np.arange(int(0.05 * rate)) / (0.005 * rate)).astype(np.float32)
+    position = 0.0
+    while position < length:
+        section_end = min(position + rng.uniform(10, 60), length)
+        beat = 60.0 / rng.uniform(MIN_TEMPO, MAX_TEMPO)
+        for start in np.arange(position, section_end, beat):
+            first = int(start * rate)
+            last = min(first + len(click), samples)
+            song[first:last] += 0.8 * click[:last - first]
+        position = section_end
+
+    song = np.clip(song, -1.0, 1.0)
+    if channels == 1:
+        return song
+    return np.column_stack([song] * channels)
+
+
+def generate_corpus(directory, n_songs, min_length=20.0, max_length=120.0, seed=0):
+    """
+    Writes n_songs songs of varied lengths, sample rates, channel counts and
+    formats to directory
+
+    :return: the paths of the songs
+    """
+    rng = np.random.RandomState(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    songs = []
+    for index in range(n_songs):
+        rate = SAMPLE_RATES[rng.randint(len(SAMPLE_RATES))]
+        channels = CHANNELS[rng.randint(len(CHANNELS))]
+        file_format = sorted(FORMATS)[rng.randint(len(FORMATS))]
+        length = rng.uniform(min_length, max_length)
+
+        path = directory / 'song_{:04}{}'.format(index, FORMATS[file_format])
+        soundfile.write(str(path), synthetic_song(length, rate, channels, rng), rate, format=file_format)
+        songs.append(str(path.resolve()))
+    return songs
+
+
+def find_corpus(directory):
+    return sorted(
+        str(path.resolve()) for path in Path(directory).iterdir() if path.suffix in FORMATS.values()
+    )
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_ingestion(songs, workers, results):
+    """
+    Adds the songs to a new library and saves it, putting the measurements on
+    the results queue. Runs in a process of its own, so that the peak RSS is
+    that of the ingestion alone.
+    """
+    timings = {}
+    music_manager = MusicManager()
+
+    started = time.perf_counter()
+    music_manager.add_songs(songs, workers=workers, timings=timings)
+
+    save_started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        music_manager.save_to_disk(os.path.join(directory, 'benchmark.json'))
+    timings['save_to_disk'] = time.perf_counter() - save_started
+    wall_seconds = time.perf_counter() - started
+
+    audio_seconds = sum(music_manager.song_info[song]['duration'] for song in music_manager.songs)
+    results.put({
+        'workers': workers,
+        'songs': len(music_manager.songs),
+        'snippets': len(music_manager.snippet_moods()),
+        'audio_seconds': audio_seconds,
+        'wall_seconds': wall_seconds,
+        'songs_per_minute': 60.0 * len(music_manager.songs) / wall_seconds,
+        'audio_seconds_per_second': audio_seconds / wall_seconds,
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if workers > 1 else None,
+        'stage_seconds': {stage: timings.get(stage, 0.0) for stage in STAGES},
+    })
+
+
+def measure(songs, workers):
+    """
+    Runs run_ingestion in a process of its own
+
+    :raises RuntimeError: if the process exits without sending its results
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_ingestion, args=(songs, workers, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=POLL_INTERVAL)
+            break
+        except queue.Empty:
+            # the results may have been sent just before the process exited
+            if not process.is_alive() and results.empty():
+                process.join()
+                raise RuntimeError('Ingestion with {} worker(s) failed, exit code {}'.format(
+                    workers, process.exitcode
+                ))
+    process.join()
+    return result
+
+
+def find_regressions(report, baseline, tolerance):
+    """
+    Compares the throughput and peak RSS of every mode with the baseline
+
+    :return: a list of descriptions of the regressions
+    """
+    regressions = []
+    for mode, result in report['modes'].items():
+        previous = baseline['modes'].get(mode)
+        if previous is None:
+            continue
+        if result['audio_seconds_per_second'] < previous['audio_seconds_per_second'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} audio seconds per second, down from {:.1f}'.format(
+                mode, result['audio_seconds_per_second'], previous['audio_seconds_per_second']
+            ))
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{}: peak RSS of {:.1f}MB, up from {:.1f}MB'.format(
+                mode, result['peak_rss_mb'], previous['peak_rss_mb']
+            ))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measures how fast songs are added to a library, and how much memory it takes')
+
+    parser.add_argument(
+        '--corpus', metavar='DIR', default=None,
+        help='Directory of songs to add. Generated in it if it has no WAV or FLAC files, or in a temporary '
+             'directory if not given.'
+    )
+
+    parser.add_argument(
+        '-n', '--songs', metavar='N', type=int, default=20,
+        help='Number of songs to generate'
+    )
+
+    parser.add_argument(
+        '--min-length', metavar='SECONDS', type=float, default=20.0,
+        help='Shortest generated song'
+    )
+
+    parser.add_argument(
+        '--max-length', metavar='SECONDS', type=float, default=120.0,
+        help='Longest generated song'
+    )
+
+    parser.add_argument(
+        '-j', '--workers', metavar='N', type=int, default=os.cpu_count() or 1,
+        help='Number of worker processes for the parallel run. Defaults to the number of CPUs.'
+    )
+
+    parser.add_argument(
+        '--modes', metavar='MODE', nargs='+', choices=['serial', 'parallel'], default=['serial', 'parallel'],
+        help='Runs to make. Should be some of: serial, parallel'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='SEED', type=int, default=0,
+        help='Seed for the generated songs'
+    )
+
+    parser.add_argument(
+        '-o', '--output', metavar='PATH', default=None,
+        help='Write the results to this file rather than printing them'
+    )
+
+    parser.add_argument(
+        '--save-baseline', metavar='PATH', default=None,
+        help='Save the results as a baseline for later runs'
+    )
+
+    parser.add_argument(
+        '--baseline', metavar='PATH', default=None,
+        help='Fail if the throughput or peak RSS of a run regressed from this baseline'
+    )
+
+    parser.add_argument(
+        '--tolerance', metavar='FRACTION', type=float, default=DEFAULT_TOLERANCE,
+        help='Fraction by which a run may be slower or use more memory than the baseline. '
+             'Defaults to {}'.format(DEFAULT_TOLERANCE)
+    )
+
+    args = parser.parse_args()
+
+    temporary = None
+    if args.corpus is None:
+        temporary = tempfile.mkdtemp(prefix='typemusic-corpus-')
+        corpus = temporary
+    else:
+        corpus = args.corpus
+
+    try:
+        songs = find_corpus(corpus) if os.path.isdir(corpus) else []
+        if not songs:
+            print('INFO: Generating {} songs in {}'.format(args.songs, corpus), file=sys.stderr)
+            songs = generate_corpus(corpus, args.songs, args.min_length, args.max_length, seed=args.seed)
+
+        report = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'corpus': args.corpus,
+            'modes': {},
+        }
+        for mode in args.modes:
+            workers = 1 if mode == 'serial' else args.workers
+            print('INFO: Adding {} songs with {} worker(s)'.format(len(songs), workers), file=sys.stderr)
+            try:
+                report['modes'][mode] = measure(songs, workers)
+            except RuntimeError as e:
+                print('Error: {}'.format(e), file=sys.stderr)
+                exit(1)
+    finally:
+        if temporary is not None:
+            shutil.rmtree(temporary)
+
+    if args.output is not None:
+        with open(args.output, 'w') as raw_file:
+            json.dump(report, raw_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as raw_file:
+            json.dump(report, raw_file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as raw_data:
+            regressions = find_regressions(report, json.load(raw_data), args.tolerance)
+        if regressions:
+            for regression in regressions:
+                print('Error: Regressed from the baseline - {}'.format(regression), file=sys.stderr)
+            exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+from argparse import ArgumentParser
+import json
+import platform
+import queue
+import random
+import sys
+import time
+
+import numpy as np
+
+from network_beats import PACKET, PACKET_MAGIC, PACKET_VERSION, BeatReceiver, BeatSender
+
+
+def run_loopback(senders, slots, window_size, max_skew, loss, seed):
+    """
+    Sends slots windows from each of senders BeatSenders, whose clocks are
+    skewed by up to max_skew seconds, to a BeatReceiver over the loopback
+    interface, in real time. loss is the fraction of windows which are
+    deliberately not sent.
+
+    :return: a dict of the results - the merged counts should equal the
+             sums of the counts sent for every slot
+    """
+    rng = random.Random(seed)
+    receiver = BeatReceiver(window_size, port=0, host='127.0.0.1')
+    merged = receiver.bus.subscribe('benchmark')
+
+    skews = [rng.uniform(-max_skew, max_skew) for _ in range(senders)]
+    # the senders are driven directly, so their queues stay empty
+    beat_senders = [
+        BeatSender(queue.Queue(), receiver.address, window_size, host_id=host + 1) for host in range(senders)
+    ]
+
+    expected = []
+    dropped = 0
+    started = time.monotonic()
+    for slot in range(slots):
+        # each window is sent as it closes, as the keyboard detector does
+        slot_end = started + (slot + 1) * window_size
+        time.sleep(max(slot_end - time.monotonic(), 0))
+
+        total = 0
+        for sender, skew in zip(beat_senders, skews):
+            count = rng.randint(0, 80)
+            if rng.random() < loss:
+                # lost on the way - the sequence number is still used up
+                sender.sequence = (sender.sequence + 1) & 0xffffffff
+                dropped += 1
+                continue
+            sender.send(count, slot_end - window_size + skew)
+            total += count
+        expected.append(total)
+
+    # every slot is published lateness seconds after it closes
+    time.sleep(2 * window_size)
+
+    published = []
+    while True:
+        try:
+            item = merged.get_nowait()
+        except queue.Empty:
+            break
+        if isinstance(item, tuple):
+            published.append(int(item[0]))
+
+    stats = receiver.stats()
+    receiver.close()
+
+    mismatched = sum(1 for got, want in zip(published, expected) if got != want)
+    mismatched += max(len(expected) - len(published), 0)
+    return {
+        'senders': senders,
+        'slots': slots,
+        'window_size': window_size,
+        'max_skew': max_skew,
+        'dropped_on_purpose': dropped,
+        'mismatched_slots': mismatched,
+        'receiver': stats,
+    }
+
+
+def time_packet_handling(hosts, slots, window_size):
+    """
+    Times BeatReceiver._handle_packet on prepared packets from hosts hosts,
+    on a fake clock so that no time is spent waiting
+
+    :return: the microseconds taken per packet
+    """
+    now = [0.0]
+    receiver = BeatReceiver(window_size, port=0, host='127.0.0.1', clock=lambda: now[0])
+    receiver.close()
+
+    packets = []
+    for slot in range(slots):
+        packets.append([
+            PACKET.pack(PACKET_MAGIC, PACKET_VERSION, host + 1, slot, slot * window_size, window_size, 10)
+            for host in range(hosts)
+        ])
+
+    times = []
+    for slot, slot_packets in enumerate(packets):
+        now[0] = (slot + 1) * window_size
+        started = time.perf_counter()
+        for packet in slot_packets:
+            receiver._handle_packet(packet, len(packet))
+        times.append((time.perf_counter() - started) / len(slot_packets))
+        receiver.merger.flush(now[0])
+    return float(np.median(times) * 1e6)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Merges windows from many loopback senders on skewed clocks, checking '
+                                        'the merged counts and timing the receiver')
+
+    parser.add_argument(
+        '-n', '--senders', metavar='N', type=int, default=30,
+        help='Number of senders'
+    )
+
+    parser.add_argument(
+        '--slots', metavar='N', type=int, default=20,
+        help='Number of windows each sender sends'
+    )
+
+    parser.add_argument(
+        '--window-size', metavar='SECONDS', type=float, default=0.2,
+        help='Length of the windows - shorter than the player\'s, so the run is quick'
+    )
+
+    parser.add_argument(
+        '--max-skew', metavar='SECONDS', type=float, default=3600.0,
+        help='Largest offset of a sender\'s clock from the receiver\'s'
+    )
+
+    parser.add_argument(
+        '--loss', metavar='FRACTION', type=float, default=0.0,
+        help='Fraction of the windows not sent, to check that they are counted as lost'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='SEED', type=int, default=0,
+        help='Seed for the counts, skews and losses'
+    )
+
+    parser.add_argument(
+        '-o', '--output', metavar='PATH', default=None,
+        help='Write the results to this file rather than printing them'
+    )
+
+    args = parser.parse_args()
+
+    print('INFO: Sending {} windows from each of {} senders'.format(args.slots, args.senders), file=sys.stderr)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'loopback': run_loopback(args.senders, args.slots, args.window_size, args.max_skew, args.loss, args.seed),
+        'handle_packet_us': time_packet_handling(args.senders, 1000, args.window_size),
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as raw_file:
+            json.dump(report, raw_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if report['loopback']['mismatched_slots']:
+        print('Error: {} slots were not merged to the counts sent'.format(report['loopback']['mismatched_slots']),
+              file=sys.stderr)
+        exit(1)
@@ -0,0 +1,90 @@
+import json
+import os
+
+from music_manager import SAVE_DIR
+
+# the log is rewritten with only the latest weights on loading once it has
+# more than this many times as many lines as weights (plus COMPACT_MIN_LINES)
+COMPACT_FACTOR = 2
+COMPACT_MIN_LINES = 1000
+
+
+def snippet_id(snippet):
+    """
+    Returns an id for a snippet which stays the same across sessions and
+    re-analysis of the library - its song and start time
+    """
+    return '{}@{:g}'.format(snippet['song'], snippet['start'])
+
+
+class FeedbackStore:
+    """
+    The weights learnt from the user's feedback, by snippet id, kept in an
+    append-only log of JSON [id, weight] lines - recording a change appends
+    a line rather than rewriting anything, and loading replays the log so
+    the last weight recorded for each snippet wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.weights = {}
+        self.lines = 0
+        # whether the log ends part way through a line
+        self.torn = False
+
+        if os.path.exists(path):
+            self.load()
+
+        self._file = open(path, 'a', buffering=1)
+        if self.torn:
+            self._file.write('\n')
+
+    @classmethod
+    def for_profile(cls, profile, changer):
+        """
+        :param changer: name of the beat changer - they scale weights
+                        differently, so each has its own log
+        """
+        return cls(str(SAVE_DIR / '{}.{}.weights'.format(profile, changer)))
+
+    def load(self):
+        with open(self.path, 'r') as raw_data:
+            for line in raw_data:
+                self.torn = not line.endswith('\n')
+                try:
+                    key, weight = json.loads(line)
+                except ValueError:
+                    # the last line is cut short if the process died while
+                    # writing it
+                    continue
+                self.weights[key] = float(weight)
+                self.lines += 1
+
+        if self.lines > COMPACT_FACTOR * len(self.weights) + COMPACT_MIN_LINES:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrites the log with one line per snippet
+        """
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as raw_file:
+            for key, weight in self.weights.items():
+                raw_file.write(json.dumps([key, weight]))
+                raw_file.write('\n')
+        os.replace(temp_path, self.path)
+        self.lines = len(self.weights)
+        self.torn = False
+
+    def weight(self, snippet, default=1.0):
+        return self.weights.get(snippet_id(snippet), default)
+
+    def record(self, snippet, weight):
+        key = snippet_id(snippet)
+        self.weights[key] = weight
+        self._file.write(json.dumps([key, weight]))
+        self._file.write('\n')
+        self.lines += 1
+
+    def close(self):
+        self._file.close()
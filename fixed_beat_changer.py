@@ -1,28 +1,54 @@
 import random
+from math import floor
 
 import numpy as np
 from beat_changer import BaseBeatChanger
+from transition_index import IndexedTracksMixin
+# defined with the window, which classifies the windows by them
+from typing_window import BASE_HIGH, BASE_MID
 
 
 # Represents the maximum number of beat windows for which the same song can be played
 MAX_REPEAT_COUNT = 3
-BASE_HIGH = 50
-BASE_MID = 40
 
 
-class FixedBeatChanger(BaseBeatChanger):
+class FixedBeatChanger(IndexedTracksMixin, BaseBeatChanger):
 
     def configure_parameters(self, beat_window_size, window_size):
         self.beat_window_size = beat_window_size
         self.window_size = window_size
 
-    def __init__(self):
+    def configure_window(self, window):
+        window.set_thresholds(self.mid_threshold, self.high_threshold)
+        self.window = window
+
+    def __init__(self, thresholds=None):
+        """
+        :param thresholds: if specified, an adaptive_thresholds.AdaptiveThresholds
+                           which the mid and high thresholds are taken from, in
+                           place of BASE_MID and BASE_HIGH
+        """
+        self.window = None
+        self.feedback = None
+
+        self.thresholds = thresholds
+        self.mid_threshold = BASE_MID
+        self.high_threshold = BASE_HIGH
+        self.last_observed = None
+        if thresholds is not None:
+            self.update_thresholds()
+
         self.low_tracks = []
         self.high_tracks = []
         self.medium_tracks = []
 
+        # mood -> list of (snippet, [weight]), and the samplers over them
+        self.tracks = {}
+        self.index = None
+
         self.last_choice = None
         self.last_selected = None
+        self.last_selected_index = None
         self.last_choice_count = 0
 
     def play_initial(self):
@@ -30,24 +56,31 @@ class FixedBeatChanger(BaseBeatChanger):
         return value[0]['song'], value[0]['start']
 
     def change_music(self, times, counts, repeated=False):
-        count_mean = np.array(counts).mean()
-
         choice = None
         low, mid, high = 0, 0, 0
 
+        if self.window is not None:
+            # the player's window holds exactly the windows passed in, with
+            # the mean and decayed mood weights already maintained
+            count_mean = self.window.mean()
+        else:
+            count_mean = np.array(counts).mean()
+
         if count_mean < 2.0:
             choice = 'low'
         else:
-
-            multiplier = 1
-            for time, count in zip(times, counts):
-                if count > BASE_HIGH:
-                    high +=  multiplier
-                elif count > BASE_MID:
-                    mid += multiplier
-                else:
-                    low += multiplier
-                multiplier *= 1.1
+            if self.window is not None:
+                low, mid, high = self.window.mood_weights()
+            else:
+                multiplier = 1
+                for time, count in zip(times, counts):
+                    if count > self.high_threshold:
+                        high +=  multiplier
+                    elif count > self.mid_threshold:
+                        mid += multiplier
+                    else:
+                        low += multiplier
+                    multiplier *= 1.1
 
             if high > mid and high > low:
                 choice = 'high'
@@ -64,59 +97,21 @@ class FixedBeatChanger(BaseBeatChanger):
             print('INFO: Song was repeated')
         print('choice{} != self.last_choice{} or self.last_choice_count{} >= MAX_REPEAT_COUNT{} or repeated{}  == {}'.format(choice, self.last_choice, self.last_choice_count, MAX_REPEAT_COUNT, repeated, choice != self.last_choice or self.last_choice_count >= MAX_REPEAT_COUNT or repeated))
         if choice != self.last_choice or self.last_choice_count >= MAX_REPEAT_COUNT or repeated:
+            previous = self.last_choice
             self.last_choice = choice
             self.last_choice_count = 0
 
-            values = None
-            if choice == 'high':
-                values = self.high_tracks
-            elif choice == 'mid':
-                values = self.medium_tracks
-            else:
-                values = self.low_tracks
-
-            # OLD SELECTION CODE - unfair allocation
-            # total_score = sum(i[1] for i in values)
-            # choice = total_score * np.random.uniform(0, 1)
-
-            # index = 0
-            # partial_choice = 0
-            # while index < len(values) - 1 and partial_choice < choice:
-            #     partial_choice += values[index][1]
-            #     index += 1
-            # index = max(min(0, index), len(values) - 1)
-
-
-            songs = list(set(song['song'] for (song, pos) in values))
-            song_sums = [sum(snippet[1][0] for snippet in values if snippet[0]['song'] == song)/len([snippet[1][0] for snippet in values if snippet[0]['song'] == song]) for song in songs]
-
-            choice = sum(song_sums) * np.random.uniform(0,1)
-
-            index = 0
-            partial_choice = 0
-            for i, value in enumerate(song_sums):
-                partial_choice += value
-                if partial_choice >= choice:
-                    index = i
-                    break
-
-            # choice = min(max(int(len(songs) * np.random.uniform(0, 1)), 0), len(songs) - 1)
-            choice = min(max(int(index), 0), len(songs) - 1)
-            song = songs[choice]
-            print('song priority sum: ', song_sums, song)
-
-            snippets = [snippet for snippet in values if snippet[0]['song'] == song]
-            total_score = sum(i[1][0] for i in snippets)
-            choice = total_score * np.random.uniform(0,1)
-
-            index = 0
-            partial_choice = 0
-            while index < len(snippets) - 1 and partial_choice < choice:
-                partial_choice += snippets[index][1][0]
-                index += 1
-
-            index = min(max(0, index), len(snippets) - 1)
-            self.last_selected = snippets[index]
+            # a song is drawn with probability proportional to the mean weight
+            # of its snippets, then one of its snippets proportional to weight -
+            # preferring snippets which ramp out of the previous mood
+            drawn = self.draw(previous, choice)
+            if drawn is None:
+                # every song has been removed from the library
+                return None
+            mood, index = drawn
+            self.last_selected = self.tracks[mood][index]
+            self.last_selected_index = drawn
+            print('song priority: ', self.last_selected[1][0], self.last_selected[0]['song'])
 
             return self.last_selected[0]['song'], self.last_selected[0]['start']
         else:
@@ -124,15 +119,32 @@ class FixedBeatChanger(BaseBeatChanger):
             # if the last choice was the same as the current, return nothing
             return None
 
+    def prepare_next(self, times, counts):
+        if self.thresholds is not None and len(times) > 0 and times[-1] != self.last_observed:
+            self.last_observed = times[-1]
+            if self.thresholds.observe(counts[-1]):
+                self.update_thresholds()
+        return None
+
+    def update_thresholds(self):
+        """
+        Takes the thresholds from the adaptive thresholds. The counts are whole
+        numbers, so only the integer part of a threshold changes the moods, and
+        the window is only reclassified when that changes.
+        """
+        mid, high = self.thresholds.thresholds()
+        mid, high = int(floor(mid)), int(floor(high))
+        if (mid, high) == (self.mid_threshold, self.high_threshold):
+            return
+        self.mid_threshold, self.high_threshold = mid, high
+        if self.window is not None:
+            self.window.set_thresholds(mid, high)
+
     def notify_event(self, event):
 
         if self.last_selected is not None:
             if event == 'good':
-                self.last_selected[1][0] = min(max(0.0, self.last_selected[1][0] + 1.0), 40.0)
+                weight = min(max(0.0, self.last_selected[1][0] + 1.0), 40.0)
             else:
-                self.last_selected[1][0] = min(max(0.0, self.last_selected[1][0] - 1.0), 40.0)
-
-    def configure_tracks(self, music_manager):
-        self.medium_tracks = [(i, [1.0]) for i in music_manager.base_snippets]
-        self.low_tracks = [(i, [1.0]) for i in music_manager.slow_snippets]
-        self.high_tracks = [(i, [1.0]) for i in music_manager.fast_snippets]
+                weight = min(max(0.0, self.last_selected[1][0] - 1.0), 40.0)
+            self.set_selected_weight(weight)
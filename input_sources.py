@@ -0,0 +1,223 @@
+from abc import ABC, abstractmethod
+import os
+import select
+import struct
+import time
+from threading import Event, Thread
+
+from keystroke_trace import load_keystroke_trace
+
+
+class BaseInputSource(ABC):
+    """
+    A source of key presses for the KeyboardBeatDetector.
+
+    Sources call on_press(key, timestamp) and on_release(key, timestamp),
+    with timestamps taken from their own clock. The detector windows the
+    keystrokes on that clock, so a replayed session keeps its original
+    timing whatever speed it is replayed at.
+    """
+
+    # how many seconds of the source's clock pass per real second
+    speed = 1.0
+
+    def clock(self):
+        """
+        Returns the current time on the source's clock
+        """
+        return time.monotonic()
+
+    def sanitize_keys(self, keys):
+        """
+        Converts key names (e.g. 'ctrl' or 'e') into the key objects this
+        source passes to its callbacks
+        """
+        return list(keys)
+
+    @abstractmethod
+    def start(self, on_press, on_release):
+        """
+        Starts delivering key presses to the callbacks, without blocking
+        """
+        pass
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+
+def _load_pynput():
+    try:
+        from pynput import keyboard
+    except ImportError:
+        # pynput needs a display server
+        raise ValueError('pynput could not be loaded - the pynput input source requires a display server.')
+    return keyboard
+
+
+class PynputInputSource(BaseInputSource):
+    """
+    Key presses from pynput's global keyboard listener
+    """
+
+    def __init__(self):
+        self.keyboard = _load_pynput()
+        self.listener = None
+
+    def sanitize_keys(self, keys):
+        keycodes = []
+        for key in keys:
+            if isinstance(key, str):
+                if len(key) > 1:
+                    key = getattr(self.keyboard.Key, key)
+                else:
+                    key = self.keyboard.KeyCode.from_char(key)
+            keycodes.append(key)
+        return keycodes
+
+    def start(self, on_press, on_release):
+        clock = self.clock
+        self.listener = self.keyboard.Listener(
+            on_press=lambda key: on_press(key, clock()),
+            on_release=lambda key: on_release(key, clock()),
+        )
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+
+
+# struct input_event from linux/input.h - a struct timeval followed by the
+# event type, code and value
+INPUT_EVENT = struct.Struct('llHHi')
+EV_KEY = 0x01
+KEY_RELEASE, KEY_PRESS, KEY_REPEAT = range(3)
+
+# linux/input-event-codes.h codes of the keys usable in keybindings
+EVDEV_KEY_CODES = {
+    'esc': 1, 'backspace': 14, 'tab': 15, 'enter': 28, 'ctrl': 29, 'ctrl_l': 29, 'shift': 42,
+    'shift_l': 42, 'shift_r': 54, 'alt': 56, 'alt_l': 56, 'space': 57, 'ctrl_r': 97, 'alt_r': 100,
+}
+for _index, _char in enumerate('1234567890'):
+    EVDEV_KEY_CODES[_char] = 2 + _index
+for _row, _offset in (('qwertyuiop', 16), ('asdfghjkl', 30), ('zxcvbnm', 44)):
+    for _index, _char in enumerate(_row):
+        EVDEV_KEY_CODES[_char] = _offset + _index
+
+
+class EvdevInputSource(BaseInputSource):
+    """
+    Key presses read straight from a Linux input device (e.g.
+    /dev/input/event3), which needs no display server - only read access to
+    the device. Keys are identified by their evdev key codes.
+
+    Event timestamps come from the kernel, on the wall clock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stopped = Event()
+        self.runner = None
+
+    def clock(self):
+        return time.time()
+
+    def sanitize_keys(self, keys):
+        keycodes = []
+        for key in keys:
+            if isinstance(key, str):
+                if key not in EVDEV_KEY_CODES:
+                    raise ValueError('Unknown key {} for the evdev input source.'.format(key))
+                key = EVDEV_KEY_CODES[key]
+            keycodes.append(key)
+        return keycodes
+
+    def start(self, on_press, on_release):
+        device = os.open(self.path, os.O_RDONLY)
+        self.runner = Thread(target=self._run, args=(device, on_press, on_release))
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _run(self, device, on_press, on_release):
+        buffered = b''
+        try:
+            while not self.stopped.is_set():
+                # wake up regularly to check whether we have been stopped
+                readable, _, _ = select.select([device], [], [], 0.5)
+                if not readable:
+                    continue
+                buffered += os.read(device, INPUT_EVENT.size * 64)
+                usable = len(buffered) - len(buffered) % INPUT_EVENT.size
+                for seconds, microseconds, event_type, code, value in INPUT_EVENT.iter_unpack(buffered[:usable]):
+                    if event_type != EV_KEY:
+                        continue
+                    timestamp = seconds + microseconds / 1e6
+                    if value == KEY_PRESS:
+                        on_press(code, timestamp)
+                    elif value == KEY_RELEASE:
+                        on_release(code, timestamp)
+                buffered = buffered[usable:]
+        finally:
+            os.close(device)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class ReplayInputSource(BaseInputSource):
+    """
+    Replays a keystroke trace (see keystroke_trace.py) as key presses, speed
+    times faster than it was recorded. As traces never contain which keys
+    were pressed, keybindings are never triggered.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.timestamps = load_keystroke_trace(path)
+        self.speed = speed
+        self.origin = float(self.timestamps[0]) if len(self.timestamps) else 0.0
+        self.started = None
+        self.stopped = Event()
+        self.finished = Event()
+        self.runner = None
+
+    def clock(self):
+        if self.started is None:
+            return self.origin
+        return self.origin + (time.monotonic() - self.started) * self.speed
+
+    def start(self, on_press, on_release):
+        self.started = time.monotonic()
+        self.runner = Thread(target=self._run, args=(on_press,))
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _run(self, on_press):
+        for timestamp in self.timestamps:
+            delay = (timestamp - self.clock()) / self.speed
+            if delay > 0 and self.stopped.wait(delay):
+                return
+            on_press(None, float(timestamp))
+        self.finished.set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+INPUT_SOURCES = ('pynput', 'evdev', 'replay')
+
+
+def create_input_source(name, path=None, speed=1.0):
+    """
+    :param name: one of INPUT_SOURCES
+    :param path: the input device for evdev, or the trace file for replay
+    """
+    if name == 'pynput':
+        return PynputInputSource()
+    if path is None:
+        raise ValueError('The {} input source needs a path.'.format(name))
+    if name == 'evdev':
+        return EvdevInputSource(path)
+    if name == 'replay':
+        return ReplayInputSource(path, speed=speed)
+    raise ValueError('Unknown input source {}, should be one of: {}'.format(name, ', '.join(INPUT_SOURCES)))
@@ -4,10 +4,19 @@ import scipy.fftpack
 from scipy import interpolate
 
 import time
-from threading import Thread, Event, RLock
+from collections import deque
+from threading import Thread, Event
 import queue
 
-from pynput.keyboard import Key, Listener, KeyCode
+from beat_bus import BeatBus
+from input_sources import PynputInputSource
+from keystroke_ring import KeystrokeRing
+from typing_window import TypingWindow
+
+# number of entries plotted when no window width is given
+DEFAULT_WINDOW_WIDTH = 100
+DEFAULT_MAX_FPS = 10
+DEFAULT_SMOOTHING = 0.3
 
 
 class BeatVisualizer:
@@ -15,31 +24,165 @@ class BeatVisualizer:
     Plots beats from a queue
     """
 
-    def __init__(self, beat_queue, update_interval=None, window_width=None):
+    def __init__(self, beat_queue, update_interval=None, window_width=None, out_queue=None, window=None,
+                 blit=False, max_fps=DEFAULT_MAX_FPS, smoothing=DEFAULT_SMOOTHING):
+        """
+        :param out_queue: if given, every item read from beat_queue is passed on to it
+        :param window: a typing_window.TypingWindow maintained by someone else
+                       (e.g. the player) to plot from - if not given, the
+                       visualizer keeps its own of window_width entries
+        :param blit: whether to render with blitting - only the lines are redrawn
+                     over a cached background, at most max_fps times a second,
+                     and frames are skipped when rendering falls behind
+        :param max_fps: maximum frame rate when blitting
+        :param smoothing: weight of the newest entry in the smoothed line when blitting
+        """
         self.beat_queue = beat_queue
-        self.out_queue = queue.Queue()
+        self.out_queue = out_queue
         self.update_interval = update_interval
         self.window_width = window_width
+        self.blit = blit
+        self.max_fps = max_fps
+        self.smoothing = smoothing
 
-        self.internal_counts = []
-        self.internal_times = []
+        self.owns_window = window is None
+        if window is None:
+            window = TypingWindow(window_width or DEFAULT_WINDOW_WIDTH)
+        self.window = window
 
     def run(self):
+        if self.blit:
+            self._run_blit()
+        else:
+            self._run_draw()
+
+    def _run_blit(self):
+        figure = plt.figure(figsize=(10, 10))
+        ax = figure.add_subplot(1, 1, 1)
+        plt.ion()
+
+        # the x axis is seconds before the newest entry, so the axes never
+        # move and the cached background stays valid
+        ax.set_xlabel('seconds ago')
+        y_max = self.window.high_threshold * 1.5
+
+        line, = ax.plot([], [], animated=True)
+        mean_low, = ax.plot([], [], label='low thresh', animated=True)
+        mean_high, = ax.plot([], [], label='high thresh', animated=True)
+        mean_line, = ax.plot([], [], label='mean thresh', animated=True)
+        smooth_line, = ax.plot([], [], label='smooth line', animated=True)
+        artists = [line, mean_low, mean_high, mean_line, smooth_line]
+        ax.legend()
+
+        # exponentially smoothed counts, kept alongside the window
+        smoothed = deque(maxlen=self.window.capacity)
+        background = None
+
+        def on_draw(event):
+            nonlocal background
+            background = figure.canvas.copy_from_bbox(ax.bbox)
+
+        figure.canvas.mpl_connect('draw_event', on_draw)
+
+        span = None
+
+        def set_limits(times):
+            nonlocal span
+            span = self.window.capacity * self._window_spacing(times)
+            ax.set_xlim(-span, 0)
+            ax.set_ylim(0, y_max)
+            # redraws the static parts, refreshing the background
+            figure.canvas.draw()
+
+        figure.show()
+        set_limits(self.window.snapshot().times)
+
+        frame_time = 1.0 / self.max_fps
+        next_frame = time.monotonic()
+        drawn_seq = None
+
+        while True:
+            # wait for data, but not past the next frame
+            timeout = max(next_frame - time.monotonic(), 0) if drawn_seq != self.window.seq else frame_time
+            items = []
+            try:
+                items.append(self.beat_queue.get(timeout=timeout))
+                # drain whatever else is waiting so that we never render
+                # intermediate states when behind
+                while True:
+                    items.append(self.beat_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for next_item in items:
+                if self.out_queue is not None:
+                    self.out_queue.put(next_item)
+                if isinstance(next_item, tuple):
+                    (count, start) = next_item
+                    if self.owns_window:
+                        self.window.push(count, start)
+                    previous = smoothed[-1] if smoothed else count
+                    smoothed.append(previous + self.smoothing * (count - previous))
+                self.beat_queue.task_done()
+
+            now = time.monotonic()
+            if now < next_frame or drawn_seq == self.window.seq or len(self.window) == 0:
+                figure.canvas.flush_events()
+                continue
+
+            # the player pushes to the window from its own thread
+            snapshot = self.window.snapshot()
+            times = snapshot.times
+            counts = snapshot.counts
+            if len(counts) == 0:
+                figure.canvas.flush_events()
+                continue
+            offsets = times - times[-1]
+
+            # the axes only change while the spacing of the windows is first
+            # being learnt, or when the counts or thresholds outgrow the plot
+            if counts.max() > y_max or snapshot.high_threshold > y_max or \
+                    abs(self.window.capacity * self._window_spacing(times) - span) > 0.01 * span:
+                y_max = max(y_max, counts.max() * 1.2, snapshot.high_threshold * 1.5)
+                set_limits(times)
+
+            line.set_data(offsets, counts)
+            mean_low.set_data(offsets, np.full(len(offsets), snapshot.mid_threshold))
+            mean_high.set_data(offsets, np.full(len(offsets), snapshot.high_threshold))
+            mean_line.set_data(offsets, snapshot.means)
+            smooth_values = np.array(smoothed)[-len(offsets):]
+            smooth_line.set_data(offsets[-len(smooth_values):], smooth_values)
+
+            if background is not None:
+                figure.canvas.restore_region(background)
+            for artist in artists:
+                ax.draw_artist(artist)
+            figure.canvas.blit(ax.bbox)
+            figure.canvas.flush_events()
+            drawn_seq = snapshot.seq
+
+            # if rendering fell behind, skip the missed frames rather than
+            # trying to catch up
+            next_frame = max(next_frame + frame_time, time.monotonic())
+
+    def _window_spacing(self, times):
+        if len(times) > 1:
+            return (times[-1] - times[0]) / (len(times) - 1)
+        return 1.0
+
+    def _run_draw(self):
         figure = plt.figure(figsize=(10, 10))
         ax = figure.add_subplot(1, 1, 1)
         plt.ion()
 
-        line, = ax.plot(self.internal_times, self.internal_counts)
+        snapshot = self.window.snapshot()
+        line, = ax.plot(snapshot.times, snapshot.counts)
 
         mean_low, = ax.plot([], [], label='low thresh')
         mean_high, = ax.plot([], [], label='high thresh')
         mean_line, = ax.plot([], [], label='mean thresh')
         smooth_line, = ax.plot([], [], label='smooth line')
 
-        low_values = []
-        high_values = []
-        mean_values = []
-
         ax.legend()
 
         figure.show()
@@ -50,49 +193,34 @@ class BeatVisualizer:
 
             # retrieve the next entry
             next_item = self.beat_queue.get()
-            self.out_queue.put(next_item)
+            if self.out_queue is not None:
+                self.out_queue.put(next_item)
 
             if isinstance(next_item, tuple):
-                (count, time) = next_item
-
-                self.internal_times.append(time)
-                self.internal_counts.append(count)
-
-                internal_times = np.array(self.internal_times)
-                internal_counts = np.array(self.internal_counts)
+                (count, start) = next_item
 
+                if self.owns_window:
+                    self.window.push(count, start)
 
-
-                if self.window_width and len(self.internal_times) > self.window_width:
-                    del self.internal_times[0]
-                    del self.internal_counts[0]
-                    del low_values[0]
-                    del high_values[0]
-                    del mean_values[0]
+                snapshot = self.window.snapshot()
+                internal_times = snapshot.times
+                internal_counts = snapshot.counts
 
                 # update the line
-                line.set_xdata(self.internal_times)
-                line.set_ydata(self.internal_counts)
-
-                # add mean values
-                count_mean = np.array(self.internal_counts).mean()
-
-                # low_values.append(count_mean * 0.96)
-                # high_values.append(count_mean * 1.54) # 1.96
-                low_values.append(40)
-                high_values.append(50) # 1.96
-                mean_values.append(count_mean)
+                line.set_xdata(internal_times)
+                line.set_ydata(internal_counts)
 
-                mean_low.set_xdata(self.internal_times)
-                mean_low.set_ydata(low_values)
+                mean_low.set_xdata(internal_times)
+                mean_low.set_ydata(np.full(len(internal_times), snapshot.mid_threshold))
 
-                mean_high.set_xdata(self.internal_times)
-                mean_high.set_ydata(high_values)
+                mean_high.set_xdata(internal_times)
+                mean_high.set_ydata(np.full(len(internal_times), snapshot.high_threshold))
 
-                mean_line.set_xdata(self.internal_times)
-                mean_line.set_ydata(mean_values)
+                # the mean of the window as each entry was added
+                mean_line.set_xdata(internal_times)
+                mean_line.set_ydata(snapshot.means)
 
-                if len(self.internal_counts) > 3:
+                if len(internal_counts) > 3:
                     flin = interpolate.interp1d(internal_times, internal_counts, kind='cubic')
                     time_resample = np.linspace(internal_times.min(), internal_times.max(), 100)
                     counts_resample = flin(time_resample)
@@ -111,24 +239,24 @@ class BeatVisualizer:
                 self.beat_queue.task_done()
 
 
-def sanitize_keys(keys):
-    keycodes = []
-    for key in keys:
-        if isinstance(key, str):
-            if len(key) > 1:
-                locals = {'key': None}
-                exec('key = Key.{}'.format(key), None, locals)
-                key = locals['key']
-            else:
-                key = KeyCode.from_char(key)
-        print(type(key), key)
-        keycodes.append(key)
-    return keycodes
-
-
 class KeyboardBeatDetector:
 
-    def __init__(self, window_size=None, exit_keys=None, keys_events=None, event_queue=None):
+    def __init__(self, window_size=None, exit_keys=None, keys_events=None, event_queue=None, beat_queue=None,
+                 bus=None, source=None):
+        """
+        Every window and event is published on a beat_bus.BeatBus, which
+        other components can subscribe to.
+
+        :param event_queue: if given, events go to this queue instead of the bus
+        :param beat_queue: a queue (e.g. the player's AsyncQueueBridge) the bus
+                           delivers into - by default, an unbounded subscription
+        :param bus: the BeatBus to publish on, a new one by default
+        :param source: the input_sources.BaseInputSource to read key presses
+                       from, pynput's keyboard listener by default
+        """
+        if source is None:
+            source = PynputInputSource()
+        self.source = source
 
         self.runner = Thread(
             target=self._run,
@@ -144,53 +272,80 @@ class KeyboardBeatDetector:
         # hook up all key-events
         self.event_map = []
         for (evnt, keys) in keys_events:
-            keycodes = sanitize_keys(keys)
+            keycodes = self.source.sanitize_keys(keys)
             self.event_map.append(
                 (evnt, {k: False for k in keycodes})
             )
 
         # hook up exit keys
-        keycodes = sanitize_keys(exit_keys)
+        keycodes = self.source.sanitize_keys(exit_keys)
         self.exit_keys = {k: False for k in keycodes}
 
+        # every key taking part in a keybinding, checked on each press
+        self.hotkeys = set(self.exit_keys)
+        for (_, keymap) in self.event_map:
+            self.hotkeys.update(keymap)
+
         self.window_size = window_size or 2.0
         self.exit_req = Event()
 
-        self.beat_queue = queue.Queue()
+        if bus is None:
+            bus = BeatBus()
+        self.bus = bus
+        if beat_queue is None:
+            beat_queue = bus.subscribe('beats')
+        else:
+            bus.attach(beat_queue)
+        self.beat_queue = beat_queue
         if event_queue is None:
-            event_queue = self.beat_queue
+            event_queue = self.bus
 
         self.event_queue = event_queue
 
+        # every keystroke's time, aggregated into windows by the runner
+        self.keystrokes = KeystrokeRing()
+        self.read_position = 0
+
         # local execution variables
         self.window_count = 0
-        self.window_start = time.time()
-        self.data_lock = RLock()
+        self.window_start = self.source.clock()
 
         self.runner.start()
 
     def _run(self):
-        with Listener(
-                on_press=self._on_press,
-                on_release=self._on_release
-        ) as listener:
+        self.source.start(self._on_press, self._on_release)
+        try:
             # wait until exit requested
             while not self.exit_req.is_set():
-                self.exit_req.wait(self.window_size)
-
-                # if wait time exceeds without getting
-                # a beat, manually send zero beats
-                with self.data_lock:
-
-                    current_time = time.time()
-                    delta_time = current_time - self.window_start
-                    while delta_time > self.window_size:
-                        self.beat_queue.put((self.window_count, self.window_start))
-                        self.window_count = 0
-                        self.window_start += self.window_size
-                        delta_time = current_time - self.window_start
-
-    def _on_press(self, key):
+                remaining = self.window_start + self.window_size - self.source.clock()
+                self.exit_req.wait(max(remaining / self.source.speed, 0))
+                self._publish_windows(self.source.clock())
+        finally:
+            self.source.stop()
+
+    def _publish_windows(self, now):
+        """
+        Counts the keystrokes received since the last call into windows,
+        publishing every window which has closed by now - including empty ones
+        """
+        timestamps, self.read_position = self.keystrokes.read(self.read_position)
+        while self.window_start + self.window_size <= now:
+            window_end = self.window_start + self.window_size
+            closed = int(np.searchsorted(timestamps, window_end))
+            self.bus.publish((self.window_count + closed, self.window_start))
+            timestamps = timestamps[closed:]
+            self.window_count = 0
+            self.window_start = window_end
+        self.window_count += len(timestamps)
+
+    def _on_press(self, key, timestamp):
+        # runs on the input hook - only record the time, unless the key is
+        # part of a keybinding
+        self.keystrokes.append(timestamp)
+        if key in self.hotkeys:
+            self._on_hotkey(key)
+
+    def _on_hotkey(self, key):
         if key in self.exit_keys:
             self.exit_keys[key] = True
 
@@ -202,28 +357,12 @@ class KeyboardBeatDetector:
         for (event, keymap) in self.event_map:
             if key in keymap:
                 keymap[key] = True
-            if all(keymap.values()):
-                self.event_queue.put(event)
-
-        # record the beat
-        current_time = time.time()
-        with self.data_lock:
-            delta_time = current_time - self.window_start
-
-            if delta_time < self.window_size:
-                self.window_count += 1
-            else:
-                # send out the beat_values
-                while delta_time > self.window_size:
-                    self.beat_queue.put((self.window_count, self.window_start))
-                    self.window_count = 0
-                    self.window_start += self.window_size
-                    delta_time = current_time - self.window_start
+                if all(keymap.values()):
+                    self.event_queue.put(event)
 
-                self.window_count = 1
-                self.window_start = current_time
-
-    def _on_release(self, key):
+    def _on_release(self, key, timestamp):
+        if key not in self.hotkeys:
+            return
 
         if key in self.exit_keys:
             self.exit_keys[key] = False
@@ -233,9 +372,8 @@ class KeyboardBeatDetector:
                 keymap[key] = False
 
 
-
 if __name__ == '__main__':
     a = KeyboardBeatDetector(window_size=5.0)
-    bv = BeatVisualizer(a.beat_queue, window_width=10)
+    bv = BeatVisualizer(a.bus.subscribe('visualizer', maxsize=64), window_width=10)
     bv.run()
     a.runner.join()
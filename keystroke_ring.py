@@ -0,0 +1,88 @@
+from math import log
+
+import numpy as np
+
+# number of keystroke timestamps held - hours of fast typing
+DEFAULT_CAPACITY = 1 << 16
+
+
+class KeystrokeRing:
+    """
+    Preallocated ring buffer of keystroke timestamps, written by a single
+    producer (the input hook) and aggregated by consumers on demand.
+
+    Appending only stores the timestamp and bumps a counter, so the input
+    hook does no other work per keystroke. Consumers read the entries
+    written since a position of their own, or compute counts and rates over
+    any span of the buffer - once more than capacity keystrokes have been
+    written, the oldest are overwritten.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._times = np.zeros(capacity)
+        # total number of timestamps ever appended
+        self.written = 0
+
+    def append(self, timestamp):
+        self._times[self.written % self.capacity] = timestamp
+        self.written += 1
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def _ordered(self, position, end):
+        return self._times[np.arange(position, end) % self.capacity]
+
+    def read(self, position):
+        """
+        Returns the timestamps appended since position, oldest first, and the
+        position to read from next time. Entries which have already been
+        overwritten are skipped.
+        """
+        end = self.written
+        position = max(position, end - self.capacity)
+        return self._ordered(position, end), end
+
+    def timestamps(self):
+        """
+        Returns a copy of every timestamp held, oldest first
+        """
+        end = self.written
+        return self._ordered(max(end - self.capacity, 0), end)
+
+    def count(self, start, end):
+        """
+        Returns the number of keystrokes with start <= timestamp < end
+        """
+        times = self.timestamps()
+        return int(np.searchsorted(times, end) - np.searchsorted(times, start))
+
+    def rate(self, window, now):
+        """
+        Returns the keystrokes per second over the window seconds up to now
+        """
+        return self.count(now - window, now) / window
+
+    def sliding_counts(self, window, step, now, n):
+        """
+        Returns the keystroke counts of n windows of the given length, ending
+        step seconds apart with the last ending at now, oldest first.
+        """
+        times = self.timestamps()
+        ends = now - step * np.arange(n - 1, -1, -1)
+        return np.searchsorted(times, ends) - np.searchsorted(times, ends - window)
+
+    def ewma_rate(self, half_life, now):
+        """
+        Returns the exponentially weighted keystrokes per second at now,
+        where a keystroke's weight halves every half_life seconds.
+        """
+        decay = log(2) / half_life
+        times = self.timestamps()
+        times = times[times <= now]
+        # ignore keystrokes whose weight has become negligible
+        times = times[times > now - 50 * half_life]
+        if len(times) == 0:
+            return 0.0
+        return float(decay * np.exp(-decay * (now - times)).sum())
@@ -0,0 +1,123 @@
+import struct
+from threading import Event, Thread
+
+import numpy as np
+
+# A keystroke trace only holds the time of each key press - never which key
+# was pressed. The file is TRACE_MAGIC, the time of the first keystroke as a
+# little-endian float64, then the gap before each keystroke in microseconds
+# as an unsigned LEB128 varint, so that a key press costs one or two bytes.
+TRACE_MAGIC = b'GOPKEYS1'
+_ORIGIN = struct.Struct('<d')
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_deltas(timestamps, previous):
+    """
+    Delta encodes the given timestamps, which follow the timestamp previous.
+
+    :return: the encoded bytes, and the timestamp the next chunk follows
+    """
+    out = bytearray()
+    # work in whole microseconds so that rounding errors never accumulate
+    previous_us = int(round(previous * 1e6))
+    for timestamp in timestamps:
+        timestamp_us = int(round(timestamp * 1e6))
+        _encode_varint(max(timestamp_us - previous_us, 0), out)
+        previous_us = max(timestamp_us, previous_us)
+    return bytes(out), previous_us / 1e6
+
+
+def decode_deltas(data, origin):
+    """
+    Returns the timestamps encoded by encode_deltas as a numpy array
+    """
+    deltas = []
+    value, shift = 0, 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            deltas.append(value)
+            value, shift = 0, 0
+    origin_us = int(round(origin * 1e6))
+    return (origin_us + np.cumsum(np.array(deltas, dtype=np.int64))) / 1e6
+
+
+def save_keystroke_trace(path, timestamps):
+    timestamps = np.asarray(timestamps, dtype=float)
+    origin = float(timestamps[0]) if len(timestamps) else 0.0
+    data, _ = encode_deltas(timestamps, origin)
+    with open(path, 'wb') as raw_file:
+        raw_file.write(TRACE_MAGIC)
+        raw_file.write(_ORIGIN.pack(origin))
+        raw_file.write(data)
+
+
+def load_keystroke_trace(path):
+    """
+    Reads a keystroke trace written by save_keystroke_trace or
+    KeystrokeRecorder.
+
+    :return: numpy array of keystroke timestamps
+    """
+    with open(path, 'rb') as raw_file:
+        magic = raw_file.read(len(TRACE_MAGIC))
+        if not magic:
+            # a recorder which never saw a keystroke
+            return np.zeros(0)
+        if magic != TRACE_MAGIC:
+            raise ValueError('{} is not a keystroke trace.'.format(path))
+        header = raw_file.read(_ORIGIN.size)
+        if len(header) < _ORIGIN.size:
+            return np.zeros(0)
+        (origin,) = _ORIGIN.unpack(header)
+        return decode_deltas(raw_file.read(), origin)
+
+
+class KeystrokeRecorder:
+    """
+    Appends the keystrokes captured in a keystroke_ring.KeystrokeRing to a
+    keystroke trace every interval seconds, from a daemon thread.
+    """
+
+    def __init__(self, keystrokes, path, interval=5.0):
+        self.keystrokes = keystrokes
+        self.path = path
+        self.interval = interval
+        self.position = keystrokes.written
+        self.previous = None
+        self.closed = Event()
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _flush(self, raw_file):
+        timestamps, self.position = self.keystrokes.read(self.position)
+        if len(timestamps) == 0:
+            return
+        if self.previous is None:
+            self.previous = float(timestamps[0])
+            raw_file.write(TRACE_MAGIC)
+            raw_file.write(_ORIGIN.pack(self.previous))
+        data, self.previous = encode_deltas(timestamps, self.previous)
+        raw_file.write(data)
+        raw_file.flush()
+
+    def _run(self):
+        with open(self.path, 'wb') as raw_file:
+            while not self.closed.wait(self.interval):
+                self._flush(raw_file)
+            self._flush(raw_file)
+
+    def close(self):
+        self.closed.set()
+        self.runner.join()
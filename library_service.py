@@ -0,0 +1,307 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+from music_manager import SAVE_DIR, analyse_song, open_saved_mm
+
+# files in the watched directories with these extensions are added
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.mp3', '.aiff', '.aif')
+# seconds between scans of the watched directories
+DEFAULT_POLL_INTERVAL = 5.0
+# added to the niceness of the workers, so ingestion only gets the CPU (and,
+# with the CFQ and BFQ schedulers, the disk) when the player does not need it
+DEFAULT_NICENESS = 10
+# seconds after a change before the profile is saved, so that a burst of new
+# songs is saved once
+SAVE_DELAY = 10.0
+# times a song is analysed before it is given up on, if a worker dies
+# analysing it - any other songs being analysed in the pool die with it
+MAX_ATTEMPTS = 2
+
+MOOD_SNIPPETS = [
+    ('low', 'slow_snippets'),
+    ('mid', 'base_snippets'),
+    ('high', 'fast_snippets'),
+]
+
+
+class LibraryUpdate:
+    """
+    Songs added to and removed from the library, as put on the player's beat
+    queue for it to apply between windows
+    """
+
+    def __init__(self, songs=None, added=None, removed=None):
+        """
+        :param songs: dict of each added song -> its song info
+        :param added: list of (mood, snippet) of the added songs
+        :param removed: list of the removed songs
+        """
+        self.songs = songs or {}
+        self.added = added or []
+        self.removed = removed or []
+
+    def __repr__(self):
+        return 'LibraryUpdate(+{} songs, +{} snippets, -{} songs)'.format(
+            len(self.songs), len(self.added), len(self.removed)
+        )
+
+
+def apply_update(music_manager, update):
+    """
+    Applies a LibraryUpdate to a music_manager.MusicManager without
+    reanalysing anything
+    """
+    for song in update.removed:
+        if song in music_manager.songs:
+            music_manager.remove_song(song)
+
+    for song, info in update.songs.items():
+        if song not in music_manager.songs:
+            music_manager.songs.append(song)
+        music_manager.song_info[song] = info
+
+    lists = {mood: getattr(music_manager, name) for mood, name in MOOD_SNIPPETS}
+    for mood, snippet in update.added:
+        lists[mood].append(snippet)
+
+
+def _lower_priority(niceness):
+    # runs in each worker as it starts
+    try:
+        os.nice(niceness)
+    except (AttributeError, OSError):
+        pass
+    if hasattr(os, 'sched_setscheduler') and hasattr(os, 'SCHED_IDLE'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+        except OSError:
+            pass
+
+
+class LibraryService:
+    """
+    Keeps a profile's library up to date while the player runs. Songs are
+    analysed in a pool of low priority worker processes, segmented in the
+    service's own thread, saved to the profile, and handed to the player as
+    LibraryUpdates on its beat queue - so the player only ever touches its
+    own library and beat changer from its own thread.
+
+    Songs are added and removed with add and remove, or by their files
+    appearing in and disappearing from the watched directories. A new file
+    is only added once its size and modification time have stopped
+    changing between two scans, so files being copied in are not read half
+    written.
+    """
+
+    def __init__(self, profile, player_queue, watch=(), workers=1, niceness=DEFAULT_NICENESS,
+                 poll_interval=DEFAULT_POLL_INTERVAL, save_delay=SAVE_DELAY):
+        """
+        :param profile: the profile to keep up to date
+        :param player_queue: the queue the LibraryUpdates are put on - the
+                             player's beat_queue
+        :param watch: directories to add the songs of, and of new songs in
+        :param workers: number of processes songs are analysed in
+        :param niceness: added to the niceness of the worker processes
+        """
+        self.profile = profile
+        self.path = SAVE_DIR / (profile + '.json')
+        self.player_queue = player_queue
+        self.watch = [Path(directory).expanduser().resolve() for directory in watch]
+        self.poll_interval = poll_interval
+        self.save_delay = save_delay
+
+        # the service's own copy of the library, which is saved - the player's
+        # is brought up to date by the updates
+        self.music_manager = open_saved_mm(profile)
+
+        self.workers = workers
+        self.niceness = niceness
+        self.pool = self._create_pool()
+        self.lock = Lock()
+        # song -> future of its analysis
+        self.pending = {}
+        # song -> number of times its analysis was lost with a worker
+        self.attempts = {}
+        # songs which could not be analysed, and the (size, mtime) they had
+        self.failed = {}
+        # song -> (size, mtime) when last scanned, for files not yet added
+        self.seen = {}
+        self.dirty_since = None
+
+        self.stopped = Event()
+        self.wake = Event()
+        self.runner = Thread(target=self.run, name='library', daemon=True)
+        self.runner.start()
+
+    def _create_pool(self):
+        # spawned rather than forked, as the player has threads of its own
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_lower_priority, initargs=(self.niceness,)
+        )
+
+    def add(self, songs):
+        with self.lock:
+            for song in songs:
+                self._submit(str(Path(song).resolve()))
+        self.wake.set()
+
+    def remove(self, songs):
+        with self.lock:
+            self._remove([str(Path(song).resolve()) for song in songs])
+
+    def _submit(self, song):
+        if song in self.music_manager.songs or song in self.pending:
+            return
+        try:
+            future = self.pool.submit(
+                analyse_song, song, self.music_manager.block_size, self.music_manager.beat_interval_size
+            )
+        except BrokenProcessPool:
+            self.pool = self._create_pool()
+            future = self.pool.submit(
+                analyse_song, song, self.music_manager.block_size, self.music_manager.beat_interval_size
+            )
+        self.pending[song] = future
+
+    def _remove(self, songs):
+        removed = []
+        for song in songs:
+            future = self.pending.pop(song, None)
+            if future is not None:
+                future.cancel()
+            if song in self.music_manager.songs:
+                self.music_manager.remove_song(song)
+                removed.append(song)
+        if removed:
+            print('INFO: Removed {} song(s) from the library'.format(len(removed)))
+            self.player_queue.put(LibraryUpdate(removed=removed))
+            self._changed()
+
+    def _changed(self):
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    def run(self):
+        next_scan = 0.0
+        while not self.stopped.is_set():
+            if self.watch and time.monotonic() >= next_scan:
+                self.scan()
+                next_scan = time.monotonic() + self.poll_interval
+
+            with self.lock:
+                self.collect()
+                if self.dirty_since is not None and time.monotonic() - self.dirty_since >= self.save_delay:
+                    self.save()
+
+            self.wake.wait(0.5 if self.pending else self.poll_interval)
+            self.wake.clear()
+
+    def scan(self):
+        """
+        Submits the new, unchanging files in the watched directories, and
+        removes the songs of the files which have gone
+        """
+        found = {}
+        # a directory which has gone, e.g. an unmounted drive, keeps its songs
+        scanned = [directory for directory in self.watch if directory.is_dir()]
+        for directory in scanned:
+            for path in directory.rglob('*'):
+                if path.suffix.lower() not in AUDIO_EXTENSIONS:
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                found[str(path)] = (stat.st_size, stat.st_mtime)
+
+        with self.lock:
+            for song, signature in found.items():
+                if song in self.music_manager.songs or song in self.pending:
+                    continue
+                if self.failed.get(song) == signature:
+                    continue
+                if self.seen.get(song) == signature:
+                    self.seen.pop(song)
+                    self._submit(song)
+                else:
+                    self.seen[song] = signature
+            self.seen = {song: signature for song, signature in self.seen.items() if song in found}
+
+            gone = [
+                song for song in self.music_manager.songs
+                if song not in found and any(directory in Path(song).parents for directory in scanned)
+            ]
+            self._remove(gone)
+
+    def collect(self):
+        """
+        Segments the songs whose analysis has finished and sends them to the
+        player - called with the lock held
+        """
+        for song in [song for song, future in self.pending.items() if future.done()]:
+            future = self.pending.pop(song)
+            if future.cancelled():
+                continue
+            try:
+                analysis = future.result()
+            except BrokenProcessPool:
+                self.attempts[song] = self.attempts.get(song, 0) + 1
+                if self.attempts[song] < MAX_ATTEMPTS:
+                    self._submit(song)
+                    continue
+                print('INFO: Could not add {} to the library: its analysis crashed'.format(song))
+                self._failed(song)
+                continue
+            except Exception as e:
+                print('INFO: Could not add {} to the library: {}'.format(song, e))
+                self._failed(song)
+                continue
+            self.attempts.pop(song, None)
+
+            counts = {mood: len(getattr(self.music_manager, name)) for mood, name in MOOD_SNIPPETS}
+            self.music_manager.add_song(song, analysis=analysis)
+            added = [
+                (mood, snippet)
+                for mood, name in MOOD_SNIPPETS
+                for snippet in getattr(self.music_manager, name)[counts[mood]:]
+            ]
+
+            print('INFO: Added {} to the library ({} snippets)'.format(song, len(added)))
+            self.player_queue.put(LibraryUpdate(
+                songs={song: self.music_manager.song_info[song]}, added=added
+            ))
+            self._changed()
+
+    def _failed(self, song):
+        # tried again only if the file changes
+        self.attempts.pop(song, None)
+        try:
+            stat = os.stat(song)
+        except OSError:
+            return
+        self.failed[song] = (stat.st_size, stat.st_mtime)
+
+    def save(self):
+        # written to a temporary file first, so the profile is never left half written
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        self.music_manager.save_to_disk(temp_path)
+        os.replace(temp_path, str(self.path))
+        self.dirty_since = None
+
+    def close(self):
+        self.stopped.set()
+        self.wake.set()
+        self.runner.join()
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+            if self.dirty_since is not None:
+                self.save()
+        self.pool.shutdown(wait=False)
@@ -1,8 +1,30 @@
 #!/usr/bin/python3
+import atexit
 from argparse import ArgumentParser
+from adaptive_thresholds import AdaptiveThresholds
+from feedback_store import FeedbackStore
 from fixed_beat_changer import FixedBeatChanger
+from nearest_beat_changer import NearestBeatChanger
+from predictive_beat_changer import PredictiveBeatChanger
+from ratio_beat_changer import RatioBeatChanger
+from input_sources import create_input_source
+from keyboard_handler import KeyboardBeatDetector
+from keystroke_trace import KeystrokeRecorder
+from library_service import LibraryService
 from music_manager import open_saved_mm
 from music_player import BeatChangerWrapperPlayer
+from network_beats import BeatSender, DEFAULT_PORT, parse_address
+from profiling import profile_from_environment
+
+# length of each typing window in seconds
+BEAT_WINDOW_SIZE = 10.0
+
+CHANGERS = {
+    'fixed': FixedBeatChanger,
+    'ratio': RatioBeatChanger,
+    'predictive': PredictiveBeatChanger,
+    'nearest': NearestBeatChanger,
+}
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='Gop-Music automatic music player')
@@ -13,9 +35,121 @@ if __name__ == '__main__':
         help='Name of the profile to load'
     )
 
+    parser.add_argument(
+        '-c', '--changer', metavar='CHANGER', choices=sorted(CHANGERS), default='fixed',
+        help='Beat changer choosing the music. Should be one of: fixed, ratio, predictive (forecasts the typing '
+             'rate and preloads the next song), nearest (picks from the snippets closest to the typing rate in '
+             'beat density and energy)'
+    )
+
+    parser.add_argument(
+        '--adaptive-thresholds', action='store_true',
+        help='Only used by the fixed and predictive beat changers - learn the typing thresholds from percentiles '
+             'of your own typing, saved with the profile, instead of using fixed ones'
+    )
+
+    parser.add_argument(
+        '-b', '--backend', metavar='BACKEND', choices=['vlc', 'sounddevice'], default='vlc',
+        help='Playback backend to use. Should be one of: vlc, sounddevice'
+    )
+
+    parser.add_argument(
+        '-o', '--output', metavar='OUTPUT', default=None,
+        help='Only used by the sounddevice backend - "null" to discard the audio, or a filename to render '
+             'the audio into instead of playing it'
+    )
+
+    parser.add_argument(
+        '--asyncio', action='store_true',
+        help='Run the player on an asyncio event loop rather than a blocking loop with helper threads'
+    )
+
+    parser.add_argument(
+        '--plot-mode', metavar='MODE', choices=['draw', 'blit', 'process'], default='draw',
+        help='How the typing graph is rendered. Should be one of: draw, blit (cheaper, redraws only the lines), '
+             'process (plots from a separate process)'
+    )
+
+    parser.add_argument(
+        '--metrics-file', metavar='PATH', default=None,
+        help='Periodically write runtime metrics to this file in the Prometheus text format'
+    )
+
+    parser.add_argument(
+        '--metrics-port', metavar='PORT', type=int, default=None,
+        help='Serve runtime metrics over HTTP on this localhost port'
+    )
+
+    parser.add_argument(
+        '--record-trace', metavar='PATH', default=None,
+        help='Append the typing windows and events to this file, for replaying with simulator.py'
+    )
+
+    parser.add_argument(
+        '-i', '--input', metavar='SOURCE', choices=['pynput', 'evdev', 'replay'], default='pynput',
+        help='Where key presses are read from. Should be one of: pynput, evdev (a /dev/input device, '
+             'no display server needed), replay (a keystroke trace)'
+    )
+
+    parser.add_argument(
+        '--input-path', metavar='PATH', default=None,
+        help='The input device for the evdev source, or the keystroke trace for the replay source'
+    )
+
+    parser.add_argument(
+        '--replay-speed', metavar='SPEED', type=float, default=1.0,
+        help='How many times faster than real time to replay a keystroke trace'
+    )
+
+    parser.add_argument(
+        '--record-keystrokes', metavar='PATH', default=None,
+        help='Record the timing of key presses (never which keys) to this file, for the replay source'
+    )
+
+    parser.add_argument(
+        '--send', metavar='HOST[:PORT]', default=None,
+        help='Only count key presses, sending the counts to a player on another machine started with --listen'
+    )
+
+    parser.add_argument(
+        '--listen', metavar='PORT', type=int, nargs='?', const=DEFAULT_PORT, default=None,
+        help='Merge in the counts sent by machines started with --send, on this UDP port '
+             '(defaults to {})'.format(DEFAULT_PORT)
+    )
+
+    parser.add_argument(
+        '--watch', metavar='DIR', nargs='+', default=[],
+        help='Add the songs in these directories to the profile while playing, and any copied into them later, '
+             'and remove those deleted from them'
+    )
+
+    parser.add_argument(
+        '--ingest-workers', metavar='N', type=int, default=1,
+        help='Number of low priority processes analysing the songs found by --watch'
+    )
+
     args = parser.parse_args()
     profile = args.profile
 
+    # TYPE_MUSIC_PROFILE=cprofile,tracemalloc,sample turns on profiling
+    profile_from_environment('main')
+
+    if args.adaptive_thresholds and args.changer in ('ratio', 'nearest'):
+        parser.error('the {} beat changer already adapts to your typing - --adaptive-thresholds is not used by it'.format(
+            args.changer
+        ))
+
+    input_source = create_input_source(args.input, path=args.input_path, speed=args.replay_speed)
+
+    if args.send:
+        # no music on this machine, just the keyboard
+        detector = KeyboardBeatDetector(window_size=BEAT_WINDOW_SIZE, source=input_source)
+        BeatSender(detector.beat_queue, parse_address(args.send), BEAT_WINDOW_SIZE)
+        if args.record_keystrokes:
+            KeystrokeRecorder(detector.keystrokes, args.record_keystrokes)
+        detector.runner.join()
+        exit(0)
+
     music_manager = open_saved_mm(profile)
 
     if not music_manager.songs:
@@ -25,15 +159,56 @@ if __name__ == '__main__':
             )
         )
 
-    beat_changer = FixedBeatChanger()
+    if args.adaptive_thresholds:
+        thresholds = AdaptiveThresholds.for_profile(profile, BEAT_WINDOW_SIZE)
+        atexit.register(thresholds.save)
+        print('INFO: Typing thresholds are (mid: {}, high: {})'.format(*thresholds.thresholds()))
+        beat_changer = CHANGERS[args.changer](thresholds=thresholds)
+    else:
+        beat_changer = CHANGERS[args.changer]()
+
+    backend = None
+    if args.backend == 'sounddevice':
+        from sounddevice_backend import SoundDeviceBackend
+        backend = SoundDeviceBackend(output=args.output)
+
+    metrics = None
+    if args.metrics_file or args.metrics_port:
+        from metrics import MetricsRegistry, TextfileExporter, serve_metrics
+        metrics = MetricsRegistry()
 
     player = BeatChangerWrapperPlayer(
         beat_changer, music_manager=music_manager,
-        beat_window_size=10.0, min_change_time=120,
+        beat_window_size=BEAT_WINDOW_SIZE, min_change_time=120,
         exit_keys=['ctrl', 'e'],
         keys_events=[('good', ['ctrl', 'g']), ('bad', ['ctrl', 'b'])],
         send_notifications=True,
-        plot_graph=True
+        plot_graph=True,
+        plot_mode=args.plot_mode,
+        backend=backend,
+        asynchronous=args.asyncio,
+        metrics=metrics,
+        record_trace=args.record_trace,
+        input_source=input_source,
+        listen_port=args.listen,
+        feedback=FeedbackStore.for_profile(profile, args.changer)
     )
 
-    player.run()
+    if args.record_keystrokes:
+        KeystrokeRecorder(player.keyboard_detector.keystrokes, args.record_keystrokes)
+
+    if args.watch:
+        # new songs reach the player through its beat queue, between windows
+        library = LibraryService(profile, player.beat_queue, watch=args.watch, workers=args.ingest_workers)
+        atexit.register(library.close)
+
+    if args.metrics_file:
+        TextfileExporter(metrics, args.metrics_file)
+    if args.metrics_port:
+        serve_metrics(metrics, args.metrics_port)
+
+    if args.asyncio:
+        import asyncio
+        asyncio.get_event_loop().run_until_complete(player.run_async())
+    else:
+        player.run()
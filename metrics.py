@@ -0,0 +1,225 @@
+import os
+import resource
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Event, Lock, Thread
+
+# upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_memory():
+    """
+    Returns the resident set size of this process in bytes. Falls back to
+    the peak resident size where /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(labelnames, values)
+    ) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, key), value))
+        return lines
+
+
+class Gauge:
+    """
+    A value which can go up and down. Either set directly, or given a function
+    which is only evaluated when the metrics are rendered - so that reading
+    e.g. a queue depth costs nothing between scrapes.
+    """
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float('nan')
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} gauge'.format(self.name),
+            '{} {}'.format(self.name, value),
+        ]
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            bound = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_sum {}'.format(self.name, total))
+        lines.append('{}_count {}'.format(self.name, count))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of a process and renders them in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = []
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def register_process_metrics(self):
+        self.gauge('process_resident_memory_bytes', 'Resident memory size in bytes.', resident_memory)
+        self.gauge('process_threads', 'Number of live threads in the process, of every kind.', threading.active_count)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Atomically replaces the file at path with the current metrics, for use
+        with the node exporter's textfile collector.
+        """
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as raw_file:
+            raw_file.write(self.render())
+        os.replace(temp_path, path)
+
+
+class TextfileExporter:
+    """
+    Rewrites a metrics text file every interval seconds on a daemon thread.
+    """
+
+    def __init__(self, registry, path, interval=15.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.closed = Event()
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _run(self):
+        while not self.closed.is_set():
+            try:
+                self.registry.write_textfile(self.path)
+            except OSError as e:
+                print('INFO: Could not write metrics to {}: {}'.format(self.path, e))
+            self.closed.wait(self.interval)
+
+    def close(self):
+        self.closed.set()
+        self.runner.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(registry, port, host='127.0.0.1'):
+    """
+    Serves the metrics over HTTP at /metrics from a daemon thread.
+
+    :return: the server, which can be stopped with shutdown()
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    runner = Thread(target=server.serve_forever)
+    runner.daemon = True
+    runner.start()
+    return server
@@ -1,11 +1,14 @@
 #!/usr/bin/python3
 # base library imports
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 import __main__ as main
 import json
 import os
 import sys
+import time
 
 # core-numerical/standard imports
 import pandas as pd
@@ -16,6 +19,7 @@ from tqdm import tqdm
 
 # library imports
 from beat_detection import *
+from profiling import profile_from_environment
 
 SCRIPT_NAME = __file__
 DEBUG = bool(os.environ.get('TYPE_MUSIC_DEBUG', False))
@@ -59,6 +63,10 @@ LOW_BASE_BEAT_THRESHOLD = int(os.environ.get('TYPE_MUSIC_LOW_BASE_BEAT_THRESHOLD
 BASE_HIGH_BEAT_THRESHOLD = int(os.environ.get('TYPE_MUSIC_BASE_HIGH_BEAT_THRESHOLD', 20))
 SAVE_DIR = Path(os.environ.get('TYPE_MUSIC_SAVE_DIR', '~/.typemusic/')).expanduser().resolve()
 
+# the features stored with each snippet, in the order of a feature vector:
+# beats per second, RMS amplitude of the audio, and length in seconds
+FEATURE_NAMES = ('beat_density', 'energy', 'length')
+
 if DEBUG:
     print("SAVE_DIR: ", SAVE_DIR)
 
@@ -83,6 +91,82 @@ def save_new_mm(filename, mm):
     mm.save_to_disk(str(file_path))
 
 
+def interval_power(data, rate, interval):
+    """
+    Returns the mean squared amplitude of the audio over each interval of
+    interval seconds, averaged over the channels
+    """
+    power = np.square(data)
+    if power.ndim > 1:
+        power = power.mean(axis=1)
+    if len(power) == 0:
+        return power
+
+    starts = np.arange(0, len(power), max(int(round(interval * rate)), 1))
+    return np.add.reduceat(power, starts) / np.diff(np.append(starts, len(power)))
+
+
+def analyse_song(song, block_size, beat_interval_size, verbose=False, timings=None):
+    """
+    Reads a song and detects its beats - the part of adding a song which does
+    not depend on the library, and takes nearly all of the time.
+
+    :param timings: if specified, a dict to which the seconds spent in the
+                    'read', 'fft', 'band_reduction', 'beats_per_interval'
+                    and 'features' stages are added
+    :return: a dict with the song's 'info' (as MusicManager.get_song_info),
+             its 'beats' per interval and the mean squared amplitude
+             ('power') of each interval
+    """
+    if timings is None:
+        stages = {}
+    else:
+        stages = timings
+
+    def record(stage, started):
+        stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - started
+
+    if verbose:
+        print('INFO: Reading song from file')
+    started = time.perf_counter()
+    data, rate = soundfile.read(song)
+    record('read', started)
+    if verbose:
+        print('INFO: Completed song read. Now transforming using frequency based conversion')
+
+    info = {
+        'duration': data.shape[0] / rate,
+        'samplerate': rate,
+        'frames': data.shape[0],
+    }
+
+    raw_beats = FrequencySelectedEnergyDetector(
+        block_size=block_size, verbose=verbose
+    ).transform(data, timings=timings)
+
+    if verbose:
+        print('INFO: Completed frequency based beat detection. Now grouping by interval.')
+
+    started = time.perf_counter()
+    beats = beats_per_interval(raw_beats, block_size, rate, beat_interval_size)
+    record('beats_per_interval', started)
+
+    if verbose:
+        print('INFO: Completed grouping by interval.')
+
+    started = time.perf_counter()
+    power = interval_power(data, rate, beat_interval_size)
+    record('features', started)
+
+    return {'info': info, 'beats': beats, 'power': power}
+
+
+def _analyse_song_timed(song, block_size, beat_interval_size, timed):
+    # the worker processes' timings are sent back with the analysis
+    timings = {} if timed else None
+    return analyse_song(song, block_size, beat_interval_size, timings=timings), timings
+
+
 class MusicManager:
     def __str__(self):
         result = ""
@@ -131,6 +215,7 @@ class MusicManager:
             self.base_high_beat_threshold = BASE_HIGH_BEAT_THRESHOLD
 
             self.songs = []
+            self.song_info = {}
             self.slow_snippets = []
             self.fast_snippets = []
             self.base_snippets = []
@@ -141,6 +226,7 @@ class MusicManager:
 
         # clear all the variables
         self.songs = []
+        self.song_info = {}
         self.slow_snippets = []
         self.fast_snippets = []
         self.base_snippets = []
@@ -155,6 +241,7 @@ class MusicManager:
 
     def remove_song(self, song):
         self.songs.remove(song)
+        self.song_info.pop(song, None)
 
         self.slow_snippets = [
             entry for entry in self.slow_snippets if entry['song'] != song
@@ -168,6 +255,54 @@ class MusicManager:
             entry for entry in self.fast_snippets if entry['song'] != song
         ]
 
+    def get_song_info(self, song):
+        """
+        Returns the stored duration (in seconds), sample rate and frame count
+        of a song. Songs from profiles saved before this information was
+        recorded are looked up from the file header once and cached.
+
+        :param song: filename of the song
+        :return: a dict with 'duration', 'samplerate' and 'frames', or None if
+                 the file could not be inspected
+        """
+        info = self.song_info.get(song)
+        if info is None:
+            try:
+                file_info = soundfile.info(song)
+            except (RuntimeError, OSError):
+                return None
+            info = {
+                'duration': file_info.frames / file_info.samplerate,
+                'samplerate': file_info.samplerate,
+                'frames': file_info.frames,
+            }
+            self.song_info[song] = info
+        return info
+
+    def get_song_length(self, song):
+        """
+        Returns the duration of a song in seconds, or None if unknown.
+        """
+        info = self.get_song_info(song)
+        if info is None:
+            return None
+        return info['duration']
+
+    def snippet_moods(self):
+        """
+        Returns a dict mapping (song, start) of every snippet to its mood -
+        one of 'low', 'mid' or 'high'.
+        """
+        moods = {}
+        for mood, snippets in [
+            ('low', self.slow_snippets),
+            ('mid', self.base_snippets),
+            ('high', self.fast_snippets),
+        ]:
+            for snippet in snippets:
+                moods[(snippet['song'], snippet['start'])] = mood
+        return moods
+
     def get_snippets(self, song, count=False):
         snippets, fast, base, slow = [], [], [], []
         if count:
@@ -202,7 +337,32 @@ class MusicManager:
 
         return snippets, fast, base, slow
 
-    def add_song(self, song, verbose=False, mood=None, min_length=None, plot_beats=False):
+    def snippet_features(self, beats, power, start, end):
+        """
+        Returns the features of the snippet of a song between start and end
+        seconds, as a dict of FEATURE_NAMES.
+
+        :param beats: the song's beats per interval
+        :param power: the song's mean squared amplitude per interval
+        """
+        first = int(start / self.beat_interval_size)
+        last = max(int(end / self.beat_interval_size), first + 1)
+
+        return {
+            'beat_density': float(np.mean(beats[first:last])) / self.beat_interval_size if first < len(beats) else 0.0,
+            'energy': float(np.sqrt(np.mean(power[first:last]))) if first < len(power) else 0.0,
+            'length': float(end - start),
+        }
+
+    def add_song(self, song, verbose=False, mood=None, min_length=None, plot_beats=False, analysis=None,
+                 timings=None):
+        """
+        :param analysis: the result of analyse_song for the song, if it has
+                         already been analysed with this library's block and
+                         interval sizes
+        :param timings: if specified, a dict to which the seconds spent in each
+                        stage of adding the song are added
+        """
         if song in self.songs:
             if verbose:
                 print('INFO: Song {} already exists in library, skipping.'.format(song))
@@ -210,24 +370,53 @@ class MusicManager:
 
         self.songs.append(song)
 
-        if verbose:
-            print('INFO: Reading song from file')
-        data, rate = soundfile.read(song)
-        if verbose:
-            print('INFO: Completed song read. Now transforming using frequency based conversion')
-
-        raw_beats = FrequencySelectedEnergyDetector(
-            block_size=self.block_size, verbose=verbose
-        ).transform(data)
-
-
-        if verbose:
-            print('INFO: Completed frequency based beat detection. Now grouping by interval.')
-
-        beats = beats_per_interval(raw_beats, self.block_size, rate, self.beat_interval_size)
+        if analysis is None:
+            analysis = analyse_song(song, self.block_size, self.beat_interval_size, verbose=verbose, timings=timings)
+
+        started = time.perf_counter()
+        self.segment_song(song, analysis, verbose=verbose, mood=mood, min_length=min_length, plot_beats=plot_beats)
+        if timings is not None:
+            timings['segmentation'] = timings.get('segmentation', 0.0) + time.perf_counter() - started
+
+    def add_songs(self, songs, workers=1, verbose=False, mood=None, min_length=None, timings=None):
+        """
+        Adds several songs, reading and analysing up to workers of them at a
+        time in separate processes. The analysis does not depend on the
+        library, so only the segmentation happens in this process, in the
+        order the songs were given.
+
+        :param timings: as for add_song - the stages run in the workers are
+                        summed over them, so can add up to more than the
+                        time taken
+        """
+        songs = [song for song in dict.fromkeys(songs) if song not in self.songs]
+
+        if workers <= 1:
+            for song in (tqdm(songs) if verbose else songs):
+                self.add_song(song, verbose=verbose, mood=mood, min_length=min_length, timings=timings)
+            return
 
-        if verbose:
-            print('INFO: Completed grouping by interval.')
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                _analyse_song_timed, songs,
+                repeat(self.block_size), repeat(self.beat_interval_size), repeat(timings is not None)
+            )
+            if verbose:
+                results = tqdm(results, total=len(songs))
+
+            for song, (analysis, song_timings) in zip(songs, results):
+                if timings is not None:
+                    for stage, seconds in song_timings.items():
+                        timings[stage] = timings.get(stage, 0.0) + seconds
+                self.add_song(song, mood=mood, min_length=min_length, analysis=analysis, timings=timings)
+
+    def segment_song(self, song, analysis, verbose=False, mood=None, min_length=None, plot_beats=False):
+        """
+        Splits an analysed song into snippets of each mood
+        """
+        self.song_info[song] = analysis['info']
+        beats = analysis['beats']
+        power = analysis['power']
 
         # if empty track, exit
         if len(beats) == 0:
@@ -298,12 +487,14 @@ class MusicManager:
 
                 if min_length is None or (i - current_start) * self.beat_interval_size >= min_length:
                     # append the data to the list
-                    entry_list.append({
+                    entry = {
                         'song': song,
                         'from': entry_from,
                         'start': (current_start * self.beat_interval_size),
                         'end': (i * self.beat_interval_size),
-                    })
+                    }
+                    entry['features'] = self.snippet_features(beats, power, entry['start'], entry['end'])
+                    entry_list.append(entry)
                     new_snippets += 1
 
                     # update the variables
@@ -344,12 +535,14 @@ class MusicManager:
                     entry_from = FROM_HIGH
 
             # append the data to the list
-            entry_list.append({
+            entry = {
                 'song': song,
                 'from': entry_from,
                 'start': (current_start * self.beat_interval_size),
                 'end': ((i - 1) * self.beat_interval_size),
-            })
+            }
+            entry['features'] = self.snippet_features(beats, power, entry['start'], entry['end'])
+            entry_list.append(entry)
             new_snippets += 1
 
         # if we didn't add any snippets, just add one for the whole song
@@ -361,12 +554,14 @@ class MusicManager:
             }[mood]
 
             entry_from = FROM_UNKNOWN
-            entry_list.append({
+            entry = {
                 'song': song,
                 'from': entry_from,
                 'start': (0 * self.beat_interval_size),
                 'end': (len(beats) * self.beat_interval_size),
-            })
+            }
+            entry['features'] = self.snippet_features(beats, power, entry['start'], entry['end'])
+            entry_list.append(entry)
 
 
 
@@ -378,6 +573,8 @@ class MusicManager:
             raise ValueError('Incompatible old version of format. Check Gitlab wiki for possible conversions.')
 
         self.songs = json_data['songs']
+        # profiles written before durations were stored lack this entry
+        self.song_info = json_data.get('song_info', {})
 
         self.block_size = int(json_data['block_size'])
         self.beat_interval_size = int(json_data['beat_interval_size'])
@@ -392,6 +589,7 @@ class MusicManager:
         save_obj = {}
 
         save_obj['songs'] = self.songs
+        save_obj['song_info'] = self.song_info
         save_obj['version'] = VERSION
 
         save_obj['block_size'] = self.block_size
@@ -440,12 +638,19 @@ if __name__ == '__main__':
         process'
     )
 
+    parser.add_argument(
+        '--jobs', '-j', metavar='JOBS', type=int, default=1,
+        help='Number of songs to analyse at once in separate processes when adding songs. Ignored when '
+             'visualising the beats.'
+    )
+
     parser.add_argument(
         'action', metavar='ACTION', choices=['add-song', 'remove-song', 'list-songs', 'list-snippets', 'test-run'],
         help='The action to perform. Should be one of: add-song, remove-song, list-songs, list-snippets, test-run'
     )
 
     args, songs = parser.parse_known_args()
+    profile_from_environment('music_manager-{}'.format(args.action))
     profile = args.profile
     mood = args.force_mood
     verbose = not args.silent
@@ -461,19 +666,20 @@ if __name__ == '__main__':
 
     mm = open_saved_mm(profile)
 
+    def add_songs(mm, songs):
+        songs = [str(Path(song).resolve()) for song in songs]
+        if visualise_beats or args.jobs <= 1:
+            for song in (tqdm(songs) if verbose else songs):
+                mm.add_song(song, verbose=verbose, mood=mood, min_length=min_length, plot_beats=visualise_beats)
+        else:
+            mm.add_songs(songs, workers=args.jobs, verbose=verbose, mood=mood, min_length=min_length)
+
     if args.action == 'add-song':
         if not songs:
             print('Error: Please provide songs to be loaded.', file=sys.stderr)
             exit(-1)
 
-        slist = songs
-
-        if verbose:
-            slist = tqdm(slist)
-
-        for song in slist:
-            song = str(Path(song).resolve())
-            mm.add_song(song, verbose=verbose, mood=mood, min_length=min_length, plot_beats=visualise_beats)
+        add_songs(mm, songs)
 
         save_new_mm(profile, mm)
 
@@ -486,13 +692,7 @@ if __name__ == '__main__':
         mm = MusicManager()
         slist = songs
 
-        if verbose:
-            slist = tqdm(slist)
-
-        for song in slist:
-            song = str(Path(song).resolve())
-            mm.add_song(song, verbose=verbose, mood=mood, min_length=min_length, plot_beats=visualise_beats)
-
+        add_songs(mm, songs)
 
         for song in slist:
             snippets, fast, base, slow = mm.get_snippets(song)
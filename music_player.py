@@ -1,109 +1,59 @@
-import time
+import asyncio
 from math import ceil
-from subprocess import call
-from threading import Event, Thread
-
-import vlc
+from threading import Lock, Thread
+from time import monotonic, perf_counter
 
+from beat_bus import DROP_OLDEST, TraceRecorder
+from input_sources import PynputInputSource
 from keyboard_handler import KeyboardBeatDetector, BeatVisualizer
+from library_service import LibraryUpdate, apply_update
 from music_manager import open_saved_mm
+from network_beats import BeatReceiver
+from notifications import NotificationDispatcher, send_notification_async
+from typing_window import TypingWindow
 
-
-def send_notification(msg):
-    """
-    Sends the provided message as a notification
-    :param msg: message to print in notification
-    """
-    call(['notify-send', msg])
+# number of items the visualizer and other observers may fall behind the
+# beat source by before they start losing the oldest ones
+OBSERVER_BUFFER_SIZE = 64
 
 
-def play_song(filename, position=None, fadein=3, fadeout=3, callback=None, volume=60, interval_res=1.0):
+class AsyncQueueBridge:
     """
-    Custom function supporting playing songs with fadein and fadeout using VLC media player.
-
-    :param filename: file to be played
-    :param position: position (in seconds) to play
-    :param fadein: number of seconds to use for fading in the song
-    :param fadeout: number of seconds to use for fading out the sonc
-    :param callback: callback to be called when music finishes
-    :param volume: the volume at which the song should be played
-    :param interval_res: the number of seconds between updates when fading in the song
-
-    :return: a condition object that can be set to stop the playback
+    Queue-like object which threads (such as the keyboard listener) can put
+    items into, delivering them to an asyncio queue on the player's event
+    loop. Items put before the loop is bound are held back until then.
     """
-    stop_event = Event()
-    print('play_song({}, {})'.format(filename, position))
-
-    def play():
-        nonlocal position
-        nonlocal fadein
-        nonlocal fadeout
-        nonlocal callback
-        nonlocal volume
-
-        sound_a = vlc.MediaPlayer(filename)
-
-        sound_a.play()
-        if interval_res != 1:
-            fadein = fadein / interval_res
-            fadeout = fadeout / interval_res
-
-        # get the length of the sound (in seconds)
-        sound_length = sound_a.get_length() // 1000
-
-        while sound_length == 0:
-            sound_length = sound_a.get_length() // 1000
-
-        if position is not None:
-            # convert position to percentage
-            original_position = position
-            position = position / sound_length
-            sound_a.set_position(position)
-        else:
-            original_position = 0
-            position = 0
-
-        # fade in the song
-        if fadein is not None:
-            current_volume = 0
-            increment = volume / fadein
-
-            while current_volume < volume:
-                sound_a.audio_set_volume(int(current_volume))
-                current_volume += increment
-                time.sleep(interval_res)
-
-        sound_a.audio_set_volume(int(volume))
-
-        # wait for a stop message or for song to end
-        print("Waiting sound_length {} - fade_out {} - position {} (original: {}) = {}".format(sound_length, fadeout, position * sound_length, original_position, (sound_length - fadeout - position * sound_length)))
-        stop_event.wait(max(sound_length - fadeout - position * sound_length, 0))
-        print("Waiting finished - sound_a.get_position() = {}".format(sound_a.get_position()))
-
-        # fade out the song
-        if sound_a.get_position() < 1.0 and fadeout is not None:
-            current_volume = volume
-            increment = volume / fadeout
-
-            while sound_a.get_position() < 1.0 and current_volume > 0:
-                sound_a.audio_set_volume(int(current_volume))
-                current_volume -= increment
-                time.sleep(interval_res)
-
-        sound_a.stop()
 
-        # if we stopped due to the song ending, call the callback
-        print("callback {} and not stop_event.is_set() {} = {}".format(callback, not stop_event.is_set(), callback and not stop_event.is_set()))
-        if callback and not stop_event.is_set():
-            print("Calling callback")
-            callback(filename)
-
-
-    t = Thread(target=play)
-    t.daemon = True
-    t.start()
-
-    return stop_event
+    def __init__(self):
+        self.lock = Lock()
+        self.loop = None
+        self.queue = None
+        self.backlog = []
+
+    def bind(self, loop):
+        with self.lock:
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            for item in self.backlog:
+                self.queue.put_nowait(item)
+            self.backlog = []
+
+    def put(self, item, block=True, timeout=None):
+        with self.lock:
+            if self.loop is None:
+                self.backlog.append(item)
+                return
+            loop = self.loop
+        loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def qsize(self):
+        with self.lock:
+            if self.queue is None:
+                return len(self.backlog)
+            return self.queue.qsize()
 
 
 class BeatChangerWrapperPlayer:
@@ -117,135 +67,393 @@ class BeatChangerWrapperPlayer:
             self, beat_changer, music_manager=None,
             beat_window_size=3.0, interval_res=0.2, fade_in=3, fade_out=3,
             min_change_time=60,
-            exit_keys=None, keys_events=None, send_notifications=False, plot_graph=False
+            exit_keys=None, keys_events=None, send_notifications=False, plot_graph=False,
+            backend=None, asynchronous=False, beat_queue=None, clock=None, metrics=None,
+            plot_mode='draw', record_trace=None, input_source=None, listen_port=None, feedback=None
     ):
+        """
+        :param backend: the playback backend to use, defaults to VLCDeckBackend
+        :param asynchronous: whether the player will be run with run_async
+        :param beat_queue: if given, (count, time) windows and events are read from this
+                           queue instead of from a keyboard detector - an AsyncQueueBridge
+                           when asynchronous is set
+        :param clock: function returning the current time, on the same clock as the
+                      window times, used to measure decision latency - defaults to
+                      the clock of the keyboard detector's input source
+        :param metrics: a metrics.MetricsRegistry to record the player's runtime metrics into
+        :param plot_mode: how the graph is rendered when plot_graph is set - 'draw' redraws the
+                          whole figure for every window, 'blit' only redraws the lines at a capped
+                          frame rate, and 'process' plots from a separate process reading the
+                          window through shared memory
+        :param record_trace: path of a file to append the keyboard's windows and events to,
+                             in the format replayed by simulator.py
+        :param input_source: the input_sources.BaseInputSource the keyboard detector reads,
+                             pynput's keyboard listener by default
+        :param listen_port: if given, windows sent by network_beats.BeatSenders on other machines
+                            are received on this UDP port and merged with the local keyboard's
+        :param feedback: a feedback_store.FeedbackStore the beat changer loads the weights of
+                         the snippets from, and records the user's feedback to
+        """
+        if asynchronous and beat_queue is not None and not isinstance(beat_queue, AsyncQueueBridge):
+            raise ValueError('An asynchronous player reads its windows from an AsyncQueueBridge, not {}'.format(
+                type(beat_queue).__name__
+            ))
+
         if music_manager is None:
             music_manager = open_saved_mm('default')
 
-        # create a keyboard detector
-        self.keyboard_detector = KeyboardBeatDetector(
-            window_size=beat_window_size,
-            exit_keys=exit_keys,
-            keys_events=keys_events,
-        )
+        # when running on an event loop, the keyboard listener hands its
+        # windows over through a thread-safe bridge
+        bridge = AsyncQueueBridge() if asynchronous else None
+
+        # create a keyboard detector, publishing to a bus which the player,
+        # the visualizer and any other observers each subscribe to
+        self.keyboard_detector = None
+        self.bus = None
+        self.receiver = None
+        if beat_queue is None:
+            if input_source is None:
+                input_source = PynputInputSource()
+
+            local_queue = bridge
+            if listen_port is not None:
+                # the local windows go through the receiver, to be merged with
+                # those of the other machines on the same clock
+                self.receiver = BeatReceiver(beat_window_size, port=listen_port, clock=input_source.clock)
+                local_queue = self.receiver.local_stream()
+
+            self.keyboard_detector = KeyboardBeatDetector(
+                window_size=beat_window_size,
+                exit_keys=exit_keys,
+                keys_events=keys_events,
+                beat_queue=local_queue,
+                source=input_source,
+            )
+            self.bus = self.keyboard_detector.bus
+
+            if self.receiver is not None:
+                # the player and the observers all see the merged windows
+                self.bus = self.receiver.bus
+                if bridge is not None:
+                    beat_queue = self.bus.attach(bridge)
+                else:
+                    beat_queue = self.bus.subscribe('beats')
 
         # calculate the number of beat_windows to include in an analysis time
+        self.beat_window_size = beat_window_size
         self.window_size = int(ceil(min_change_time / beat_window_size) + 1)
 
-        # retrieve a beat queue
-        if plot_graph:
-            self.detector = BeatVisualizer(
-                self.keyboard_detector.beat_queue,
-                window_width=self.window_size,
-            )
-            self.beat_queue = self.detector.out_queue
-            self.beat_thread = Thread(target=self.detector.run)
-            self.beat_thread.start()
+        # the most recent windows, shared with the visualizer and the beat changer
+        if plot_graph and plot_mode == 'process':
+            # imported here as shared memory needs python 3.8
+            from shared_window import SharedTypingWindow
+            self.window = SharedTypingWindow(self.window_size)
+        else:
+            self.window = TypingWindow(self.window_size)
+        # number of windows received since the music last changed
+        self.windows_since_change = 0
+
+        # retrieve a beat queue - the player's own subscription never drops items
+        if beat_queue is not None:
+            self.beat_queue = beat_queue
         else:
             self.beat_queue = self.keyboard_detector.beat_queue
-        self.last_song_stop = None
-        self.current_repeated = False
 
+        # the visualizer only observes the windows, it never sits between the
+        # keyboard and the player
+        self.detector = None
+        self.visualizer_process = None
+        if plot_graph and self.bus is not None:
+            if plot_mode == 'process':
+                from visualizer_process import start_visualizer_process
+                self.visualizer_process = start_visualizer_process(self.window)
+            else:
+                self.detector = BeatVisualizer(
+                    self.bus.subscribe('visualizer', maxsize=OBSERVER_BUFFER_SIZE, overflow=DROP_OLDEST),
+                    window_width=self.window_size,
+                    window=self.window,
+                    blit=plot_mode == 'blit',
+                )
+                self.beat_thread = Thread(target=self.detector.run)
+                self.beat_thread.start()
+
+        self.recorder = None
+        if record_trace is not None and self.bus is not None:
+            self.recorder = TraceRecorder(
+                self.bus.subscribe('recorder', maxsize=OBSERVER_BUFFER_SIZE, overflow=DROP_OLDEST), record_trace
+            )
+        self.current_repeated = False
 
-        # two variables to keep track of recieved data
-        self.internal_counts = []
-        self.internal_times = []
 
         # parameters used to play songs
         self.fade_in = fade_in
         self.fade_out = fade_out
         self.interval_res = interval_res
 
+        if backend is None:
+            # imported here so that other backends can be used without VLC installed
+            from vlc_backend import VLCDeckBackend
+            backend = VLCDeckBackend(
+                fade_in=fade_in, fade_out=fade_out, interval_res=interval_res, threaded=not asynchronous
+            )
+        self.backend = backend
+
         self.send_notifications = send_notifications
+        # notifications are sent from a background dispatcher so that a slow
+        # notification daemon never holds up music decisions
+        self.notifier = None
+        if not asynchronous:
+            self.notifier = NotificationDispatcher()
+            self.notify = self.notifier.notify
+        if clock is None:
+            # the windows are timed on the input source's clock
+            clock = self.keyboard_detector.source.clock if self.keyboard_detector is not None else monotonic
+        self.clock = clock
+        self.last_decision_latency = None
+        self.last_decision_cost = None
+        self.decision_count = 0
 
         # load the beat-changer
+        if feedback is not None:
+            beat_changer.configure_feedback(feedback)
         beat_changer.configure_tracks(music_manager)
         beat_changer.configure_parameters(beat_window_size=beat_window_size, window_size=self.window_size)
+        beat_changer.configure_window(self.window)
 
         self.beat_changer = beat_changer
         self.music_manager = music_manager
+        self.snippet_moods = music_manager.snippet_moods()
+
+        # time at which the last song was requested from the backend
+        self.play_requested_at = None
+        self.metrics = None
+        if metrics is not None:
+            self._register_metrics(metrics)
+        self.backend.on_audible = self._on_audible
+
+    def _register_metrics(self, registry):
+        self.metrics = {
+            'windows': registry.counter(
+                'gop_windows_processed_total', 'Keystroke windows processed by the player.'
+            ),
+            'events': registry.counter(
+                'gop_events_total', 'Keybinding events received by the player.', ['event']
+            ),
+            'switches': registry.counter(
+                'gop_song_switches_total', 'Songs switched to by the beat changer, by mood.', ['mood']
+            ),
+            'decision_latency': registry.histogram(
+                'gop_decision_latency_seconds', 'Time from a keystroke window closing to the music decision.'
+            ),
+            'playback_latency': registry.histogram(
+                'gop_playback_latency_seconds', 'Time from a music decision to the song being audible.'
+            ),
+        }
+        registry.gauge(
+            'gop_playback_threads', 'Live threads the playback backend plays songs on.',
+            self.backend.playback_threads
+        )
+        registry.gauge(
+            'gop_beat_queue_depth', 'Items waiting in the queue read by the player.', self.beat_queue.qsize
+        )
+        if self.detector is not None:
+            registry.gauge(
+                'gop_visualizer_queue_depth', 'Items waiting in the queue read by the visualizer.',
+                self.detector.beat_queue.qsize
+            )
+            registry.gauge(
+                'gop_visualizer_dropped_items', 'Items the visualizer fell too far behind to read.',
+                lambda: self.detector.beat_queue.dropped
+            )
+        if self.bus is not None:
+            # keystroke counts are taken off the bus, rather than in the
+            # decision path
+            keystrokes = registry.counter('gop_keystrokes_total', 'Keystrokes counted by the keyboard detector.')
+            subscription = self.bus.subscribe('metrics', maxsize=OBSERVER_BUFFER_SIZE, overflow=DROP_OLDEST)
+
+            def count_keystrokes():
+                while True:
+                    item = subscription.get()
+                    if isinstance(item, tuple):
+                        keystrokes.inc(item[0])
+                    subscription.task_done()
+
+            counter_thread = Thread(target=count_keystrokes)
+            counter_thread.daemon = True
+            counter_thread.start()
+        if self.receiver is not None:
+            registry.gauge(
+                'gop_network_late_windows', 'Windows from other machines dropped for arriving too late.',
+                lambda: self.receiver.stats()['late']
+            )
+            registry.gauge(
+                'gop_network_hosts', 'Other machines windows have been received from.',
+                lambda: self.receiver.stats()['hosts']
+            )
+            registry.gauge(
+                'gop_network_lost_windows', 'Windows from other machines which never arrived.',
+                lambda: self.receiver.stats()['lost']
+            )
+        if self.notifier is not None:
+            registry.gauge(
+                'gop_notification_queue_depth', 'Notifications waiting to be sent.', self.notifier.depth
+            )
+        registry.register_process_metrics()
+
+    def _on_audible(self, song, timestamp):
+        if self.metrics is not None and self.play_requested_at is not None:
+            self.metrics['playback_latency'].observe(max(timestamp - self.play_requested_at, 0))
 
     def play_song(self, song, position=None):
         """
         Given a song and position, begins playback of the song,
-        fading out the last played song if necassary
+        crossfading from the last played song if necassary
 
         :param song: filename of the song to be played
         :param position: position (in seconds) of the song at which to play
         """
-        if self.last_song_stop is not None:
-            print("Playing song - sending stop signal", self.last_song_stop)
-            self.last_song_stop.set()
-
         if not position:
             print('play_song called due to timeout ({}, {})'.format(song, position))
             self.current_repeated = True
         else:
             self.current_repeated = False
 
-        self.last_song_stop = play_song(
+        self.play_requested_at = monotonic()
+        self.backend.play(
             song,
             position=position,
-            fadein=self.fade_in,
-            fadeout=self.fade_out,
-            interval_res=self.interval_res,
-            callback=self.play_song
+            length=self.music_manager.get_song_length(song),
+            callback=self.play_song,
         )
 
     def change_music(self):
         # look at beats queue and return a song or none
         return self.beat_changer.change_music(
-            self.internal_times, self.internal_counts, self.current_repeated
+            self.window.times, self.window.counts, self.current_repeated
         )
 
     def notify_event(self, event):
-        send_notification('Sending Notification of {} Music Choice'.format(event))
+        self.notify('Sending Notification of {} Music Choice'.format(event), key='event')
         # passed an event to indicate quality of last choice
         self.beat_changer.notify_event(event)
 
+    def update_library(self, update):
+        """
+        Applies a library_service.LibraryUpdate to the library and the beat
+        changer, configuring the beat changer from the whole library again if
+        it cannot be updated in place.
+        """
+        apply_update(self.music_manager, update)
+        for song in update.removed:
+            for key in [key for key in self.snippet_moods if key[0] == song]:
+                del self.snippet_moods[key]
+        for mood, snippet in update.added:
+            self.snippet_moods[(snippet['song'], snippet['start'])] = mood
+
+        try:
+            self.beat_changer.update_tracks(update.added, update.removed)
+        except NotImplementedError:
+            self.beat_changer.configure_tracks(self.music_manager)
+        print('INFO: Library updated:', update)
+
+    def handle_item(self, next_item):
+        """
+        Processes a single entry from the beat queue - either an event string
+        if the user pressed a keybinding, a (count, time) beat window, or a
+        library_service.LibraryUpdate.
+        """
+        if isinstance(next_item, LibraryUpdate):
+            self.update_library(next_item)
+            return
+
+        if not isinstance(next_item, tuple):
+            if self.metrics is not None:
+                self.metrics['events'].inc(event=next_item)
+            self.notify_event(next_item)
+            return
+
+        (count, time) = next_item
+        if self.metrics is not None:
+            self.metrics['windows'].inc()
+
+        self.window.push(count, time)
+        self.windows_since_change += 1
+
+        upcoming = self.beat_changer.prepare_next(self.window.times, self.window.counts)
+        if upcoming is not None:
+            song, position = upcoming
+            self.backend.preload(song, position=position, length=self.music_manager.get_song_length(song))
+
+        if self.windows_since_change > self.beat_changer.change_interval(self.window_size):
+            # once the window has filled up (or as much of it as the beat
+            # changer needs), we are safe to try changing the music
+            started = perf_counter()
+            next_music = self.change_music()
+            self.last_decision_cost = perf_counter() - started
+            self.decision_count += 1
+
+            # time between the window closing and the decision being made
+            self.last_decision_latency = self.clock() - (time + self.beat_window_size)
+            if self.metrics is not None:
+                self.metrics['decision_latency'].observe(max(self.last_decision_latency, 0))
+
+            # if the beat changer requests a music change
+            if next_music:
+                song, position = next_music
+                self.play_song(song, position)
+                if self.metrics is not None:
+                    self.metrics['switches'].inc(mood=self.snippet_moods.get((song, position), 'unknown'))
+                print('INFO: Got Next music from beat changer', song, position,
+                      '(decided {:.3f}s after window closed)'.format(self.last_decision_latency))
+
+                if self.send_notifications:
+                    self.notify('Playing {}'.format(song), key='playing')
+
+                # wait for the window to fill with windows from after the change
+                self.windows_since_change = 0
+
+            elif self.send_notifications:
+                # self.notify('Continuing Playback of Last Song')
+                pass
+
     def run(self):
         song, start = self.beat_changer.play_initial()
         self.play_song(song, start)
 
         while True:
-
             # retrieve the next entry
-            next_item = self.beat_queue.get()
-
-            # we'll expect 3 types of things from the beat queue
-            # events if the user presses a keybinding
-            # or a result
-            if not isinstance(next_item, tuple):
-                self.notify_event(next_item)
-            else:
-                (count, time) = next_item
-
-                self.internal_times.append(time)
-                self.internal_counts.append(count)
+            self.handle_item(self.beat_queue.get())
 
-                if len(self.internal_times) > self.window_size:
-                    del self.internal_times[0]
-                    del self.internal_counts[0]
-
-                    # once the window has filled up, we are safe to
-                    # try changing the music
-                    next_music = self.change_music()
+    async def run_async(self):
+        """
+        Runs the player on an asyncio event loop. Beat windows and events are
+        delivered through the bridge queue, the backend's fades and song
+        end-times are driven as tasks on the loop, and notifications are
+        spawned without waiting on them.
 
-                    # if the beat changer requests a music change
-                    if next_music:
-                        song, position = next_music
-                        self.play_song(song, position)
-                        print('INFO: Got Next music from beat changer', song, position)
+        Requires the player to have been created with asynchronous=True.
+        """
+        loop = asyncio.get_event_loop()
+        self.beat_queue.bind(loop)
 
-                        if self.send_notifications:
-                            send_notification('Playing {}'.format(song))
+        pending = {}
 
-                        # reset the window
-                        self.internal_times = []
-                        self.internal_counts = []
+        def notify(msg, key=None):
+            # a newer notification with the same key supersedes the old one
+            if key is not None and key in pending and not pending[key].done():
+                pending[key].cancel()
+            task = loop.create_task(send_notification_async(msg))
+            if key is not None:
+                pending[key] = task
+        self.notify = notify
 
-                    elif self.send_notifications:
-                        # send_notification('Continuing Playback of Last Song')
-                        pass
+        backend_task = loop.create_task(self.backend.run_async())
 
+        song, start = self.beat_changer.play_initial()
+        self.play_song(song, start)
 
+        try:
+            while True:
+                self.handle_item(await self.beat_queue.get())
+        finally:
+            backend_task.cancel()
@@ -0,0 +1,300 @@
+import random
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from adaptive_thresholds import MIN_ACTIVE_COUNT
+from beat_changer import BaseBeatChanger
+from fixed_beat_changer import MAX_REPEAT_COUNT
+from music_manager import FEATURE_NAMES
+from weighted_sampler import FenwickTree
+
+# number of nearest snippets the next one is drawn from
+DEFAULT_K = 16
+# scale of each feature in the distance - the beat density matters most, the
+# length only separates otherwise close snippets
+FEATURE_WEIGHTS = np.array([1.0, 0.5, 0.25])
+# window counts above this are tracked as this
+MAX_TRACKED_COUNT = 1000
+# the KD-tree is rebuilt once the snippets added or removed since it was last
+# built exceed this many, or this fraction of the library if more
+REBUILD_MIN_CHANGES = 256
+REBUILD_FRACTION = 0.1
+
+
+class NearestBeatChanger(BaseBeatChanger):
+    """
+    Places every snippet at a point in a continuous feature space (beat
+    density, energy and length - see music_manager.FEATURE_NAMES) rather
+    than in one of three moods, and picks the next snippet from the ones
+    nearest to a query point made from the typing rate.
+
+    Each feature is mapped to its rank in the library, and the typing rate to
+    its rank among the user's own windows, so that typing faster than 80% of
+    the time asks for music denser and more energetic than 80% of the
+    library. The nearest snippets are found with a KD-tree in O(log n), and
+    one of them is drawn with probability proportional to its feedback
+    weight, favouring the closest.
+
+    Snippets added while playing are searched by brute force, and removed
+    ones filtered out of the tree's results, until enough have changed for
+    the tree to be rebuilt.
+    """
+
+    def configure_parameters(self, beat_window_size, window_size):
+        self.beat_window_size = beat_window_size
+        self.window_size = window_size
+
+    def __init__(self, k=DEFAULT_K):
+        self.window = None
+        self.feedback = None
+        self.k = k
+        self.beat_window_size = None
+        self.window_size = None
+
+        # list of (snippet, [weight]), their moods and features, by position
+        # in the tree and then in the order they were added
+        self.snippets = []
+        self.moods = []
+        self.features = []
+        self.tree = None
+        # the sorted values of each feature over the library
+        self.sorted_features = []
+        # the library's low and high thresholds in beats per second
+        self.library_thresholds = None
+        # song -> positions of its snippets which have not been removed
+        self.song_indices = {}
+        # points of the snippets added since the tree was built, and the
+        # positions of those removed since
+        self.pending_points = []
+        self.removed = set()
+
+        # how many of the user's windows had each count
+        self.rate_histogram = FenwickTree([0.0] * (MAX_TRACKED_COUNT + 1))
+        self.last_observed = None
+
+        self.last_choice = None
+        self.last_selected = None
+        self.last_selected_index = None
+        self.last_choice_count = 0
+
+    def play_initial(self):
+        alive = [i for i in range(len(self.snippets)) if i not in self.removed]
+        low = [i for i in alive if self.moods[i] == 'low'] or alive
+        value = self.snippets[random.choice(low)]
+        return value[0]['song'], value[0]['start']
+
+    def feature_vector(self, snippet, mood, thresholds):
+        """
+        Returns the features of a snippet, approximating those of snippets
+        added before features were stored from their mood - adding the song
+        again computes the real ones.
+
+        :param thresholds: the library's low and high thresholds in beats per second
+        """
+        features = snippet.get('features')
+        if features is not None:
+            return [features[name] for name in FEATURE_NAMES]
+        low, high = thresholds
+        density = {'low': low / 2.0, 'mid': (low + high) / 2.0, 'high': high * 1.5}[mood]
+        return [density, 0.0, snippet['end'] - snippet['start']]
+
+    @staticmethod
+    def rank(sorted_values, values):
+        """
+        Returns the mid-rank of values among sorted_values, scaled to [0, 1]
+        """
+        if len(sorted_values) < 2:
+            return np.zeros(np.shape(values))
+        below = np.searchsorted(sorted_values, values, side='left')
+        at_or_below = np.searchsorted(sorted_values, values, side='right')
+        return np.clip((below + at_or_below - 1) / 2.0 / (len(sorted_values) - 1), 0.0, 1.0)
+
+    def configure_tracks(self, music_manager):
+        self.library_thresholds = (
+            music_manager.low_base_beat_threshold / music_manager.beat_interval_size,
+            music_manager.base_high_beat_threshold / music_manager.beat_interval_size,
+        )
+
+        self.snippets = []
+        self.moods = []
+        self.features = []
+        self.removed = set()
+        for mood, snippets in [
+            ('low', music_manager.slow_snippets),
+            ('mid', music_manager.base_snippets),
+            ('high', music_manager.fast_snippets),
+        ]:
+            for snippet in snippets:
+                self.snippets.append((snippet, [self.initial_weight(snippet)]))
+                self.moods.append(mood)
+                self.features.append(self.feature_vector(snippet, mood, self.library_thresholds))
+
+        self.last_selected = None
+        self.last_selected_index = None
+        self.build()
+
+    def build(self):
+        """
+        Drops the removed snippets and builds the KD-tree over the rest -
+        O(n log n)
+        """
+        if self.removed:
+            keep = [i for i in range(len(self.snippets)) if i not in self.removed]
+            if self.last_selected_index is not None:
+                positions = {index: position for position, index in enumerate(keep)}
+                self.last_selected_index = positions.get(self.last_selected_index)
+            self.snippets = [self.snippets[i] for i in keep]
+            self.moods = [self.moods[i] for i in keep]
+            self.features = [self.features[i] for i in keep]
+            self.removed = set()
+
+        features = np.array(self.features, dtype=float).reshape(-1, len(FEATURE_NAMES))
+        self.sorted_features = [np.sort(features[:, i]) for i in range(len(FEATURE_NAMES))]
+        self.tree = cKDTree(self.point(features))
+        self.pending_points = []
+
+        self.song_indices = {}
+        for index, (snippet, _) in enumerate(self.snippets):
+            self.song_indices.setdefault(snippet['song'], []).append(index)
+
+    def point(self, features):
+        """
+        Returns the points in the tree's space of rows of features
+        """
+        return np.column_stack([
+            self.rank(self.sorted_features[i], features[:, i]) for i in range(len(FEATURE_NAMES))
+        ]) * FEATURE_WEIGHTS
+
+    def update_tracks(self, added, removed):
+        # the ranks of the added snippets are against the library the tree
+        # was built from, until it is rebuilt
+        for song in removed:
+            self.removed.update(self.song_indices.pop(song, []))
+        for mood, snippet in added:
+            self.song_indices.setdefault(snippet['song'], []).append(len(self.snippets))
+            self.snippets.append((snippet, [self.initial_weight(snippet)]))
+            self.moods.append(mood)
+            self.features.append(self.feature_vector(snippet, mood, self.library_thresholds))
+            self.pending_points.append(self.point(np.array([self.features[-1]], dtype=float))[0])
+
+        changes = len(self.pending_points) + len(self.removed)
+        if changes > max(REBUILD_MIN_CHANGES, REBUILD_FRACTION * self.tree.n):
+            self.build()
+
+    def nearest(self, point, k):
+        """
+        Returns the distances to and positions of the k nearest snippets
+        which have not been removed, nearest first
+        """
+        # enough from the tree that k are left once the removed are dropped
+        tree_k = min(k + len(self.removed), self.tree.n)
+        if tree_k > 0:
+            distances, indices = self.tree.query(point, k=tree_k)
+            distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+        else:
+            distances, indices = np.zeros(0), np.zeros(0, dtype=int)
+
+        if self.pending_points:
+            distances = np.concatenate([
+                distances, np.linalg.norm(np.array(self.pending_points) - point, axis=1)
+            ])
+            indices = np.concatenate([
+                indices, np.arange(self.tree.n, self.tree.n + len(self.pending_points))
+            ])
+            order = np.argsort(distances, kind='stable')
+            distances, indices = distances[order], indices[order]
+
+        if self.removed:
+            alive = np.array([int(i) not in self.removed for i in indices], dtype=bool)
+            distances, indices = distances[alive], indices[alive]
+        return distances[:k], indices[:k]
+
+    def typing_rank(self, rate):
+        """
+        Returns the fraction of the user's windows with fewer keystrokes than
+        rate, counting those with the same number as half - O(log n)
+        """
+        total = self.rate_histogram.total()
+        if total == 0.0:
+            return 0.5
+        count = min(int(rate), MAX_TRACKED_COUNT)
+        below = self.rate_histogram.prefix_sum(count)
+        at = self.rate_histogram.weights[count]
+        return (below + at * (rate - count)) / total
+
+    def query_point(self, rate):
+        rank = self.typing_rank(rate)
+        # the next change is a window away, so the snippet should last that long
+        length = self.window_size * self.beat_window_size if self.window_size else 0.0
+        return np.array([rank, rank, self.rank(self.sorted_features[2], length)]) * FEATURE_WEIGHTS
+
+    def prepare_next(self, times, counts):
+        if len(times) > 0 and times[-1] != self.last_observed:
+            self.last_observed = times[-1]
+            count = int(counts[-1])
+            if count >= MIN_ACTIVE_COUNT:
+                count = min(count, MAX_TRACKED_COUNT)
+                self.rate_histogram.set(count, self.rate_histogram.weights[count] + 1.0)
+        return None
+
+    def change_music(self, times, counts, repeated=False):
+        counts = np.asarray(counts, dtype=float)
+        if self.window is not None:
+            count_mean = self.window.mean()
+        else:
+            count_mean = counts.mean()
+
+        if count_mean < 2.0:
+            rate = 0.0
+        else:
+            # the newer windows count for more, as in FixedBeatChanger
+            rate = float(np.average(counts, weights=1.1 ** np.arange(len(counts))))
+
+        distances, indices = self.nearest(self.query_point(rate), self.k)
+        neighbours = len(indices)
+        if neighbours == 0:
+            # every snippet has been removed
+            return None
+
+        print('next music from the {} snippets nearest a rate of {:.1f} (rank {:.2f})'.format(
+            neighbours, rate, self.typing_rank(rate)
+        ))
+
+        if repeated:
+            print('INFO: Song was repeated')
+        current = self.last_selected_index
+        if current is not None and current in indices and self.last_choice_count < MAX_REPEAT_COUNT and not repeated:
+            # the playing snippet still fits the typing
+            self.last_choice_count += 1
+            return None
+
+        # closer snippets are favoured, on a scale set by the furthest one
+        scale = max(distances[-1], 1e-6)
+        weights = np.array([self.snippets[i][1][0] for i in indices]) * np.exp(-(distances / scale) ** 2)
+        if current is not None and len(indices) > 1:
+            weights[indices == current] = 0.0
+        if weights.sum() <= 0.0:
+            weights = np.ones(len(indices))
+
+        cumulative = np.cumsum(weights)
+        position = min(int(np.searchsorted(cumulative, random.random() * cumulative[-1], side='right')),
+                       len(indices) - 1)
+        index = int(indices[position])
+
+        self.last_choice = self.moods[index]
+        self.last_choice_count = 0
+        self.last_selected = self.snippets[index]
+        self.last_selected_index = index
+        print('song priority: ', self.last_selected[1][0], self.last_selected[0]['song'])
+
+        return self.last_selected[0]['song'], self.last_selected[0]['start']
+
+    def notify_event(self, event):
+
+        if self.last_selected is not None:
+            if event == 'good':
+                self.last_selected[1][0] = min(max(0.0, self.last_selected[1][0] + 1.0), 40.0)
+            else:
+                self.last_selected[1][0] = min(max(0.0, self.last_selected[1][0] - 1.0), 40.0)
+            self.record_weight(self.last_selected[0], self.last_selected[1][0])
@@ -0,0 +1,347 @@
+import os
+import socket
+import struct
+import zlib
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from beat_bus import BeatBus
+
+DEFAULT_PORT = 47315
+
+# magic, version, sender id, sequence number, window start (on the sender's
+# clock), window size, keystroke count - 29 bytes, and never any keys
+PACKET = struct.Struct('!4sBIIdfI')
+PACKET_MAGIC = b'GOPB'
+PACKET_VERSION = 1
+
+# host id used for the windows of the receiver's own keyboard
+LOCAL_HOST = 0
+# sequence numbers wrap around at 2 ** 32 - one less than half of that ahead
+# of the highest seen is newer, anything else older
+SEQUENCE_MODULUS = 1 << 32
+
+
+def default_host_id():
+    # 0 is reserved for the receiver's own keyboard
+    return zlib.crc32('{}:{}'.format(socket.gethostname(), os.getpid()).encode('utf-8')) or 1
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    """
+    Parses 'host:port', 'host' or ':port' into a (host, port) tuple
+    """
+    host, separator, port = address.rpartition(':')
+    if not separator:
+        host, port = address, ''
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+class BeatSender:
+    """
+    Sends the (count, time) windows read from a queue to a BeatReceiver on
+    another machine as UDP datagrams, one per window. Events are not sent.
+    """
+
+    def __init__(self, beat_queue, address, window_size, host_id=None):
+        """
+        :param beat_queue: queue of windows, such as a subscription to the keyboard detector's bus
+        :param address: (host, port) of the receiver
+        """
+        self.beat_queue = beat_queue
+        self.address = address
+        self.window_size = window_size
+        self.host_id = host_id or default_host_id()
+        self.sequence = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def send(self, count, start):
+        packet = PACKET.pack(
+            PACKET_MAGIC, PACKET_VERSION, self.host_id, self.sequence, start, self.window_size, count
+        )
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        try:
+            self.socket.sendto(packet, self.address)
+        except OSError as e:
+            # the receiver may not be up yet - the window is simply lost
+            print('INFO: Could not send window to {}: {}'.format(self.address, e))
+
+    def _run(self):
+        while True:
+            next_item = self.beat_queue.get()
+            if isinstance(next_item, tuple):
+                (count, start) = next_item
+                self.send(count, start)
+            self.beat_queue.task_done()
+
+
+class BeatMerger:
+    """
+    Merges the windows of several hosts into one stream of (count, time)
+    windows on the local clock, published on a BeatBus.
+
+    Each host's clock offset is estimated from the lower envelope of
+    (arrival time - window end), so that clock skew and network delay are
+    both absorbed; windows are then snapped to the nearest slot of a shared
+    grid. A slot is published once lateness seconds have passed since it
+    closed, after which any window still arriving for it is dropped.
+    """
+
+    def __init__(self, window_size, lateness=None, clock=monotonic, bus=None, drift=0.05):
+        """
+        :param lateness: seconds to wait for windows after a slot closes - by
+                         default three quarters of a window, as a remote window
+                         can end up to half a window after the slot it is
+                         snapped to
+        :param clock: the local clock, which the local windows are timed on
+        :param drift: how quickly a host's offset estimate rises towards
+                      later samples, following clock drift
+        """
+        self.window_size = window_size
+        self.lateness = 0.75 * window_size if lateness is None else lateness
+        self.clock = clock
+        if bus is None:
+            bus = BeatBus()
+        self.bus = bus
+        self.drift = drift
+
+        self.lock = Lock()
+        # grid start, and the index of the next slot to publish
+        self.origin = None
+        self.next_slot = None
+        # slot -> {host: count}
+        self.pending = {}
+        # host -> estimated offset of its clock from the local one
+        self.offsets = {LOCAL_HOST: 0.0}
+
+        # counters, readable through stats()
+        self.accepted = 0
+        self.late = 0
+        self.duplicates = 0
+        self.early = 0
+
+    def add(self, host, start, count, now=None):
+        """
+        Adds a window from the given host, with its start on that host's clock.
+
+        :return: whether the window was accepted
+        """
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            offset = self._update_offset(host, now - (start + self.window_size))
+            local_start = start + offset
+            if self.origin is None:
+                self.origin = local_start
+                self.next_slot = 0
+
+            slot = int(round((local_start - self.origin) / self.window_size))
+            if slot < self.next_slot:
+                self.late += 1
+                return False
+            if local_start > now + self.window_size:
+                # can only be a host whose offset estimate is still settling
+                self.early += 1
+                return False
+
+            counts = self.pending.setdefault(slot, {})
+            if host in counts:
+                self.duplicates += 1
+                return False
+            counts[host] = count
+            self.accepted += 1
+        return True
+
+    def _update_offset(self, host, sample):
+        if host == LOCAL_HOST:
+            return 0.0
+        offset = self.offsets.get(host)
+        if offset is None or sample < offset:
+            offset = sample
+        else:
+            offset += self.drift * (sample - offset)
+        self.offsets[host] = offset
+        return offset
+
+    def flush(self, now=None):
+        """
+        Publishes every slot which closed more than lateness seconds ago -
+        including those no host sent a window for
+        """
+        if now is None:
+            now = self.clock()
+        windows = []
+        with self.lock:
+            if self.origin is None:
+                return
+            while self.origin + (self.next_slot + 1) * self.window_size + self.lateness <= now:
+                counts = self.pending.pop(self.next_slot, {})
+                windows.append((sum(counts.values()), self.origin + self.next_slot * self.window_size))
+                self.next_slot += 1
+        for window in windows:
+            self.bus.publish(window)
+
+    def next_deadline(self):
+        with self.lock:
+            if self.origin is None:
+                return None
+            return self.origin + (self.next_slot + 1) * self.window_size + self.lateness
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hosts': len(self.offsets) - 1,
+                'accepted': self.accepted,
+                'late': self.late,
+                'duplicates': self.duplicates,
+                'early': self.early,
+                'pending': len(self.pending),
+            }
+
+
+class _LocalStream:
+    """
+    Queue-like sink feeding the local keyboard's windows into a BeatMerger,
+    for attaching to the keyboard detector's bus. Events go straight through.
+    """
+
+    def __init__(self, merger):
+        self.merger = merger
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, tuple):
+            (count, start) = item
+            self.merger.add(LOCAL_HOST, start, count)
+            self.merger.flush()
+        else:
+            self.merger.bus.publish(item)
+
+    def qsize(self):
+        return 0
+
+
+class BeatReceiver:
+    """
+    Listens for the windows of BeatSenders on a UDP port, merging them with
+    the local keyboard's windows into its bus.
+
+    The senders' sequence numbers tell the windows lost on the way (the
+    numbers never received below the highest one of the host), reordered
+    (received after a higher one) and duplicated - duplicates are dropped.
+    """
+
+    def __init__(self, window_size, port=DEFAULT_PORT, host='0.0.0.0', lateness=None, clock=monotonic):
+        self.merger = BeatMerger(window_size, lateness=lateness, clock=clock)
+        self.bus = self.merger.bus
+        self.window_size = window_size
+        self.malformed = 0
+        # host -> [first sequence number, highest, number of packets received],
+        # with the sequence numbers unwrapped - guarded by lock, as stats are
+        # read from other threads
+        self.lock = Lock()
+        self.sequences = {}
+        self.reordered = 0
+        self.duplicates = 0
+        self.closed = Event()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.address = self.socket.getsockname()
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def local_stream(self):
+        return _LocalStream(self.merger)
+
+    def _run(self):
+        buffer = bytearray(PACKET.size)
+        clock = self.merger.clock
+        while not self.closed.is_set():
+            # wake up in time to publish the next slot even if nothing arrives
+            deadline = self.merger.next_deadline()
+            timeout = self.window_size if deadline is None else deadline - clock()
+            try:
+                self.socket.settimeout(min(max(timeout, 0.001), self.window_size))
+                size, _ = self.socket.recvfrom_into(buffer)
+            except socket.timeout:
+                size = 0
+            except OSError:
+                if self.closed.is_set():
+                    return
+                raise
+
+            if size:
+                self._handle_packet(buffer, size)
+            self.merger.flush()
+
+    def _handle_packet(self, buffer, size):
+        if size != PACKET.size:
+            self.malformed += 1
+            return
+        magic, version, host_id, sequence, start, window_size, count = PACKET.unpack_from(buffer)
+        if magic != PACKET_MAGIC or version != PACKET_VERSION or host_id == LOCAL_HOST:
+            self.malformed += 1
+            return
+        if abs(window_size - self.window_size) > 1e-3:
+            # counts over other window sizes cannot be merged
+            self.malformed += 1
+            return
+        with self.lock:
+            fresh = self._track_sequence(host_id, sequence)
+        if not fresh:
+            return
+        self.merger.add(host_id, start, count)
+
+    def _track_sequence(self, host, sequence):
+        """
+        :return: False if the packet is a duplicate
+        """
+        state = self.sequences.get(host)
+        if state is None:
+            self.sequences[host] = [sequence, sequence, 1]
+            return True
+
+        first, highest, received = state
+        ahead = (sequence - highest) % SEQUENCE_MODULUS
+        if ahead == 0:
+            self.duplicates += 1
+            return False
+        if ahead < SEQUENCE_MODULUS // 2:
+            state[1] = highest + ahead
+        else:
+            # older than the highest - a duplicate of an older packet is
+            # counted as reordered, as telling them apart would mean keeping
+            # every number seen
+            self.reordered += 1
+        state[2] = received + 1
+        return True
+
+    def lost(self):
+        """
+        Returns the number of windows never received, of those numbered up
+        to the highest received from each host
+        """
+        with self.lock:
+            return sum(
+                max(highest - first + 1 - received, 0) for first, highest, received in self.sequences.values()
+            )
+
+    def stats(self):
+        stats = self.merger.stats()
+        stats['malformed'] = self.malformed
+        stats['lost'] = self.lost()
+        with self.lock:
+            stats['reordered'] = self.reordered
+            stats['duplicate_packets'] = self.duplicates
+        return stats
+
+    def close(self):
+        self.closed.set()
+        self.socket.close()
+        self.runner.join()
@@ -0,0 +1,125 @@
+import asyncio
+from collections import OrderedDict
+from itertools import count
+from subprocess import call
+from threading import Condition, Thread
+
+
+def send_notification(msg):
+    """
+    Sends the provided message as a notification
+    :param msg: message to print in notification
+    """
+    call(['notify-send', msg])
+
+
+async def send_notification_async(msg):
+    """
+    Sends the provided message as a notification without blocking the event loop
+    :param msg: message to print in notification
+    """
+    process = await asyncio.create_subprocess_exec('notify-send', msg)
+    await process.wait()
+
+
+class NotificationDispatcher:
+    """
+    Runs notifications and other side effects on a background thread, so
+    that the caller never waits on them.
+
+    Side effects submitted with the same key are coalesced - only the most
+    recent one is run (e.g. only the latest 'Playing X' matters). At most
+    maxsize side effects are held at once, beyond which the oldest pending
+    one is dropped.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.condition = Condition()
+        self.pending = OrderedDict()
+        self.keys = count()
+        self.closed = False
+
+        # counters, readable through stats()
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def dispatch(self, func, *args, key=None):
+        """
+        Schedules func(*args) to be run on the dispatcher thread.
+
+        :param key: side effects sharing a key replace each other while pending
+        """
+        with self.condition:
+            if self.closed:
+                return
+
+            self.submitted += 1
+            if key is None:
+                key = ('unique', next(self.keys))
+            elif key in self.pending:
+                del self.pending[key]
+                self.coalesced += 1
+
+            while len(self.pending) >= self.maxsize:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+
+            self.pending[key] = (func, args)
+            self.condition.notify()
+
+    def notify(self, msg, key=None):
+        """
+        Schedules a desktop notification with the given message
+        """
+        self.dispatch(send_notification, msg, key=key)
+
+    def depth(self):
+        with self.condition:
+            return len(self.pending)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'depth': len(self.pending),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def close(self, timeout=None):
+        """
+        Stops the dispatcher once the pending side effects have run
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.runner.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                _, (func, args) = self.pending.popitem(last=False)
+
+            try:
+                func(*args)
+            except Exception as e:
+                print('INFO: Side effect {} failed: {}'.format(getattr(func, '__name__', func), e))
+                with self.condition:
+                    self.failed += 1
+            else:
+                with self.condition:
+                    self.completed += 1
@@ -0,0 +1,130 @@
+import time
+from abc import ABC, abstractmethod
+
+
+class BasePlaybackBackend(ABC):
+
+    # if set, called with the song filename and the time.monotonic() time at
+    # which a song requested through play actually began to be heard
+    on_audible = None
+
+    def report_audible(self, song, timestamp=None):
+        if self.on_audible is not None:
+            self.on_audible(song, time.monotonic() if timestamp is None else timestamp)
+
+    @abstractmethod
+    def play(self, song, position=None, length=None, callback=None):
+        """
+        Begins playback of a song, crossfading out whatever is currently
+        playing.
+
+        :param song: filename of the song to be played
+        :param position: offset in seconds into the song to start playback
+        :param length: length of the song in seconds, if known
+        :param callback: called with the song filename when playback reaches
+                         the end of the song (but not when it is replaced)
+        """
+        pass
+
+    def preload(self, song, position=None, length=None):
+        """
+        Prepares a song which is likely to be played next, so that a later
+        play of the same song and position starts without delay. Only a
+        hint - backends which cannot prepare songs ahead ignore it.
+        """
+        pass
+
+    @abstractmethod
+    def stop(self):
+        """
+        Fades out the current song without starting another one.
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        """
+        Stops playback and releases all resources held by the backend.
+        """
+        pass
+
+    def playback_threads(self):
+        """
+        Returns the number of live threads the backend plays songs on, for
+        monitoring - those it started itself, and those of its audio stream
+        """
+        return 0
+
+    async def run_async(self):
+        """
+        Drives the backend from an asyncio event loop. Backends which manage
+        their own threads need not override this.
+        """
+        pass
+
+
+class NullBackend(BasePlaybackBackend):
+    """
+    Backend which plays nothing, but keeps track of what would be playing and
+    when it would end. It has no thread of its own - its owner calls advance
+    with the current time to fire the end-of-song callbacks, which makes it
+    suitable for driving from a fake clock.
+    """
+
+    def __init__(self, clock, fade_out=3):
+        """
+        :param clock: function returning the current time in seconds
+        :param fade_out: number of seconds before the end of a song at which
+                         its callback fires, as with the audible backends
+        """
+        self.clock = clock
+        self.fade_out = fade_out
+
+        self.song = None
+        self.position = None
+        self.callback = None
+        self.end_time = None
+        self.history = []
+
+        self.preloaded = None
+        self.preloads = 0
+        # plays of the preloaded song
+        self.preload_hits = 0
+
+    def preload(self, song, position=None, length=None):
+        self.preloaded = (song, position or 0)
+        self.preloads += 1
+
+    def play(self, song, position=None, length=None, callback=None):
+        now = self.clock()
+        if self.preloaded == (song, position or 0):
+            self.preload_hits += 1
+            self.preloaded = None
+        self.song = song
+        self.position = position or 0
+        self.callback = callback
+        self.end_time = None
+        if length is not None:
+            self.end_time = now + max(length - self.position, 0)
+        self.history.append((now, song, self.position))
+        self.report_audible(song)
+
+    def stop(self):
+        self.song = None
+        self.callback = None
+        self.end_time = None
+
+    def close(self):
+        self.stop()
+
+    def advance(self, now):
+        """
+        Fires the callback of the current song if it would have started
+        fading out by the given time.
+        """
+        if self.end_time is not None and now >= self.end_time - self.fade_out:
+            callback, song = self.callback, self.song
+            self.callback = None
+            self.end_time = None
+            if callback is not None:
+                callback(song)
@@ -0,0 +1,123 @@
+from fixed_beat_changer import FixedBeatChanger, MAX_REPEAT_COUNT
+
+# smoothing factors of the level and trend of the typing rate
+DEFAULT_ALPHA = 0.5
+DEFAULT_BETA = 0.3
+# number of windows ahead the typing rate is forecast
+DEFAULT_HORIZON = 3
+# fraction of the window the player waits between changes
+CHANGE_FRACTION = 0.25
+
+
+class PredictiveBeatChanger(FixedBeatChanger):
+    """
+    Forecasts the typing rate a few windows ahead with Holt's linear trend
+    method (an exponentially smoothed level and trend, updated in O(1) per
+    window), and picks the mood from the forecast rather than from the past
+    window.
+
+    As soon as the forecast points at a different mood, the snippet to
+    switch to is chosen and handed to the player to preload, so that the
+    switch itself is an immediate crossfade. Changes are also allowed after
+    a quarter of the window rather than the whole of it.
+    """
+
+    def __init__(self, alpha=DEFAULT_ALPHA, beta=DEFAULT_BETA, horizon=DEFAULT_HORIZON, thresholds=None):
+        super().__init__(thresholds=thresholds)
+        self.alpha = alpha
+        self.beta = beta
+        self.horizon = horizon
+
+        self.level = None
+        self.trend = 0.0
+        self.last_time = None
+
+        # (predicted mood, (mood, index)) of the snippet chosen ahead of the next change
+        self.pending = None
+        self.windows_in_choice = 0
+
+    def change_interval(self, window_size):
+        return max(int(window_size * CHANGE_FRACTION), 1)
+
+    def update(self, count):
+        """
+        Adds the count of a new window to the level and trend
+        """
+        if self.level is None:
+            self.level = float(count)
+            return
+        previous = self.level
+        self.level = self.alpha * count + (1 - self.alpha) * (self.level + self.trend)
+        self.trend = self.beta * (self.level - previous) + (1 - self.beta) * self.trend
+
+    def forecast(self, horizon=None):
+        if self.level is None:
+            return None
+        return max(self.level + (self.horizon if horizon is None else horizon) * self.trend, 0.0)
+
+    def predicted_mood(self):
+        forecast = self.forecast()
+        if forecast is None:
+            return None
+        if forecast > self.high_threshold:
+            return 'high'
+        if forecast > self.mid_threshold:
+            return 'mid'
+        return 'low'
+
+    def prepare_next(self, times, counts):
+        super().prepare_next(times, counts)
+        if len(times) == 0 or times[-1] == self.last_time:
+            return None
+        self.last_time = times[-1]
+        self.update(counts[-1])
+        self.windows_in_choice += 1
+
+        mood = self.predicted_mood()
+        # the current mood is picked again once it goes stale
+        going_stale = self.windows_in_choice >= self.window_size + MAX_REPEAT_COUNT
+        if mood == self.last_choice and not going_stale:
+            return None
+        if self.pending is not None and self.pending[0] == mood:
+            return None
+
+        drawn = self.draw(self.last_choice, mood)
+        if drawn is None:
+            return None
+        self.pending = (mood, drawn)
+        snippet = self.tracks[drawn[0]][drawn[1]][0]
+        return snippet['song'], snippet['start']
+
+    def change_music(self, times, counts, repeated=False):
+        choice = self.predicted_mood() or 'low'
+        print('next music choice is {} from {} (forecast: {}, trend: {})'.format(
+            choice, self.last_choice, self.forecast(), self.trend
+        ))
+
+        if repeated:
+            print('INFO: Song was repeated')
+
+        # as with FixedBeatChanger, a mood is moved on from after the window
+        # has been replaced and MAX_REPEAT_COUNT more windows
+        stale = self.windows_in_choice > self.window_size + MAX_REPEAT_COUNT
+        if choice == self.last_choice and not stale and not repeated:
+            return None
+
+        previous = self.last_choice
+        self.last_choice = choice
+        self.windows_in_choice = 0
+
+        if self.pending is not None and self.pending[0] == choice and not self.index.is_removed(*self.pending[1]):
+            # the snippet the backend has been preparing
+            drawn = self.pending[1]
+        else:
+            drawn = self.draw(previous, choice)
+        self.pending = None
+        if drawn is None:
+            # every song has been removed from the library
+            return None
+
+        mood, index = drawn
+        self.last_selected = self.tracks[mood][index]
+        self.last_selected_index = drawn
+        return self.last_selected[0]['song'], self.last_selected[0]['start']
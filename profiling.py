@@ -0,0 +1,186 @@
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from threading import Event, Thread
+
+# comma separated profiling modes to turn on - any of cprofile, tracemalloc
+# and sample. Nothing is profiled when unset.
+PROFILE = os.environ.get('TYPE_MUSIC_PROFILE', '')
+# directory the profiles are written to
+PROFILE_DIR = os.environ.get('TYPE_MUSIC_PROFILE_DIR', '.')
+# seconds between stack samples in the sample mode
+PROFILE_INTERVAL = float(os.environ.get('TYPE_MUSIC_PROFILE_INTERVAL', 0.01))
+# seconds between writing the tracemalloc and sample profiles while running,
+# or 0 to only write them on exit
+PROFILE_DUMP_INTERVAL = float(os.environ.get('TYPE_MUSIC_PROFILE_DUMP_INTERVAL', 0))
+# number of functions and allocation sites listed in the text summaries
+PROFILE_TOP = int(os.environ.get('TYPE_MUSIC_PROFILE_TOP', 30))
+# frames kept for each allocation in the tracemalloc mode
+PROFILE_FRAMES = int(os.environ.get('TYPE_MUSIC_PROFILE_FRAMES', 10))
+
+PROFILE_MODES = ('cprofile', 'tracemalloc', 'sample')
+
+
+class Profiler:
+    """
+    Profiles the process in any of the PROFILE_MODES, writing to directory:
+
+    - cprofile: <name>-<pid>.pstats, loadable with pstats or snakeviz, and a
+      summary of the slowest functions in <name>-<pid>.pstats.txt. Only the
+      thread which started the profiler is profiled.
+    - tracemalloc: a snapshot in <name>-<pid>.tracemalloc, loadable with
+      tracemalloc.Snapshot.load, and the top allocation sites in
+      <name>-<pid>.tracemalloc.txt
+    - sample: the stacks of every thread, sampled every interval seconds,
+      in the collapsed format read by flamegraph.pl and speedscope in
+      <name>-<pid>.collapsed. Samples are of wall-clock time, so threads
+      waiting on a lock or a queue are included.
+
+    The cprofile profile is written when the profiler is stopped, the others
+    also every dump_interval seconds if it is not 0.
+    """
+
+    def __init__(self, name, modes, directory=PROFILE_DIR, interval=PROFILE_INTERVAL,
+                 dump_interval=PROFILE_DUMP_INTERVAL, top=PROFILE_TOP):
+        for mode in modes:
+            if mode not in PROFILE_MODES:
+                raise ValueError('Unknown profiling mode {} - should be one of: {}'.format(
+                    mode, ', '.join(PROFILE_MODES)
+                ))
+
+        self.modes = set(modes)
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.top = top
+
+        directory = Path(directory).expanduser()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.prefix = str(directory / '{}-{}'.format(name, os.getpid()))
+
+        self.profile = None
+        # collapsed stack -> number of samples
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = Event()
+        self.runner = None
+
+    def start(self):
+        if 'tracemalloc' in self.modes:
+            tracemalloc.start(PROFILE_FRAMES)
+
+        if 'sample' in self.modes or (self.dump_interval > 0 and 'tracemalloc' in self.modes):
+            self.runner = Thread(target=self._run, name='profiler', daemon=True)
+            self.runner.start()
+
+        if 'cprofile' in self.modes:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+
+        if self.profile is not None:
+            self.profile.disable()
+        if self.runner is not None:
+            self.runner.join()
+
+        # before the cprofile summary, whose allocations would be in the snapshot
+        self.dump()
+        if 'tracemalloc' in self.modes:
+            tracemalloc.stop()
+
+        if self.profile is not None:
+            self.profile.dump_stats(self.prefix + '.pstats')
+
+            summary = io.StringIO()
+            pstats.Stats(self.profile, stream=summary).sort_stats('cumulative').print_stats(self.top)
+            with open(self.prefix + '.pstats.txt', 'w') as raw_file:
+                raw_file.write(summary.getvalue())
+        print('INFO: Wrote {} profiles to {}.*'.format(', '.join(sorted(self.modes)), self.prefix))
+
+    def _run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        interval = self.interval if 'sample' in self.modes else self.dump_interval
+        while not self.stopped.wait(interval):
+            if 'sample' in self.modes:
+                self.sample()
+            if self.dump_interval > 0 and time.monotonic() >= next_dump:
+                self.dump()
+                next_dump += self.dump_interval
+
+    def sample(self):
+        """
+        Records the stack of every thread but the profiler's own
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def dump(self):
+        """
+        Writes the tracemalloc and sample profiles
+        """
+        if 'sample' in self.modes:
+            with open(self.prefix + '.collapsed', 'w') as raw_file:
+                for stack, count in sorted(self.stacks.items()):
+                    raw_file.write('{} {}\n'.format(stack, count))
+
+        if 'tracemalloc' in self.modes and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            snapshot.dump(self.prefix + '.tracemalloc')
+
+            current, peak = tracemalloc.get_traced_memory()
+            with open(self.prefix + '.tracemalloc.txt', 'w') as raw_file:
+                raw_file.write('Traced memory: {:.1f}KiB, peak {:.1f}KiB\n\n'.format(current / 1024, peak / 1024))
+                for statistic in snapshot.statistics('lineno')[:self.top]:
+                    raw_file.write('{}\n'.format(statistic))
+
+
+def profile_from_environment(name):
+    """
+    Starts a Profiler with the modes in TYPE_MUSIC_PROFILE, which is stopped
+    and written out when the process exits - including on SIGTERM.
+
+    :param name: the start of the profiles' file names, e.g. the script
+    :return: the Profiler, or None if profiling is off
+    """
+    modes = [mode.strip() for mode in PROFILE.split(',') if mode.strip()]
+    if not modes:
+        return None
+
+    profiler = Profiler(name, modes)
+    profiler.start()
+    atexit.register(profiler.stop)
+
+    # the default SIGTERM handler skips atexit
+    if threading.current_thread() is threading.main_thread() and \
+            signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    print('INFO: Profiling {} with {}'.format(name, ', '.join(sorted(profiler.modes))))
+    return profiler
@@ -2,48 +2,70 @@ import random
 
 import numpy as np
 from beat_changer import BaseBeatChanger
+from transition_index import IndexedTracksMixin
 
 
 
 BASE_HIGH_RATIO = 1.56
 BASE_MID_RATIO = 0.96
 
+# bounds of a snippet's weight
+MIN_WEIGHT = 0.0
+MAX_WEIGHT = 3.0
 
-class RatioBeatChanger(BaseBeatChanger):
+
+class RatioBeatChanger(IndexedTracksMixin, BaseBeatChanger):
+    """
+    Picks the mood from how the windows compare to the mean of the whole
+    window - so it adapts to the user's own typing speed, where
+    FixedBeatChanger uses absolute thresholds.
+    """
 
     def configure_parameters(self, beat_window_size, window_size):
         self.beat_window_size = beat_window_size
         self.window_size = window_size
 
     def __init__(self):
+        self.window = None
+        self.feedback = None
+
         self.low_tracks = []
         self.high_tracks = []
         self.medium_tracks = []
 
+        # mood -> list of (snippet, [weight]), and the samplers over them
+        self.tracks = {}
+        self.index = None
+
         self.last_choice = None
         self.last_selected = None
+        self.last_selected_index = None
 
     def play_initial(self):
         value = random.choice(self.low_tracks)
         return value[0]['song'], value[0]['start']
 
-    def change_music(self, times, counts):
-        count_mean = np.array(counts).mean()
+    def classify(self, counts, count_mean):
+        """
+        Returns the number of (low, mid, high) windows relative to the mean
+        """
+        counts = np.asarray(counts)
+        high = int(np.count_nonzero(counts > count_mean * BASE_HIGH_RATIO))
+        mid = int(np.count_nonzero(counts > count_mean * BASE_MID_RATIO)) - high
+        return len(counts) - mid - high, mid, high
+
+    def change_music(self, times, counts, repeated=False):
+        if self.window is not None:
+            count_mean = self.window.mean()
+        else:
+            count_mean = np.array(counts).mean()
 
         choice = None
 
         if count_mean < 2.0:
             choice = 'low'
         else:
-            low, mid, high = 0, 0, 0
-
-            for time, count in zip(times, counts):
-                if count > count_mean * BASE_HIGH_RATIO:
-                    high += 1
-                elif count > count_mean * BASE_MID_RATIO:
-                    mid += 1
-                else:
-                    low += 1
+            low, mid, high = self.classify(counts, count_mean)
 
             if high > mid and high > low:
                 choice = 'high'
@@ -53,33 +75,19 @@ class RatioBeatChanger(BaseBeatChanger):
                 choice = 'low'
 
         print('next music choice is {} from {}'.format(choice, self.last_choice))
-        if choice != self.last_choice:
+        if choice != self.last_choice or repeated:
+            previous = self.last_choice
             self.last_choice = choice
 
-            list = None
-            if choice == 'high':
-                list = self.high_tracks
-            elif choice == 'mid':
-                list = self.medium_tracks
-            else:
-                list = self.low_tracks
-
-            counter = {}
-            for (song, score) in list:
-                counter.setdefault(song, 0)
-                counter[song] += 1
-
-            total_score = sum(i[1]/counter[i[0]] for i in list)
-            choice = total_score * np.random.uniform(0, 1)
-
-            index = 0
-            partial_choice = 0
-            while index < len(list) - 1 and partial_choice < choice:
-                partial_choice += list[index][1] / counter[list[index][0]]
-                index += 1
-            index = min(max(0, index), len(list) - 1)
-
-            self.last_selected = list[index]
+            # each song is equally likely before weighting - a song with many
+            # snippets of the mood is no more likely than one with a single one
+            drawn = self.draw(previous, choice)
+            if drawn is None:
+                # every song has been removed from the library
+                return None
+            mood, index = drawn
+            self.last_selected = self.tracks[mood][index]
+            self.last_selected_index = drawn
 
             return self.last_selected[0]['song'], self.last_selected[0]['start']
         else:
@@ -90,11 +98,7 @@ class RatioBeatChanger(BaseBeatChanger):
 
         if self.last_selected is not None:
             if event == 'good':
-                self.last_selected[1] = max(min(0.0, self.last_selected[1] + 0.1), 3.0)
+                weight = min(max(MIN_WEIGHT, self.last_selected[1][0] + 0.1), MAX_WEIGHT)
             else:
-                self.last_selected[1] = max(min(0.0, self.last_selected[1] - 0.1), 3.0)
-
-    def configure_tracks(self, music_manager):
-        self.medium_tracks = [(i, 1.0) for i in music_manager.base_snippets]
-        self.low_tracks = [(i, 1.0) for i in music_manager.slow_snippets]
-        self.high_tracks = [(i, 1.0) for i in music_manager.fast_snippets]
+                weight = min(max(MIN_WEIGHT, self.last_selected[1][0] - 0.1), MAX_WEIGHT)
+            self.set_selected_weight(weight)
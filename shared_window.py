@@ -0,0 +1,213 @@
+import atexit
+
+import numpy as np
+
+from typing_window import BASE_HIGH, BASE_MID, TypingWindow
+
+SHARED_MEMORY_ENABLED = True
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # only available from python 3.8
+    SHARED_MEMORY_ENABLED = False
+    print("INFO: Could not load multiprocessing.shared_memory, the visualizer can only run in-process.")
+
+# header layout - int64 fields followed by float64 fields
+_VERSION, _START, _LENGTH, _PUSHES = range(4)
+_MID_THRESHOLD, _HIGH_THRESHOLD = range(2)
+_HEADER_INTS = 4
+_HEADER_FLOATS = 2
+_HEADER_BYTES = 8 * (_HEADER_INTS + _HEADER_FLOATS)
+
+
+def _layout(buffer, capacity):
+    """
+    Maps the header and the mirrored ring arrays of a window of the given
+    capacity onto a buffer.
+    """
+    ints = np.ndarray((_HEADER_INTS,), dtype=np.int64, buffer=buffer, offset=0)
+    floats = np.ndarray((_HEADER_FLOATS,), dtype=np.float64, buffer=buffer, offset=8 * _HEADER_INTS)
+    offset = _HEADER_BYTES
+    arrays = []
+    for dtype in (np.float64, np.float64, np.float64, np.int8):
+        arrays.append(np.ndarray((2 * capacity,), dtype=dtype, buffer=buffer, offset=offset))
+        offset += 2 * capacity * np.dtype(dtype).itemsize
+    return ints, floats, arrays
+
+
+def _size(capacity):
+    return _HEADER_BYTES + 2 * capacity * (8 * 3 + 1)
+
+
+class SharedTypingWindow(TypingWindow):
+    """
+    TypingWindow whose ring lives in a multiprocessing.shared_memory block so
+    that another process can read it without any locking or copying through
+    pipes.
+
+    Writes are guarded by a sequence counter (a seqlock): it is odd while a
+    write is in progress, and a reader retries if the counter was odd or
+    changed while it was copying.
+    """
+
+    def __init__(self, capacity, mid_threshold=BASE_MID, high_threshold=BASE_HIGH, **kwargs):
+        if not SHARED_MEMORY_ENABLED:
+            raise ValueError('multiprocessing.shared_memory is not available.')
+        self.shm = shared_memory.SharedMemory(create=True, size=_size(capacity))
+        self.name = self.shm.name
+        self._header, self._thresholds, _ = _layout(self.shm.buf, capacity)
+        atexit.register(self.close)
+
+        super().__init__(capacity, mid_threshold=mid_threshold, high_threshold=high_threshold, **kwargs)
+
+    def _allocate(self):
+        _, _, (self._times, self._counts, self._means, self._moods) = _layout(self.shm.buf, self.capacity)
+
+    def close(self):
+        """
+        Releases the shared memory - readers must have detached first
+        """
+        if self.shm is None:
+            return
+        self._header = self._thresholds = None
+        self._times = self._counts = self._means = self._moods = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def _begin_write(self):
+        self._header[_VERSION] += 1
+
+    def _end_write(self):
+        self._header[_VERSION] += 1
+
+    def push(self, count, time):
+        self._begin_write()
+        try:
+            return super().push(count, time)
+        finally:
+            self._end_write()
+
+    def set_thresholds(self, mid_threshold, high_threshold):
+        self._begin_write()
+        try:
+            super().set_thresholds(mid_threshold, high_threshold)
+        finally:
+            self._end_write()
+
+    def clear(self):
+        self._begin_write()
+        try:
+            super().clear()
+        finally:
+            self._end_write()
+
+    # the fields readers need are kept in the shared header
+
+    @property
+    def start(self):
+        return int(self._header[_START])
+
+    @start.setter
+    def start(self, value):
+        self._header[_START] = value
+
+    @property
+    def length(self):
+        return int(self._header[_LENGTH])
+
+    @length.setter
+    def length(self, value):
+        self._header[_LENGTH] = value
+
+    @property
+    def pushes(self):
+        return int(self._header[_PUSHES])
+
+    @pushes.setter
+    def pushes(self, value):
+        self._header[_PUSHES] = value
+
+    @property
+    def mid_threshold(self):
+        return float(self._thresholds[_MID_THRESHOLD])
+
+    @mid_threshold.setter
+    def mid_threshold(self, value):
+        self._thresholds[_MID_THRESHOLD] = value
+
+    @property
+    def high_threshold(self):
+        return float(self._thresholds[_HIGH_THRESHOLD])
+
+    @high_threshold.setter
+    def high_threshold(self, value):
+        self._thresholds[_HIGH_THRESHOLD] = value
+
+
+class SharedWindowSnapshot:
+    """
+    A consistent copy of a SharedTypingWindow, as read by SharedWindowReader
+    """
+
+    def __init__(self, version, pushes, times, counts, mid_threshold, high_threshold):
+        self.version = version
+        self.pushes = pushes
+        self.times = times
+        self.counts = counts
+        self.mid_threshold = mid_threshold
+        self.high_threshold = high_threshold
+
+
+class SharedWindowReader:
+    """
+    Attaches to a SharedTypingWindow created by another process. Meant for
+    processes started by the window's owner, which share its resource
+    tracker, so the block is only unlinked once by the owner.
+    """
+
+    def __init__(self, name, capacity):
+        if not SHARED_MEMORY_ENABLED:
+            raise ValueError('multiprocessing.shared_memory is not available.')
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.capacity = capacity
+        self._header, self._thresholds, (self._times, self._counts, _, _) = _layout(self.shm.buf, capacity)
+        self.last_version = None
+
+    def version(self):
+        return int(self._header[_VERSION])
+
+    def snapshot(self, retries=100):
+        """
+        Copies the window out of shared memory.
+
+        :return: a SharedWindowSnapshot, or None if the window has not changed
+                 since the last snapshot or a consistent copy could not be
+                 taken within the number of retries
+        """
+        for _ in range(retries):
+            version = int(self._header[_VERSION])
+            if version % 2 == 1:
+                # a write is in progress
+                continue
+            if version == self.last_version:
+                return None
+
+            start = int(self._header[_START])
+            length = int(self._header[_LENGTH])
+            pushes = int(self._header[_PUSHES])
+            mid_threshold = float(self._thresholds[_MID_THRESHOLD])
+            high_threshold = float(self._thresholds[_HIGH_THRESHOLD])
+            if not 0 <= start < self.capacity or not 0 <= length <= self.capacity:
+                continue
+            times = self._times[start:start + length].copy()
+            counts = self._counts[start:start + length].copy()
+
+            if int(self._header[_VERSION]) == version:
+                self.last_version = version
+                return SharedWindowSnapshot(version, pushes, times, counts, mid_threshold, high_threshold)
+        return None
+
+    def close(self):
+        self._header = self._thresholds = self._times = self._counts = None
+        self.shm.close()
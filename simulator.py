@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import json
+import os
+import queue
+import random
+import sys
+import time
+
+import numpy as np
+
+from adaptive_thresholds import AdaptiveThresholds
+from fixed_beat_changer import FixedBeatChanger
+from nearest_beat_changer import NearestBeatChanger
+from music_manager import MusicManager, open_saved_mm, FROM_HIGH, FROM_LOW, FROM_MED, FROM_UNKNOWN
+from music_player import BeatChangerWrapperPlayer
+from playback_backend import NullBackend
+from predictive_beat_changer import PredictiveBeatChanger
+from ratio_beat_changer import RatioBeatChanger
+
+CHANGERS = {
+    'fixed': FixedBeatChanger,
+    'ratio': RatioBeatChanger,
+    'predictive': PredictiveBeatChanger,
+    'nearest': NearestBeatChanger,
+}
+
+# typing regimes of the synthetic trace:
+# name -> (mean keystrokes per second, mean seconds spent in the regime)
+TYPING_REGIMES = {
+    'idle': (0.05, 600.0),
+    'low': (2.0, 300.0),
+    'mid': (4.5, 300.0),
+    'high': (6.0, 180.0),
+}
+
+# chance per window of the user pressing the good/bad keybindings
+EVENT_PROBABILITY = 0.002
+
+
+class FakeClock:
+    """
+    Clock which only moves when told to.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def set(self, now):
+        self.now = max(self.now, now)
+
+
+def synthetic_trace(duration, window_size=10.0, seed=0, active_hours=8.0):
+    """
+    Generates a typing-rate trace in the beat queue format - (count, time)
+    tuples for each window, and occasional 'good'/'bad' events.
+
+    Typing moves between the TYPING_REGIMES as a Markov chain with
+    exponentially distributed dwell times, and only happens during the first
+    active_hours of every simulated day.
+
+    :param duration: number of seconds of typing to generate
+    :param window_size: length of each window in seconds
+    :param seed: seed for the random generator
+    :param active_hours: hours per day during which the user is typing
+    """
+    rng = np.random.RandomState(seed)
+    regimes = list(TYPING_REGIMES)
+
+    regime = 'low'
+    regime_end = 0.0
+    start = 0.0
+    while start < duration:
+        if start >= regime_end:
+            regime = regimes[rng.randint(len(regimes))]
+            regime_end = start + rng.exponential(TYPING_REGIMES[regime][1])
+
+        if (start % 86400.0) < active_hours * 3600.0:
+            rate = TYPING_REGIMES[regime][0]
+        else:
+            rate = 0.0
+
+        yield (int(rng.poisson(rate * window_size)), start)
+
+        if rate > 0 and rng.uniform() < EVENT_PROBABILITY:
+            yield 'good' if rng.uniform() < 0.5 else 'bad'
+
+        start += window_size
+
+
+def load_trace(path):
+    """
+    Reads a trace saved by save_trace - one JSON value per line, either a
+    [count, time] pair or an event string.
+    """
+    with open(path, 'r') as raw_data:
+        for line in raw_data:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, list):
+                item = tuple(item)
+            yield item
+
+
+def save_trace(path, trace):
+    with open(path, 'w') as raw_file:
+        for item in trace:
+            raw_file.write(json.dumps(item))
+            raw_file.write('\n')
+
+
+def synthetic_music_manager(n_songs, snippets_per_song=6, song_length=240.0, seed=0):
+    """
+    Builds a MusicManager with a generated library, without reading any audio.
+    Every song is split into equal snippets with randomly assigned moods, and
+    each mood is guaranteed at least one snippet. Snippet features are drawn
+    from within the beat density range of the snippet's mood.
+    """
+    rng = np.random.RandomState(seed)
+    mm = MusicManager()
+
+    mood_lists = [mm.slow_snippets, mm.base_snippets, mm.fast_snippets]
+    # bounds of each mood's beat density, in beats per second
+    low = mm.low_base_beat_threshold / mm.beat_interval_size
+    high = mm.base_high_beat_threshold / mm.beat_interval_size
+    densities = [(0.0, low), (low, high), (high, 2 * high)]
+    snippet_length = song_length / snippets_per_song
+
+    for song_index in range(n_songs):
+        song = '/synthetic/song_{:06}.flac'.format(song_index)
+        mm.songs.append(song)
+        mm.song_info[song] = {
+            'duration': song_length,
+            'samplerate': 44100,
+            'frames': int(song_length * 44100),
+        }
+        # as in MusicManager.add_song, a snippet comes 'from' the mood of the
+        # snippet before it in the song
+        entry_from = FROM_UNKNOWN
+        for snippet_index in range(snippets_per_song):
+            mood = rng.randint(len(mood_lists))
+            if song_index < len(mood_lists) and snippet_index == 0:
+                mood = song_index
+            mood_lists[mood].append({
+                'song': song,
+                'from': entry_from,
+                'start': snippet_index * snippet_length,
+                'end': (snippet_index + 1) * snippet_length,
+                'features': {
+                    'beat_density': rng.uniform(*densities[mood]),
+                    'energy': rng.uniform(0.05, 0.1 + 0.1 * mood),
+                    'length': snippet_length,
+                },
+            })
+            entry_from = (FROM_LOW, FROM_MED, FROM_HIGH)[mood]
+    return mm
+
+
+class Simulation:
+    """
+    Replays a trace through a BeatChangerWrapperPlayer wired to a fake clock
+    and a null backend, recording what the player did.
+    """
+
+    def __init__(self, beat_changer, music_manager, beat_window_size=10.0, min_change_time=120,
+                 fade_out=3, seed=0):
+        random.seed(seed)
+        np.random.seed(seed)
+
+        self.clock = FakeClock()
+        self.backend = NullBackend(self.clock.time, fade_out=fade_out)
+        self.beat_queue = queue.Queue()
+        self.beat_window_size = beat_window_size
+
+        self.player = BeatChangerWrapperPlayer(
+            beat_changer, music_manager=music_manager,
+            beat_window_size=beat_window_size, min_change_time=min_change_time,
+            backend=self.backend, beat_queue=self.beat_queue, clock=self.clock.time,
+        )
+        # notifications have nowhere to go
+        self.player.notify = lambda msg, key=None: None
+
+        self.moods = music_manager.snippet_moods()
+
+    def run(self, trace):
+        switches = {'low': 0, 'mid': 0, 'high': 0, 'unknown': 0}
+        dwell = {'low': 0.0, 'mid': 0.0, 'high': 0.0, 'unknown': 0.0}
+        latencies = []
+        windows, events, repeats = 0, 0, 0
+
+        started = time.perf_counter()
+
+        song, start = self.player.beat_changer.play_initial()
+        self.player.play_song(song, start)
+        current_mood = self.moods.get((song, start), 'unknown')
+        mood_since = self.clock.time()
+        played = len(self.backend.history)
+
+        for item in trace:
+            if isinstance(item, tuple):
+                windows += 1
+                # the window is handed over once it has closed
+                self.clock.set(item[1] + self.beat_window_size)
+                self.backend.advance(self.clock.time())
+                if len(self.backend.history) != played:
+                    repeats += len(self.backend.history) - played
+                    played = len(self.backend.history)
+            else:
+                events += 1
+
+            decisions = self.player.decision_count
+            self.beat_queue.put(item)
+            self.player.handle_item(self.beat_queue.get_nowait())
+
+            if self.player.decision_count != decisions:
+                latencies.append(self.player.last_decision_cost)
+
+            if len(self.backend.history) != played:
+                played = len(self.backend.history)
+                _, song, position = self.backend.history[-1]
+                now = self.clock.time()
+                dwell[current_mood] += now - mood_since
+                current_mood = self.moods.get((song, position), 'unknown')
+                mood_since = now
+                switches[current_mood] += 1
+
+        dwell[current_mood] += self.clock.time() - mood_since
+        wall_time = time.perf_counter() - started
+
+        latencies = np.array(latencies) if latencies else np.zeros(1)
+        return {
+            'simulated_seconds': self.clock.time(),
+            'wall_seconds': wall_time,
+            'speedup': self.clock.time() / wall_time if wall_time > 0 else None,
+            'windows': windows,
+            'events': events,
+            'decisions': self.player.decision_count,
+            'switches': sum(switches.values()),
+            'switches_by_mood': switches,
+            'repeats': repeats,
+            'preloads': self.backend.preloads,
+            'preload_hits': self.backend.preload_hits,
+            'dwell_seconds': dwell,
+            'decision_latency': {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            },
+        }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Replays typing-rate traces through the player without audio or keyboard')
+
+    parser.add_argument(
+        '-p', '--profile', metavar='PROFILE', default=None,
+        help='Name of the profile to load the library from. Defaults to a synthetic library.'
+    )
+
+    parser.add_argument(
+        '--synthetic-songs', metavar='N', type=int, default=200,
+        help='Number of songs in the synthetic library used when no profile is given'
+    )
+
+    parser.add_argument(
+        '-t', '--trace', metavar='TRACE', default=None,
+        help='Trace file to replay. Defaults to a synthetic trace.'
+    )
+
+    parser.add_argument(
+        '--save-trace', metavar='TRACE', default=None,
+        help='Save the replayed trace to this file'
+    )
+
+    parser.add_argument(
+        '-d', '--days', metavar='DAYS', type=float, default=7.0,
+        help='Number of days of synthetic typing to simulate'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='SEED', type=int, default=0,
+        help='Seed for the synthetic trace, library and the beat changer'
+    )
+
+    parser.add_argument(
+        '-c', '--changer', metavar='CHANGER', choices=sorted(CHANGERS), default='fixed',
+        help='Beat changer to simulate. Should be one of: {}'.format(', '.join(sorted(CHANGERS)))
+    )
+
+    parser.add_argument(
+        '--adaptive-thresholds', action='store_true',
+        help='Learn the thresholds of the fixed and predictive beat changers from the trace'
+    )
+
+    parser.add_argument(
+        '--beat-window-size', metavar='SECONDS', type=float, default=10.0,
+        help='Length of each typing window in seconds'
+    )
+
+    parser.add_argument(
+        '--min-change-time', metavar='SECONDS', type=float, default=120,
+        help='Minimum time between music changes in seconds'
+    )
+
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show the output of the player and beat changer'
+    )
+
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        music_manager = open_saved_mm(args.profile)
+        if not music_manager.songs:
+            print('Error: Profile {} has no songs.'.format(args.profile), file=sys.stderr)
+            exit(-1)
+    else:
+        music_manager = synthetic_music_manager(args.synthetic_songs, seed=args.seed)
+
+    if args.trace is not None:
+        trace = list(load_trace(args.trace))
+    else:
+        trace = list(synthetic_trace(args.days * 86400, window_size=args.beat_window_size, seed=args.seed))
+
+    if args.save_trace is not None:
+        save_trace(args.save_trace, trace)
+
+    if args.adaptive_thresholds:
+        if args.changer in ('ratio', 'nearest'):
+            print('Error: The {} beat changer does not use thresholds.'.format(args.changer), file=sys.stderr)
+            exit(-1)
+        beat_changer = CHANGERS[args.changer](thresholds=AdaptiveThresholds())
+    else:
+        beat_changer = CHANGERS[args.changer]()
+
+    simulation = Simulation(
+        beat_changer, music_manager,
+        beat_window_size=args.beat_window_size, min_change_time=args.min_change_time, seed=args.seed,
+    )
+
+    if args.verbose:
+        report = simulation.run(trace)
+    else:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            report = simulation.run(trace)
+
+    print(json.dumps(report, indent=4))
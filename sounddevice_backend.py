@@ -0,0 +1,448 @@
+import time
+from collections import deque
+from threading import Event, Thread
+
+import numpy as np
+import soundfile
+
+from playback_backend import BasePlaybackBackend
+
+SOUNDDEVICE_ENABLED = True
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    SOUNDDEVICE_ENABLED = False
+    print("INFO: Could not load sounddevice, only the null and file outputs are available.")
+
+
+class _Voice:
+    """
+    Streams a single song from disk. Decoded audio is kept in a small ring of
+    blocks which the control thread refills and the audio callback drains.
+    """
+
+    def __init__(self, song, position, samplerate, channels, blocksize, ring_blocks, callback=None):
+        self.song = song
+        self.position = position or 0
+        self.callback = callback
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.ring_blocks = ring_blocks
+
+        self.file = soundfile.SoundFile(song)
+        self.ratio = self.file.samplerate / samplerate
+        start = min(int(round((position or 0) * self.file.samplerate)), self.file.frames)
+        self.file.seek(start)
+
+        # number of output frames left until the song runs out
+        self.remaining = int((self.file.frames - start) / self.ratio)
+
+        self.ring = deque()
+        self.head = None
+        self.head_offset = 0
+        self.exhausted = False
+
+        # carried between blocks when resampling
+        self.resample_pos = 0.0
+        self.resample_last = None
+
+        self.gain = 0.0
+        self.ramp_step = 0.0
+        self.ramp_remaining = 0
+        self.fading_out = False
+        self.ending_reported = False
+        self.finished = False
+        # set from the audio callback when the first frames are mixed
+        self.audible_at = None
+        self.audible_reported = False
+
+    def ramp(self, gain, frames):
+        """
+        Schedules a linear gain ramp to the given gain over a number of frames
+        """
+        frames = max(int(frames), 1)
+        self.ramp_step = (gain - self.gain) / frames
+        self.ramp_remaining = frames
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def needs_data(self):
+        return not self.exhausted and len(self.ring) < self.ring_blocks
+
+    def fill(self):
+        """
+        Decodes blocks until the ring is full or the file runs out. Only ever
+        called from the control thread.
+        """
+        while self.needs_data():
+            data = self.file.read(int(np.ceil(self.blocksize * self.ratio)), dtype='float32', always_2d=True)
+            if data.shape[0] == 0:
+                self.exhausted = True
+                self.close()
+                break
+            self.ring.append(self._convert(data))
+
+    def _convert(self, data):
+        if data.shape[1] != self.channels:
+            if data.shape[1] == 1:
+                data = np.repeat(data, self.channels, axis=1)
+            elif self.channels == 1:
+                data = data.mean(axis=1, keepdims=True)
+            else:
+                data = data[:, :self.channels]
+
+        if self.ratio == 1.0:
+            return data
+
+        # linear resampling, continuing from where the last block finished
+        if self.resample_last is not None:
+            data = np.concatenate([self.resample_last, data])
+        positions = np.arange(self.resample_pos, data.shape[0] - 1, self.ratio)
+        source = np.arange(data.shape[0])
+        out = np.empty((positions.shape[0], data.shape[1]), dtype='float32')
+        for channel in range(data.shape[1]):
+            out[:, channel] = np.interp(positions, source, data[:, channel])
+        next_pos = positions[-1] + self.ratio if positions.size else self.resample_pos
+        self.resample_pos = next_pos - (data.shape[0] - 1)
+        self.resample_last = data[-1:]
+        return out
+
+    def _gains(self, frames):
+        if self.ramp_remaining == 0:
+            return None
+        n = min(frames, self.ramp_remaining)
+        gains = self.gain + self.ramp_step * np.arange(1, n + 1, dtype='float32')
+        self.gain = float(gains[-1])
+        self.ramp_remaining -= n
+        if n < frames:
+            gains = np.concatenate([gains, np.full(frames - n, self.gain, dtype='float32')])
+        return gains[:, None]
+
+    def mix_into(self, out):
+        """
+        Adds the next len(out) frames of the voice into out, applying the gain
+        ramp per sample. Called from the audio callback.
+        """
+        frames = out.shape[0]
+        written = 0
+        gains = self._gains(frames)
+
+        while written < frames:
+            if self.head is None or self.head_offset >= self.head.shape[0]:
+                if not self.ring:
+                    break
+                self.head = self.ring.popleft()
+                self.head_offset = 0
+            n = min(frames - written, self.head.shape[0] - self.head_offset)
+            chunk = self.head[self.head_offset:self.head_offset + n]
+            if gains is None:
+                out[written:written + n] += chunk * self.gain
+            else:
+                out[written:written + n] += chunk * gains[written:written + n]
+            self.head_offset += n
+            written += n
+
+        self.remaining -= written
+        if written and self.audible_at is None:
+            self.audible_at = time.monotonic()
+        if self.exhausted and not self.ring and (self.head is None or self.head_offset >= self.head.shape[0]):
+            self.finished = True
+        if self.fading_out and self.ramp_remaining == 0 and self.gain <= 0:
+            self.finished = True
+
+
+class Mixer:
+    """
+    Sums the active voices. Changes to the voices are handed over from the
+    control thread through a deque of commands, so that the audio callback
+    never takes a lock.
+    """
+
+    def __init__(self, channels, on_low_data=None):
+        self.channels = channels
+        self.voices = []
+        self.pending = deque()
+        self.on_low_data = on_low_data
+        self.frames_rendered = 0
+
+    def submit(self, command):
+        """
+        Queues a callable to be run at the start of the next rendered block
+        """
+        self.pending.append(command)
+
+    def add_voice(self, voice):
+        self.submit(lambda: self.voices.append(voice))
+
+    def fade_out(self, voice, frames):
+        def command():
+            voice.fading_out = True
+            voice.ramp(0.0, frames)
+        self.submit(command)
+
+    def render(self, frames, out=None):
+        while self.pending:
+            self.pending.popleft()()
+
+        if out is None:
+            out = np.zeros((frames, self.channels), dtype='float32')
+        else:
+            out.fill(0)
+
+        low_data = False
+        for voice in self.voices:
+            voice.mix_into(out)
+            if len(voice.ring) <= voice.ring_blocks // 2 and not voice.exhausted:
+                low_data = True
+
+        self.voices = [voice for voice in self.voices if not voice.finished]
+        self.frames_rendered += frames
+
+        if low_data and self.on_low_data is not None:
+            self.on_low_data()
+        return out
+
+
+class DeviceOutput:
+    """
+    Plays the mixer through a sounddevice output stream.
+    """
+
+    def __init__(self, mixer, samplerate, channels, blocksize, device=None):
+        if not SOUNDDEVICE_ENABLED:
+            raise ValueError('sounddevice is not available - use the null or file output instead.')
+
+        def callback(outdata, frames, time_info, status):
+            mixer.render(frames, outdata)
+
+        self.stream = sd.OutputStream(
+            samplerate=samplerate, channels=channels, blocksize=blocksize,
+            device=device, dtype='float32', callback=callback,
+        )
+        self.stream.start()
+
+    def threads(self):
+        # the stream's callback runs on a thread of the audio library
+        return int(self.stream.active)
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+class NullOutput:
+    """
+    Pulls blocks from the mixer on a thread in place of an audio device,
+    optionally writing them to a sound file. Useful for testing on machines
+    without audio hardware.
+
+    :param path: if given, the rendered audio is written to this file
+    :param realtime: whether blocks should be pulled at the rate a device would
+                     consume them, or as fast as possible
+    """
+
+    def __init__(self, mixer, samplerate, channels, blocksize, path=None, realtime=True):
+        self.mixer = mixer
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.realtime = realtime
+        self.closed = Event()
+
+        self.file = None
+        if path is not None:
+            self.file = soundfile.SoundFile(path, 'w', samplerate=samplerate, channels=channels)
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+    def _run(self):
+        block_time = self.blocksize / self.samplerate
+        next_time = time.monotonic()
+        buffer = np.zeros((self.blocksize, self.mixer.channels), dtype='float32')
+        while not self.closed.is_set():
+            self.mixer.render(self.blocksize, buffer)
+            if self.file is not None:
+                self.file.write(buffer)
+
+            if self.realtime:
+                next_time += block_time
+                self.closed.wait(max(next_time - time.monotonic(), 0))
+
+    def threads(self):
+        return int(self.runner.is_alive())
+
+    def close(self):
+        self.closed.set()
+        self.runner.join()
+        if self.file is not None:
+            self.file.close()
+
+
+class SoundDeviceBackend(BasePlaybackBackend):
+    """
+    Playback engine which decodes songs with soundfile and mixes them itself,
+    giving per-sample crossfades and sample-exact start offsets. Only a small
+    ring of decoded blocks is kept in memory per playing song.
+    """
+
+    def __init__(self, fade_in=3, fade_out=3, volume=60, samplerate=44100, channels=2, blocksize=1024,
+                 ring_blocks=16, output=None, device=None):
+        """
+        :param fade_in: number of seconds to use for fading in a song
+        :param fade_out: number of seconds to use for fading out a song
+        :param volume: the volume (0-100) at which songs should be played
+        :param samplerate: output sample rate - songs at other rates are resampled
+        :param channels: number of output channels
+        :param blocksize: number of frames per block handed to the output
+        :param ring_blocks: number of decoded blocks to keep ahead of playback per song
+        :param output: None for the sound card, 'null' to discard the audio, or
+                       a filename to render the audio into
+        :param device: sounddevice output device to use
+        """
+        self.fade_in = fade_in
+        self.fade_out = fade_out
+        self.gain = volume / 100
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.ring_blocks = ring_blocks
+
+        self.wake = Event()
+        self.commands = deque()
+        self.closed = False
+        self.voices = []
+        self.current = None
+        # voice opened and decoded ahead by preload, not yet mixed
+        self.preloaded = None
+
+        self.mixer = Mixer(channels, on_low_data=self.wake.set)
+
+        self.runner = Thread(target=self._run)
+        self.runner.daemon = True
+        self.runner.start()
+
+        if output is None:
+            self.output = DeviceOutput(self.mixer, samplerate, channels, blocksize, device=device)
+        elif output == 'null':
+            self.output = NullOutput(self.mixer, samplerate, channels, blocksize)
+        else:
+            self.output = NullOutput(self.mixer, samplerate, channels, blocksize, path=output)
+
+    def play(self, song, position=None, length=None, callback=None):
+        print('play_song({}, {})'.format(song, position))
+        self._submit(('play', song, position, callback))
+
+    def preload(self, song, position=None, length=None):
+        self._submit(('preload', song, position))
+
+    def stop(self):
+        self._submit(('stop',))
+
+    def playback_threads(self):
+        return int(self.runner.is_alive()) + self.output.threads()
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.runner.join()
+        self.output.close()
+        for voice in self.voices:
+            voice.close()
+        if self.preloaded is not None:
+            self.preloaded.close()
+
+    def _submit(self, command):
+        self.commands.append(command)
+        self.wake.set()
+
+    def _fade_out(self, voice):
+        voice.callback = None
+        voice.ending_reported = True
+        self.mixer.fade_out(voice, self.fade_out * self.samplerate)
+
+    def _execute(self, command):
+        if command[0] == 'stop':
+            if self.current is not None:
+                self._fade_out(self.current)
+                self.current = None
+            return
+
+        if command[0] == 'preload':
+            _, song, position = command
+            if self.preloaded is not None:
+                if (self.preloaded.song, self.preloaded.position) == (song, position or 0):
+                    return
+                self.preloaded.close()
+                self.preloaded = None
+            self.preloaded = self._open(song, position)
+            return
+
+        _, song, position, callback = command
+        voice = self.preloaded
+        if voice is not None and (voice.song, voice.position) == (song, position or 0):
+            self.preloaded = None
+        else:
+            voice = self._open(song, position)
+            if voice is None:
+                return
+        voice.callback = callback
+        voice.ramp(self.gain, self.fade_in * self.samplerate)
+
+        if self.current is not None:
+            self._fade_out(self.current)
+        self.current = voice
+        self.voices.append(voice)
+        self.mixer.add_voice(voice)
+
+    def _open(self, song, position):
+        try:
+            voice = _Voice(song, position, self.samplerate, self.channels, self.blocksize, self.ring_blocks)
+        except (RuntimeError, OSError) as e:
+            print('INFO: Could not open {}: {}'.format(song, e))
+            return None
+
+        # decode ahead before the voice becomes audible
+        voice.fill()
+        return voice
+
+    def _run(self):
+        fade_out_frames = self.fade_out * self.samplerate
+        poll_time = self.blocksize * max(self.ring_blocks // 4, 1) / self.samplerate
+
+        while not self.closed:
+            self.wake.wait(poll_time)
+            self.wake.clear()
+
+            while self.commands:
+                self._execute(self.commands.popleft())
+
+            for voice in self.voices:
+                if voice.finished:
+                    voice.close()
+            self.voices = [voice for voice in self.voices if not voice.finished]
+            if self.current is not None and self.current.finished:
+                self.current = None
+
+            callbacks = []
+            for voice in self.voices:
+                voice.fill()
+
+                if voice.audible_at is not None and not voice.audible_reported:
+                    voice.audible_reported = True
+                    self.report_audible(voice.song, voice.audible_at)
+
+                if not voice.ending_reported and voice.remaining <= fade_out_frames:
+                    # the song is running out - fade it and let the callback
+                    # schedule what plays next so the two overlap
+                    voice.ending_reported = True
+                    self.mixer.fade_out(voice, max(voice.remaining, 1))
+                    if voice.callback is not None:
+                        callbacks.append((voice.callback, voice.song))
+                        voice.callback = None
+
+            for callback, song in callbacks:
+                callback(song)
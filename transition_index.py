@@ -0,0 +1,177 @@
+import random
+
+from music_manager import FROM_HIGH, FROM_LOW, FROM_MED
+from weighted_sampler import TwoLevelSampler
+
+# the snippet 'from' value matching each mood the player can be in
+MOOD_FROM = {
+    'low': FROM_LOW,
+    'mid': FROM_MED,
+    'high': FROM_HIGH,
+}
+
+# chance of drawing from the snippets which ramp out of the current mood,
+# when there are any - the rest of the time any snippet of the mood is drawn,
+# so that small transition pools do not play on repeat
+TRANSITION_PREFERENCE = 0.75
+
+# the moods drawn from in turn when every snippet of the chosen one has been
+# removed, nearest first
+FALLBACK_MOODS = {
+    'low': ('low', 'mid', 'high'),
+    'mid': ('mid', 'low', 'high'),
+    'high': ('high', 'mid', 'low'),
+}
+
+
+class TransitionIndex:
+    """
+    Samplers over the snippets of each mood, and over the snippets of each
+    mood grouped by the mood of the music preceding them in their song (the
+    snippet's 'from'), so that moving from one mood to another can prefer a
+    snippet which ramps out of the current mood as the song itself did.
+
+    Looking up a (previous mood, target mood) pair is a dict access, and a
+    weight change updates both samplers holding the snippet in O(log n), as
+    does adding a snippet. The snippets of a removed song stay in the lists,
+    so that the indices of the others do not change, but are never drawn.
+    """
+
+    def __init__(self, tracks, preference=TRANSITION_PREFERENCE):
+        """
+        :param tracks: dict of mood -> list of (snippet, [weight]) - snippets
+                       added to the index are appended to these lists
+        """
+        self.tracks = tracks
+        self.preference = preference
+        self.samplers = {}
+        self.transitions = {}
+        # (mood, index in the mood's list) -> (transition key, index in that sampler)
+        self.locations = {}
+        # song -> list of (mood, index in the mood's list) of its snippets
+        self.song_locations = {}
+
+        for mood, values in tracks.items():
+            self.samplers[mood] = TwoLevelSampler(
+                [weight[0] for (_, weight) in values], [snippet['song'] for (snippet, _) in values]
+            )
+
+            by_from = {}
+            for index, (snippet, _) in enumerate(values):
+                by_from.setdefault(snippet.get('from'), []).append(index)
+                self.song_locations.setdefault(snippet['song'], []).append((mood, index))
+
+            for entry_from, indices in by_from.items():
+                key = (entry_from, mood)
+                self.transitions[key] = (
+                    TwoLevelSampler([values[i][1][0] for i in indices], [values[i][0]['song'] for i in indices]),
+                    indices,
+                )
+                for position, index in enumerate(indices):
+                    self.locations[(mood, index)] = (key, position)
+
+    def sample(self, previous, target, uniform=random.random):
+        """
+        :param previous: the mood being moved from, or None
+        :param target: the mood to draw a snippet of
+        :return: the index of the drawn snippet in the target mood's list, or
+                 None if every snippet of the mood has been removed
+        """
+        transition = self.transitions.get((MOOD_FROM.get(previous), target))
+        if transition is not None and uniform() < self.preference:
+            sampler, indices = transition
+            index = sampler.sample(uniform)
+            if index is not None:
+                return indices[index]
+        return self.samplers[target].sample(uniform)
+
+    def is_removed(self, mood, index):
+        return self.samplers[mood].is_removed(index)
+
+    def set_weight(self, mood, index, weight):
+        self.samplers[mood].set_weight(index, weight)
+        key, position = self.locations[(mood, index)]
+        self.transitions[key][0].set_weight(position, weight)
+
+    def add(self, mood, snippet, weight):
+        """
+        Appends a snippet to the mood's list - O(log n)
+
+        :param weight: the snippet's weight, as a list of one value
+        :return: the index of the snippet in the mood's list
+        """
+        values = self.tracks.setdefault(mood, [])
+        if mood not in self.samplers:
+            self.samplers[mood] = TwoLevelSampler([], [])
+        values.append((snippet, weight))
+        index = self.samplers[mood].add(weight[0], snippet['song'])
+
+        key = (snippet.get('from'), mood)
+        if key not in self.transitions:
+            self.transitions[key] = (TwoLevelSampler([], []), [])
+        sampler, indices = self.transitions[key]
+        self.locations[(mood, index)] = (key, sampler.add(weight[0], snippet['song']))
+        indices.append(index)
+
+        self.song_locations.setdefault(snippet['song'], []).append((mood, index))
+        return index
+
+    def remove_song(self, song):
+        """
+        Stops the snippets of a song from being drawn - O(log n) per snippet
+        """
+        for mood, index in self.song_locations.pop(song, []):
+            self.samplers[mood].remove(index)
+            key, position = self.locations[(mood, index)]
+            self.transitions[key][0].remove(position)
+
+
+class IndexedTracksMixin:
+    """
+    The track plumbing of the beat changers which draw their snippets
+    through a TransitionIndex: the low, medium and high tracks as lists of
+    (snippet, [weight]), kept up to date as songs are added and removed.
+    Goes before BaseBeatChanger in the bases, so that its configure_tracks
+    and update_tracks are the ones used.
+    """
+
+    def configure_tracks(self, music_manager):
+        self.medium_tracks = [(i, [self.initial_weight(i)]) for i in music_manager.base_snippets]
+        self.low_tracks = [(i, [self.initial_weight(i)]) for i in music_manager.slow_snippets]
+        self.high_tracks = [(i, [self.initial_weight(i)]) for i in music_manager.fast_snippets]
+
+        self.tracks = {'low': self.low_tracks, 'mid': self.medium_tracks, 'high': self.high_tracks}
+        self.index = TransitionIndex(self.tracks)
+        self.last_selected = None
+        self.last_selected_index = None
+
+    def update_tracks(self, added, removed):
+        for song in removed:
+            self.index.remove_song(song)
+        # the index appends to the lists in self.tracks
+        for mood, snippet in added:
+            self.index.add(mood, snippet, [self.initial_weight(snippet)])
+
+    def draw(self, previous, choice):
+        """
+        Draws a snippet of the chosen mood, or of the nearest mood which has
+        any left if every snippet of the chosen one has been removed
+
+        :return: (mood, index in the mood's list) of the drawn snippet, or
+                 None if every song has been removed
+        """
+        for mood in FALLBACK_MOODS[choice]:
+            index = self.index.sample(previous, mood)
+            if index is not None:
+                return mood, index
+        return None
+
+    def set_selected_weight(self, weight):
+        """
+        Sets the weight of the last selected snippet, in its track and the index
+        """
+        self.last_selected[1][0] = weight
+        if self.last_selected_index is not None:
+            mood, index = self.last_selected_index
+            self.index.set_weight(mood, index, weight)
+        self.record_weight(self.last_selected[0], weight)
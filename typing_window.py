@@ -0,0 +1,204 @@
+from threading import Lock
+
+import numpy as np
+
+MOOD_LOW = 0
+MOOD_MID = 1
+MOOD_HIGH = 2
+MOODS = ('low', 'mid', 'high')
+
+# the weight of each window is DECAY times that of the window before it
+DECAY = 1.1
+# keystroke counts per window above which typing is 'high' and 'mid', unless
+# told otherwise - the thresholds of FixedBeatChanger
+BASE_HIGH = 50
+BASE_MID = 40
+
+
+class TypingWindowSnapshot:
+    """
+    A consistent copy of a TypingWindow, as returned by TypingWindow.snapshot
+    """
+
+    def __init__(self, seq, times, counts, means, mid_threshold, high_threshold):
+        self.seq = seq
+        self.times = times
+        self.counts = counts
+        self.means = means
+        self.mid_threshold = mid_threshold
+        self.high_threshold = high_threshold
+
+
+class TypingWindow:
+    """
+    Fixed-size ring buffer of the most recent keystroke windows, maintaining
+    the mean, variance and decayed per-mood weighted counts of the windows it
+    holds in O(1) per new window.
+
+    Every value is written twice, capacity entries apart, so the windows can
+    always be read oldest-first as a contiguous numpy view without copying.
+
+    A window's mood is 'high' if its count is above high_threshold, 'mid' if
+    above mid_threshold and 'low' otherwise. Its weight is DECAY ** i, with i
+    its position counting from the oldest window held.
+
+    The views returned by times, counts, means and moods change as windows
+    are pushed, so another thread (such as the visualizer's) should read the
+    window through snapshot instead.
+    """
+
+    def __init__(self, capacity, mid_threshold=BASE_MID, high_threshold=BASE_HIGH, decay=DECAY):
+        self.capacity = capacity
+        self.mid_threshold = mid_threshold
+        self.high_threshold = high_threshold
+        self.decay = decay
+        # held while the window changes, and while it is copied by snapshot
+        self.lock = Lock()
+
+        self._allocate()
+        self.clear()
+
+    def _allocate(self):
+        self._times = np.zeros(2 * self.capacity)
+        self._counts = np.zeros(2 * self.capacity)
+        # the mean of the window at the time each entry was added
+        self._means = np.zeros(2 * self.capacity)
+        self._moods = np.zeros(2 * self.capacity, dtype=np.int8)
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.start = 0
+        self.length = 0
+        # total number of windows ever pushed
+        self.pushes = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.weights = np.zeros(len(MOODS))
+        self._pushes_since_recompute = 0
+        # incremented on every change, so readers can tell when to redraw
+        self.seq = 0
+
+    def __len__(self):
+        return self.length
+
+    def full(self):
+        return self.length == self.capacity
+
+    def classify(self, counts):
+        """
+        Returns the mood index of each of the given counts
+        """
+        counts = np.asarray(counts)
+        return (counts > self.mid_threshold).astype(np.int8) + (counts > self.high_threshold).astype(np.int8)
+
+    def push(self, count, time):
+        """
+        Adds the window with the given keystroke count and start time,
+        evicting the oldest window if the buffer is full.
+
+        :return: True if a window was evicted
+        """
+        with self.lock:
+            return self._push(count, time)
+
+    def _push(self, count, time):
+        evicted = False
+        if self.length == self.capacity:
+            old_count = self._counts[self.start]
+            self.total -= old_count
+            self.total_squares -= old_count * old_count
+            # the oldest window always has weight 1, and every other window
+            # moves one step closer to the start
+            self.weights[self._moods[self.start]] -= 1.0
+            self.weights /= self.decay
+            self.start = (self.start + 1) % self.capacity
+            self.length -= 1
+            evicted = True
+
+        mood = int(self.classify(count))
+        self.weights[mood] += self.decay ** self.length
+        self.total += count
+        self.total_squares += count * count
+        self.length += 1
+
+        index = (self.start + self.length - 1) % self.capacity
+        for position in (index, index + self.capacity):
+            self._times[position] = time
+            self._counts[position] = count
+            self._moods[position] = mood
+            self._means[position] = self.total / self.length
+
+        self.pushes += 1
+        self._pushes_since_recompute += 1
+        if self._pushes_since_recompute >= self.capacity:
+            # stop rounding errors in the running totals from accumulating
+            self._recompute()
+        self.seq += 1
+        return evicted
+
+    def set_thresholds(self, mid_threshold, high_threshold):
+        """
+        Changes the mood thresholds, reclassifying the windows held - O(n)
+        """
+        with self.lock:
+            self.mid_threshold = mid_threshold
+            self.high_threshold = high_threshold
+            self._moods[:] = self.classify(self._counts)
+            self._recompute()
+            self.seq += 1
+
+    def snapshot(self):
+        """
+        Returns a TypingWindowSnapshot of copies of the times, counts and
+        means of the windows, and of the thresholds, all taken at once
+        """
+        with self.lock:
+            return TypingWindowSnapshot(
+                self.seq, self.times.copy(), self.counts.copy(), self.means.copy(),
+                self.mid_threshold, self.high_threshold,
+            )
+
+    def _recompute(self):
+        counts = self.counts
+        self.total = float(counts.sum())
+        self.total_squares = float((counts * counts).sum())
+        multipliers = self.decay ** np.arange(self.length)
+        self.weights = np.bincount(self.moods, weights=multipliers, minlength=len(MOODS)).astype(float)
+        self._pushes_since_recompute = 0
+
+    @property
+    def times(self):
+        return self._times[self.start:self.start + self.length]
+
+    @property
+    def counts(self):
+        return self._counts[self.start:self.start + self.length]
+
+    @property
+    def means(self):
+        return self._means[self.start:self.start + self.length]
+
+    @property
+    def moods(self):
+        return self._moods[self.start:self.start + self.length]
+
+    def mean(self):
+        if self.length == 0:
+            return 0.0
+        return self.total / self.length
+
+    def variance(self):
+        if self.length == 0:
+            return 0.0
+        mean = self.total / self.length
+        return max(self.total_squares / self.length - mean * mean, 0.0)
+
+    def mood_weights(self):
+        """
+        Returns the decayed weighted counts of the (low, mid, high) moods
+        """
+        low, mid, high = self.weights
+        return low, mid, high
@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import queue
+import time
+from threading import Thread
+
+from keyboard_handler import BeatVisualizer, DEFAULT_MAX_FPS
+from shared_window import SharedWindowReader
+
+# seconds between checks of the shared window for new entries
+DEFAULT_POLL_INTERVAL = 0.1
+
+
+def _poll(reader, visualizer, beat_queue, poll_interval, parent_pid):
+    seen = 0
+    while True:
+        if os.getppid() != parent_pid:
+            # the player has gone away
+            os._exit(0)
+
+        snapshot = reader.snapshot()
+        if snapshot is not None:
+            if (snapshot.mid_threshold, snapshot.high_threshold) != (
+                    visualizer.window.mid_threshold, visualizer.window.high_threshold
+            ):
+                visualizer.window.set_thresholds(snapshot.mid_threshold, snapshot.high_threshold)
+
+            # replay the entries added since the last snapshot
+            new_entries = min(snapshot.pushes - seen, len(snapshot.counts))
+            if new_entries > 0:
+                for count, start in zip(snapshot.counts[-new_entries:], snapshot.times[-new_entries:]):
+                    beat_queue.put((int(count), float(start)))
+            seen = snapshot.pushes
+
+        time.sleep(poll_interval)
+
+
+def run_visualizer(name, capacity, blit=False, max_fps=DEFAULT_MAX_FPS, poll_interval=DEFAULT_POLL_INTERVAL,
+                   parent_pid=None):
+    """
+    Entry point of the visualizer process - plots the SharedTypingWindow with
+    the given shared memory name until the player exits.
+    """
+    reader = SharedWindowReader(name, capacity)
+    beat_queue = queue.Queue()
+    visualizer = BeatVisualizer(
+        beat_queue, window_width=capacity, blit=blit, max_fps=max_fps,
+    )
+
+    poller = Thread(
+        target=_poll, args=(reader, visualizer, beat_queue, poll_interval, parent_pid or os.getppid()),
+    )
+    poller.daemon = True
+    poller.start()
+
+    visualizer.run()
+
+
+def start_visualizer_process(window, blit=False, max_fps=DEFAULT_MAX_FPS, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Starts a separate process plotting the given SharedTypingWindow. The
+    player only ever writes to the shared window, so a crash or hang in the
+    GUI cannot affect playback.
+
+    :return: the multiprocessing.Process running the visualizer
+    """
+    # spawn rather than fork, so the child does not inherit the keyboard
+    # listener's threads
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(
+        target=run_visualizer,
+        args=(window.name, window.capacity, blit, max_fps, poll_interval, os.getpid()),
+    )
+    process.daemon = True
+    process.start()
+    return process
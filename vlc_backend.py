@@ -0,0 +1,469 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Event, Thread
+
+import vlc
+
+from playback_backend import BasePlaybackBackend
+
+
+def parse_media_length(media, timeout=5.0):
+    """
+    Determines the length of a VLC media by asking VLC to parse it, waiting
+    on the parsed event rather than polling.
+
+    :param media: the vlc.Media to be parsed
+    :param timeout: maximum number of seconds to wait for the parse to finish
+
+    :return: the length of the media in seconds, or None if it could not be
+             determined within the timeout
+    """
+    duration = media.get_duration()
+    if duration is not None and duration > 0:
+        return duration / 1000
+
+    parsed = Event()
+
+    def on_parsed(event):
+        parsed.set()
+
+    event_manager = media.event_manager()
+    event_manager.event_attach(vlc.EventType.MediaParsedChanged, on_parsed)
+    try:
+        media.parse_with_options(vlc.MediaParseFlag.local, int(timeout * 1000))
+        parsed.wait(timeout)
+    finally:
+        event_manager.event_detach(vlc.EventType.MediaParsedChanged)
+
+    duration = media.get_duration()
+    if duration is None or duration <= 0:
+        return None
+    return duration / 1000
+
+
+class _Fade:
+    """
+    A linear volume ramp, evaluated against the clock rather than stepped,
+    so that late ticks never accumulate into drift.
+    """
+
+    def __init__(self, start_time, start_volume, end_volume, duration):
+        self.start_time = start_time
+        self.start_volume = start_volume
+        self.end_volume = end_volume
+        self.duration = duration
+
+    def volume_at(self, now):
+        if self.duration <= 0:
+            return self.end_volume
+        progress = min(max((now - self.start_time) / self.duration, 0.0), 1.0)
+        return self.start_volume + (self.end_volume - self.start_volume) * progress
+
+    def finished(self, now):
+        return now >= self.start_time + self.duration
+
+
+class _Deck:
+    """
+    One of the two long-lived VLC players owned by VLCDeckBackend.
+    """
+
+    def __init__(self, instance, on_end, on_playing):
+        self.player = instance.media_player_new()
+        self.player.event_manager().event_attach(
+            vlc.EventType.MediaPlayerEndReached, lambda event: on_end(self)
+        )
+        self.player.event_manager().event_attach(
+            vlc.EventType.MediaPlayerPlaying, lambda event: on_playing(self)
+        )
+        self.reset()
+
+    def reset(self):
+        self.ended = False
+        self.song = None
+        self.callback = None
+        # monotonic time at which the song runs out, None if unknown
+        self.end_time = None
+        self.fade = None
+        self.volume = 0
+        self.fading_out = False
+        self.playing = False
+        # (song, position, length) loaded and paused on this idle deck
+        self.preloaded = None
+        # whether VLC has reported the loaded song playing - pausing and
+        # seeking are ignored until it has
+        self.started = False
+        # whether to pause the deck once it has started
+        self.pause_pending = False
+
+    def set_volume(self, volume):
+        volume = int(round(volume))
+        if volume != self.volume:
+            self.player.audio_set_volume(volume)
+            self.volume = volume
+
+
+class VLCDeckBackend(BasePlaybackBackend):
+    """
+    Playback engine which keeps exactly two VLC players ("decks") and a single
+    control thread for the lifetime of the session. Each switch loads the new
+    song into the idle deck and crossfades between the two, so switching never
+    creates new threads or players.
+    """
+
+    def __init__(self, fade_in=3, fade_out=3, volume=60, interval_res=0.05, parse_timeout=5.0,
+                 media_cache_size=32, threaded=True):
+        """
+        :param fade_in: number of seconds to use for fading in a song
+        :param fade_out: number of seconds to use for fading out a song
+        :param volume: the volume at which songs should be played
+        :param interval_res: the number of seconds between volume updates while fading
+        :param parse_timeout: number of seconds to wait for VLC to parse a song whose length is unknown
+        :param media_cache_size: number of vlc.Media instances to keep around for reuse
+        :param threaded: whether to drive the decks from a control thread - if False,
+                         run_async must be awaited on an event loop instead
+        """
+        self.fade_in = fade_in
+        self.fade_out = fade_out
+        self.volume = volume
+        self.interval_res = interval_res
+        self.parse_timeout = parse_timeout
+        self.media_cache_size = media_cache_size
+
+        self.instance = vlc.Instance()
+        self.media_cache = OrderedDict()
+
+        self.condition = Condition()
+        self.commands = deque()
+        self.closed = False
+
+        # set while the decks are driven by run_async
+        self.loop = None
+        self.wake = None
+
+        self.decks = [
+            _Deck(self.instance, self._on_end, self._on_playing),
+            _Deck(self.instance, self._on_end, self._on_playing),
+        ]
+        self.active = 0
+
+        self.runner = None
+        if threaded:
+            self.runner = Thread(target=self._run)
+            self.runner.daemon = True
+            self.runner.start()
+
+    def play(self, song, position=None, length=None, callback=None):
+        print('play_song({}, {})'.format(song, position))
+        self._submit(('play', song, position, length, callback))
+
+    def preload(self, song, position=None, length=None):
+        self._submit(('preload', song, position, length))
+
+    def stop(self):
+        self._submit(('stop',))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self._notify()
+        if self.runner is not None:
+            self.runner.join()
+
+        for deck in self.decks:
+            deck.player.stop()
+            deck.player.release()
+        for media in self.media_cache.values():
+            media.release()
+        self.media_cache.clear()
+        self.instance.release()
+
+    def playback_threads(self):
+        # VLC's own decoding threads are not visible to python
+        return int(self.runner is not None and self.runner.is_alive())
+
+    def _notify(self):
+        # must be called with the condition held
+        self.condition.notify()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def _submit(self, command):
+        with self.condition:
+            self.commands.append(command)
+            self._notify()
+
+    def _on_end(self, deck):
+        # called from a VLC thread - libvlc must not be re-entered here
+        with self.condition:
+            deck.ended = True
+            self._notify()
+
+    def _on_playing(self, deck):
+        # called from a VLC thread - a deck being preloaded is not audible,
+        # and is paused from the control thread
+        with self.condition:
+            deck.started = True
+            if deck.pause_pending:
+                self._notify()
+        if deck.playing:
+            self.report_audible(deck.song)
+
+    def _get_media(self, song):
+        media = self.media_cache.pop(song, None)
+        if media is None:
+            media = self.instance.media_new(song)
+        self.media_cache[song] = media
+
+        while len(self.media_cache) > self.media_cache_size:
+            # never release media that is loaded on one of the decks
+            loaded = set(deck.song for deck in self.decks)
+            loaded.update(deck.preloaded[0] for deck in self.decks if deck.preloaded is not None)
+            for old_song in self.media_cache:
+                if old_song not in loaded:
+                    self.media_cache.pop(old_song).release()
+                    break
+            else:
+                break
+        return media
+
+    def _start_fade(self, deck, end_volume, duration, now):
+        deck.fade = _Fade(now, deck.volume, end_volume, duration or 0)
+
+    def _execute(self, command, now):
+        if command[0] == 'stop':
+            deck = self.decks[self.active]
+            if deck.playing:
+                deck.callback = None
+                deck.fading_out = True
+                self._start_fade(deck, 0, self.fade_out, now)
+            return
+
+        if command[0] == 'preload':
+            self._preload(*command[1:])
+            return
+
+        _, song, position, length, callback = command
+        position = position or 0
+
+        outgoing = self.decks[self.active]
+        self.active = 1 - self.active
+        deck = self.decks[self.active]
+
+        preloaded = deck.preloaded
+        started = deck.started
+        # overlapping switches - cut whatever is still fading on the idle deck
+        if deck.playing:
+            deck.player.stop()
+            preloaded = None
+        deck.reset()
+
+        if preloaded is not None and preloaded[:2] == (song, position):
+            # already opened - if it has started, it was paused a moment
+            # after its start, so is seeked back before unpausing it
+            if length is None:
+                length = preloaded[2]
+            deck.started = started
+            if started:
+                deck.player.set_time(int(position * 1000))
+                deck.player.set_pause(0)
+        else:
+            length = self._load(deck, song, position, length)
+
+        now = time.monotonic()
+        deck.song = song
+        deck.callback = callback
+        deck.playing = True
+        if length is not None:
+            deck.end_time = now + max(length - position, 0)
+        self._start_fade(deck, self.volume, self.fade_in, now)
+
+        if outgoing.playing:
+            outgoing.callback = None
+            outgoing.end_time = None
+            outgoing.fading_out = True
+            self._start_fade(outgoing, 0, self.fade_out, now)
+
+    def _load(self, deck, song, position, length):
+        """
+        Starts the song on the deck at volume 0.
+
+        :return: the length of the song, if known
+        """
+        media = self._get_media(song)
+        if length is None:
+            length = parse_media_length(media, self.parse_timeout)
+            if length is None:
+                print('INFO: Could not determine length of {}, playing until it ends.'.format(song))
+
+        if position:
+            # libvlc ignores a seek until the player is playing, so the start
+            # is set on a copy of the media instead - the cached media is
+            # shared by every load of the song
+            media = media.duplicate()
+            media.add_option('start-time={:.3f}'.format(position))
+            deck.player.set_media(media)
+            # the player holds its own reference
+            media.release()
+        else:
+            deck.player.set_media(media)
+        with self.condition:
+            deck.started = False
+            deck.pause_pending = False
+        deck.player.audio_set_volume(0)
+        deck.player.play()
+        return length
+
+    def _preload(self, song, position, length):
+        position = position or 0
+        deck = self.decks[1 - self.active]
+        if deck.playing:
+            # still fading out the previous song
+            return
+        if deck.preloaded is not None and deck.preloaded[:2] == (song, position):
+            return
+
+        # opening, parsing and seeking happen now rather than at the switch -
+        # the deck plays silently until VLC reports it playing, then is paused
+        length = self._load(deck, song, position, length)
+        with self.condition:
+            deck.pause_pending = True
+        deck.preloaded = (song, position, length)
+
+    def _step(self, now):
+        """
+        Advances fades and end-of-song handling to the given time.
+
+        :return: a list of callbacks to be run outside of the lock
+        """
+        callbacks = []
+        for deck in self.decks:
+            if deck.pause_pending and deck.started:
+                deck.pause_pending = False
+                deck.player.set_pause(1)
+
+            if not deck.playing:
+                # a late end event for a deck that was already stopped
+                deck.ended = False
+                continue
+
+            if deck.fade is not None:
+                deck.set_volume(deck.fade.volume_at(now))
+                if deck.fade.finished(now):
+                    deck.fade = None
+                    if deck.fading_out:
+                        deck.player.stop()
+                        deck.reset()
+                        continue
+
+            out_time = None
+            if deck.end_time is not None:
+                out_time = deck.end_time - (self.fade_out or 0)
+
+            if deck.ended or (out_time is not None and now >= out_time and not deck.fading_out):
+                # the song is running out - begin fading it, and let the
+                # callback schedule what plays next so the two overlap
+                if deck.callback is not None:
+                    callbacks.append((deck.callback, deck.song))
+                    deck.callback = None
+                if deck.ended:
+                    deck.player.stop()
+                    deck.reset()
+                else:
+                    deck.fading_out = True
+                    self._start_fade(deck, 0, deck.end_time - now, now)
+        return callbacks
+
+    def _next_deadline(self, now):
+        deadline = None
+        for deck in self.decks:
+            if not deck.playing:
+                continue
+            if deck.fade is not None:
+                # tick on a fixed grid anchored at the fade start
+                elapsed = now - deck.fade.start_time
+                ticks = int(elapsed / self.interval_res) + 1
+                candidate = min(
+                    deck.fade.start_time + ticks * self.interval_res,
+                    deck.fade.start_time + deck.fade.duration,
+                )
+            elif deck.end_time is not None and not deck.fading_out:
+                candidate = deck.end_time - (self.fade_out or 0)
+            else:
+                continue
+            if deadline is None or candidate < deadline:
+                deadline = candidate
+        return deadline
+
+    def _wait_time(self):
+        """
+        Returns the number of seconds until the decks next need attention, 0
+        if they need it now, or None if only a command can change anything.
+        Must be called with the condition held.
+        """
+        if self.commands or self.closed or any(deck.ended for deck in self.decks if deck.playing):
+            return 0
+        if any(deck.pause_pending and deck.started for deck in self.decks):
+            return 0
+        now = time.monotonic()
+        deadline = self._next_deadline(now)
+        if deadline is None:
+            return None
+        return max(deadline - now, 0)
+
+    def _take_commands(self):
+        with self.condition:
+            commands = list(self.commands)
+            self.commands.clear()
+        return commands
+
+    def _advance(self, commands):
+        for command in commands:
+            self._execute(command, time.monotonic())
+
+        for callback, song in self._step(time.monotonic()):
+            callback(song)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                wait_time = self._wait_time()
+                if wait_time != 0:
+                    self.condition.wait(wait_time)
+                if self.closed:
+                    return
+
+            self._advance(self._take_commands())
+
+    async def run_async(self):
+        loop = asyncio.get_event_loop()
+        with self.condition:
+            self.loop = loop
+            self.wake = asyncio.Event()
+
+        try:
+            while True:
+                with self.condition:
+                    wait_time = self._wait_time()
+                if wait_time != 0:
+                    try:
+                        await asyncio.wait_for(self.wake.wait(), wait_time)
+                    except asyncio.TimeoutError:
+                        pass
+                self.wake.clear()
+                if self.closed:
+                    return
+
+                commands = self._take_commands()
+                for index, command in enumerate(commands):
+                    # parsing can take a while, so keep it off the event loop
+                    if command[0] == 'play' and command[3] is None:
+                        media = self._get_media(command[1])
+                        length = await loop.run_in_executor(None, parse_media_length, media, self.parse_timeout)
+                        commands[index] = command[:3] + (length,) + command[4:]
+                self._advance(commands)
+        finally:
+            with self.condition:
+                self.loop = None
+                self.wake = None
@@ -0,0 +1,207 @@
+import random
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over a list of non-negative weights, supporting
+    O(log n) weight updates, prefix sums and weighted searches.
+    """
+
+    def __init__(self, weights):
+        self.weights = [float(weight) for weight in weights]
+        self.size = len(self.weights)
+        self._rebuild()
+
+    def _rebuild(self):
+        tree = [0.0] + list(self.weights)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                tree[parent] += tree[index]
+        self.tree = tree
+        # updates are applied as deltas, so floating point error creeps into
+        # the partial sums - rebuilding every size updates keeps it bounded
+        self._updates = 0
+
+    def __len__(self):
+        return self.size
+
+    def set(self, index, weight):
+        weight = float(weight)
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self._updates += 1
+        if self._updates > self.size:
+            self._rebuild()
+            return
+        position = index + 1
+        while position <= self.size:
+            self.tree[position] += delta
+            position += position & -position
+
+    def append(self, weight):
+        """
+        Adds a weight to the end of the tree - O(log n)
+        """
+        weight = float(weight)
+        self.weights.append(weight)
+        self.size += 1
+        # the new node covers the weights after its lowest set bit is cleared
+        lower = self.size - (self.size & -self.size)
+        self.tree.append(weight + self.prefix_sum(self.size - 1) - self.prefix_sum(lower))
+
+    def prefix_sum(self, index):
+        """
+        Returns the sum of the first index weights
+        """
+        total = 0.0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def total(self):
+        return self.prefix_sum(self.size)
+
+    def find(self, target):
+        """
+        Returns the index i for which prefix_sum(i) <= target < prefix_sum(i + 1),
+        i.e. drawing target uniformly from [0, total) picks each index with
+        probability proportional to its weight
+        """
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] <= target:
+                position = next_position
+                target -= self.tree[next_position]
+            step >>= 1
+        if position >= self.size:
+            # rounding carried target past the total - take the last item
+            # with any weight
+            position = self.size - 1
+            while position > 0 and self.weights[position] <= 0.0:
+                position -= 1
+        return position
+
+
+class TwoLevelSampler:
+    """
+    Draws items grouped into groups (e.g. snippets by song) in two steps:
+    a group with probability proportional to the mean weight of its items,
+    then an item of that group with probability proportional to its weight.
+    The draw, a change to an item's weight, and adding or removing an item
+    are all O(log n).
+
+    Removed items keep their index, with a weight of zero, so that the
+    indices of the others do not change.
+    """
+
+    def __init__(self, weights, groups):
+        """
+        :param weights: the weight of each item
+        :param groups: the group of each item - any hashable
+        """
+        self.groups = []
+        self.group_indices = {}
+        # item -> (group index, index within the group)
+        self.locations = []
+        members = []
+        for weight, group in zip(weights, groups):
+            if group not in self.group_indices:
+                self.group_indices[group] = len(self.groups)
+                self.groups.append(group)
+                members.append([])
+            group_index = self.group_indices[group]
+            self.locations.append((group_index, len(members[group_index])))
+            members[group_index].append(len(self.locations) - 1)
+
+        self.members = members
+        self.group_trees = [
+            FenwickTree([weights[item] for item in items]) for items in members
+        ]
+        # number of items of each group which have not been removed
+        self.live = [len(items) for items in members]
+        # 1 for each item which has not been removed, to draw from uniformly
+        self.alive = FenwickTree([1.0] * len(self.locations))
+        self.top = FenwickTree([tree.total() / len(tree) for tree in self.group_trees])
+
+    def __len__(self):
+        return len(self.locations)
+
+    def weight(self, item):
+        group_index, index = self.locations[item]
+        return self.group_trees[group_index].weights[index]
+
+    def group_weight(self, group_index):
+        return self.top.weights[group_index]
+
+    def is_removed(self, item):
+        return self.alive.weights[item] == 0.0
+
+    def set_weight(self, item, weight):
+        if self.is_removed(item):
+            return
+        group_index, index = self.locations[item]
+        self.group_trees[group_index].set(index, weight)
+        self._update_group(group_index)
+
+    def _update_group(self, group_index):
+        tree = self.group_trees[group_index]
+        live = self.live[group_index]
+        self.top.set(group_index, max(tree.total(), 0.0) / live if live else 0.0)
+
+    def add(self, weight, group):
+        """
+        Adds an item to the end
+
+        :return: the index of the new item
+        """
+        if group not in self.group_indices:
+            self.group_indices[group] = len(self.groups)
+            self.groups.append(group)
+            self.members.append([])
+            self.group_trees.append(FenwickTree([]))
+            self.live.append(0)
+            self.top.append(0.0)
+        group_index = self.group_indices[group]
+
+        item = len(self.locations)
+        self.locations.append((group_index, len(self.members[group_index])))
+        self.members[group_index].append(item)
+        self.group_trees[group_index].append(weight)
+        self.live[group_index] += 1
+        self.alive.append(1.0)
+        self._update_group(group_index)
+        return item
+
+    def remove(self, item):
+        """
+        Stops an item from being drawn
+        """
+        if self.is_removed(item):
+            return
+        group_index, index = self.locations[item]
+        self.group_trees[group_index].set(index, 0.0)
+        self.live[group_index] -= 1
+        self.alive.set(item, 0.0)
+        self._update_group(group_index)
+
+    def sample(self, uniform=random.random):
+        """
+        :param uniform: function returning uniform random numbers in [0, 1)
+        :return: the index of the drawn item, or None if every item has been removed
+        """
+        if self.alive.total() <= 0.0:
+            return None
+        total = self.top.total()
+        if total <= 0.0:
+            # every weight is zero - fall back to a uniform draw over the
+            # items which have not been removed
+            return self.alive.find(uniform() * self.alive.total())
+        group_index = self.top.find(uniform() * total)
+
+        tree = self.group_trees[group_index]
+        index = tree.find(uniform() * tree.total())
+        return self.members[group_index][index]